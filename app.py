@@ -1,23 +1,36 @@
-import os
+import json
 import streamlit as st
-import tempfile
-from utils.document_handler import create_document_handler
-from utils.text_processor import normalize_text, search_terms, generate_summary
-from utils.export_handler import create_excel_export
-from utils.database import get_db_context, Document, SearchResult
-from utils.summarizer import TextSummarizer
-import pandas as pd
-from datetime import datetime
-
-def get_or_create_document(db, filename, page_count):
-    """Get existing document or create new one"""
-    doc = db.query(Document).filter(Document.filename == filename).first()
-    if not doc:
-        doc = Document(filename=filename, page_count=page_count)
-        db.add(doc)
-        db.commit()
-        db.refresh(doc)
-    return doc
+from utils.text_processor import init_tokenizer
+from utils.export_handler import EXPORT_FORMATS, create_export
+from utils.database import get_db_context, init_db, Document
+from utils.hits import get_search_history
+from utils.search_index import init_search_index
+from utils.jobs import (EMBEDDED_WORKER, FAILED, FINISHED, JOB_POLL_SECONDS, QUEUED, get_job, get_job_events,
+                        get_job_results, start_embedded_worker, submit_job)
+from utils.metrics import start_metrics_server
+from utils.ranking import RANK_OVERALL, RANK_PER_TERM, RANK_TOP_K
+from datetime import datetime, timedelta
+
+# Download formats offered in the UI, by label
+EXPORT_FORMAT_LABELS = {"Excel": "xlsx", "CSV": "csv", "JSON Lines": "jsonl", "Parquet": "parquet"}
+
+# Result ranking modes offered in the UI, by label
+RANKING_LABELS = {"Top pages per term": RANK_PER_TERM, "Top pages overall": RANK_OVERALL, "Every match": None}
+
+# Latest results shown while a job runs
+LIVE_RESULTS_SHOWN = 20
+
+@st.cache_resource
+def initialize():
+    """One-time startup work, shared by every session: schema, search index, tokenizer data, metrics server and job worker"""
+    init_db()
+    init_search_index()
+    init_tokenizer()
+    # Serve Prometheus metrics when METRICS_PORT is set
+    start_metrics_server()
+    # Without separate worker processes (worker.py), jobs run in a thread of the app
+    if EMBEDDED_WORKER:
+        start_embedded_worker()
 
 def main():
     st.set_page_config(page_title="Document Search & Analysis", layout="wide")
@@ -25,8 +38,10 @@ def main():
     st.title("Document Search & Analysis Tool")
     st.write("Upload documents and search for specific terms with context.")
 
-    # Initialize summarizer
-    summarizer = TextSummarizer()
+    try:
+        initialize()
+    except Exception as e:
+        st.error(f"Database connection error: {str(e)}")
 
     # File upload section with tooltip
     uploaded_files = st.file_uploader(
@@ -40,7 +55,44 @@ def main():
     search_terms_input = st.text_area(
         "Enter search terms (one per line)",
         height=100,
-        help="Enter the terms you want to search for in your documents. Put each term on a new line. The search is case-insensitive and will find variations of the terms."
+        help="Enter the terms you want to search for in your documents. Put each term on a new line. The search is case-insensitive and ignores accents; turn on fuzzy matching below to also find variations of the terms."
+    )
+
+    include_history = st.checkbox(
+        "Also search previously analyzed documents",
+        help="Search the stored text of every document analyzed before, in addition to the files uploaded now. Uses the full-text index, so it doesn't need the original files."
+    )
+
+    fuzzy_matching = st.checkbox(
+        "Fuzzy matching",
+        help="Also find variants of the terms, such as misspellings, OCR errors and other word forms. Each word may differ by a few characters, depending on its length."
+    )
+    stemming = fuzzy_matching and st.checkbox(
+        "Match word forms (stemming)",
+        help="Also match words that share the same stem, e.g. 'terminate' and 'terminated'."
+    )
+
+    ai_excerpt_summaries = st.checkbox(
+        "Generate AI summaries for each excerpt",
+        help="Summarize every excerpt with OpenAI instead of using its first sentence. Excerpts are summarized concurrently within the configured rate limits."
+    )
+
+    ranking_label = st.selectbox(
+        "Results to keep",
+        list(RANKING_LABELS),
+        help="Rank pages by relevance (BM25) and keep only the best ones, for each term or across all terms. 'Every match' keeps all occurrences, still sorted by relevance."
+    )
+    top_k = RANKING_LABELS[ranking_label] and st.number_input(
+        "Pages to keep",
+        min_value=1,
+        value=RANK_TOP_K,
+        help="How many of the best-matching pages to keep."
+    )
+
+    export_label = st.selectbox(
+        "Export format",
+        list(EXPORT_FORMAT_LABELS),
+        help="File format for downloading the results. CSV, JSON Lines and Parquet are faster to produce than Excel for very large result sets."
     )
 
     if uploaded_files and search_terms_input:
@@ -51,125 +103,32 @@ def main():
             "Analyze Documents",
             help="Click to start processing your documents. This will search for your terms, generate summaries, and save the results."
         ):
-            with st.spinner("Processing documents..."):
-                all_results = []
-
-                try:
-                    with get_db_context() as db:
-                        for uploaded_file in uploaded_files:
-                            with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(uploaded_file.name)[1]) as tmp_file:
-                                tmp_file.write(uploaded_file.read())
-
-                                try:
-                                    # Create appropriate document handler
-                                    doc_handler = create_document_handler(tmp_file.name)
-
-                                    # Extract text from document
-                                    text_by_page = doc_handler.extract_text()
-
-                                    # Create or get document record
-                                    doc = get_or_create_document(db, uploaded_file.name, len(text_by_page))
-
-                                    # Search for terms
-                                    for term in search_terms_list:
-                                        results = search_terms(text_by_page, term)
-                                        if results:
-                                            for page_num, excerpts in results.items():
-                                                for excerpt in excerpts:
-                                                    context_summary = generate_summary(excerpt)
-
-                                                    # Store in database
-                                                    search_result = SearchResult(
-                                                        document_id=doc.id,
-                                                        search_term=term,
-                                                        page_number=page_num + 1,
-                                                        excerpt=excerpt,
-                                                        summary=context_summary
-                                                    )
-                                                    db.add(search_result)
-
-                                                    all_results.append({
-                                                        'Document': uploaded_file.name,
-                                                        'Search Term': term,
-                                                        'Page': page_num + 1,
-                                                        'Excerpt': excerpt,
-                                                        'Summary': context_summary
-                                                    })
-
-                                except Exception as e:
-                                    st.error(f"Error processing {uploaded_file.name}: {str(e)}")
-                                    continue
-
-                                finally:
-                                    # Clean up temporary file
-                                    try:
-                                        os.unlink(tmp_file.name)
-                                    except:
-                                        pass
-
-                        # Commit all changes
-                        try:
-                            db.commit()
-                        except Exception as e:
-                            st.error(f"Error saving results to database: {str(e)}")
-                            db.rollback()
-
-                except Exception as e:
-                    st.error(f"Database connection error: {str(e)}")
-                    return
-
-                if all_results:
-                    # Generate and display overall summary
-                    st.header("Search Summary")
-                    st.caption("An AI-generated summary of all search results, providing a quick overview of the key findings.")
-
-                    with st.spinner("Generating summary..."):
-                        overall_summary = summarizer.summarize_search_results(all_results)
-                        if overall_summary:
-                            if "API quota exceeded" in overall_summary:
-                                st.error(overall_summary)
-                                st.info("Please visit https://platform.openai.com/billing to check your credit balance and billing status.")
-                            elif "API key not found" in overall_summary:
-                                st.warning(overall_summary)
-                            elif "rate limit" in overall_summary:
-                                st.warning(overall_summary)
-                                st.info("Please wait a moment before trying again.")
-                            elif "Error generating summary" in overall_summary:
-                                st.error(overall_summary)
-                            else:
-                                st.write(overall_summary)
-                        else:
-                            st.warning("Could not generate summary. Please check the error logs for details.")
-
-                    # Add prominent header for Search Results section
-                    st.header("Search Results")
-                    st.caption("Detailed findings organized by search term. Click to expand each section.")
-
-                    # Group results by search term and display in expandable sections
-                    df = pd.DataFrame(all_results)
-                    grouped_results = df.groupby('Search Term')
-
-                    for term, group in grouped_results:
-                        with st.expander(f"**Results for: {term}**"):
-                            st.write(f"Found {len(group)} matches")
-                            for _, row in group.iterrows():
-                                st.write("**Document:**", row['Document'])
-                                st.write("**Page:**", row['Page'])
-                                st.write("**Context:**")
-                                st.write(row['Excerpt'])
-                                st.markdown("---")
-
-                    # Export to Excel with tooltip
-                    excel_file = create_excel_export(df)
-                    st.download_button(
-                        label="Download Results as Excel",
-                        data=excel_file,
-                        file_name="search_results.xlsx",
-                        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                        help="Download all search results in Excel format for offline analysis and sharing."
+            # The analysis runs in a worker; the page follows its progress through the job id in the URL
+            try:
+                with get_db_context() as db:
+                    job_id = submit_job(
+                        db,
+                        [(uploaded_file.name, uploaded_file.getvalue()) for uploaded_file in uploaded_files],
+                        {
+                            "terms": search_terms_list,
+                            "fuzzy": fuzzy_matching,
+                            "stem": stemming,
+                            "include_history": include_history,
+                            "ai_excerpt_summaries": ai_excerpt_summaries,
+                            "rank": RANKING_LABELS[ranking_label],
+                            "top_k": int(top_k) if top_k else None
+                        }
                     )
-                else:
-                    st.warning("No matches found for the provided search terms.")
+                st.query_params["job"] = str(job_id)
+            except Exception as e:
+                st.error(f"Database connection error: {str(e)}")
+
+    job_id = st.query_params.get("job")
+    if job_id and job_id.isdigit():
+        try:
+            show_job(int(job_id), export_label)
+        except Exception as e:
+            st.error(f"Database connection error: {str(e)}")
 
     # Show previous searches section
     st.header("Previous Search Results")
@@ -177,26 +136,210 @@ def main():
 
     with st.expander("View Previous Search Results"):
         try:
-            with get_db_context() as db:
-                previous_results = (
-                    db.query(SearchResult)
-                    .join(Document)
-                    .order_by(SearchResult.id.desc())
-                    .limit(50)
-                    .all()
-                )
-
-                if previous_results:
-                    for result in previous_results:
-                        st.write(f"**Document:** {result.document.filename}")
-                        st.write(f"**Search Term:** {result.search_term}")
-                        st.write(f"**Page:** {result.page_number}")
-                        st.write(f"**Excerpt:**\n{result.excerpt}")
-                        st.write("---")
-                else:
-                    st.write("No previous search results found.")
+            show_search_history()
         except Exception as e:
             st.error(f"Error loading previous results: {str(e)}")
 
+def show_job(job_id, export_label):
+    """Progress of a queued or running job, or the results of a finished one"""
+    with get_db_context() as db:
+        job = get_job(db, job_id)
+    if job is None:
+        st.warning("This analysis could not be found.")
+        return
+
+    if job.status in FINISHED:
+        show_job_results(job, export_label)
+    else:
+        show_job_progress(job_id)
+
+@st.fragment(run_every=JOB_POLL_SECONDS)
+def show_job_progress(job_id):
+    """Reruns on its own every JOB_POLL_SECONDS, fetching only results saved since the last poll"""
+    state = st.session_state
+    if state.get("live_job") != job_id:
+        state.live_job = job_id
+        state.live_rows = []
+
+    with get_db_context() as db:
+        job = get_job(db, job_id)
+        after_id = state.live_rows[-1]['id'] if state.live_rows else 0
+        state.live_rows.extend(get_job_results(db, job_id, after_id=after_id))
+        errors = get_job_events(db, job_id, level="error")
+
+    if job.status in FINISHED:
+        # Reload the history view so it includes the new results, then show the final view
+        state.pop("history_filters", None)
+        st.rerun()
+
+    st.header("Processing documents...")
+    if job.status == QUEUED:
+        st.info("Waiting for a worker to start the analysis.")
+    st.progress(
+        job.files_done / job.files_total if job.files_total else 0.0,
+        text=f"{job.message} ({job.files_done} of {job.files_total} files)"
+    )
+    for event in errors:
+        st.error(event.message)
+
+    if state.live_rows:
+        st.write(f"Found {len(state.live_rows)} matches so far")
+        st.dataframe(
+            [{column: row[column] for column in ('Document', 'Search Term', 'Page', 'Excerpt')}
+             for row in state.live_rows[-LIVE_RESULTS_SHOWN:]]
+        )
+
+def show_summary(overall_summary):
+    if overall_summary:
+        if "API quota exceeded" in overall_summary:
+            st.error(overall_summary)
+            st.info("Please visit https://platform.openai.com/billing to check your credit balance and billing status.")
+        elif "API key not found" in overall_summary:
+            st.warning(overall_summary)
+        elif "rate limit" in overall_summary:
+            st.warning(overall_summary)
+            st.info("Please wait a moment before trying again.")
+        elif "Error generating summary" in overall_summary:
+            st.error(overall_summary)
+        else:
+            st.write(overall_summary)
+    else:
+        st.warning("Could not generate summary. Please check the error logs for details.")
+
+def show_job_results(job, export_label):
+    import pandas as pd
+
+    with get_db_context() as db:
+        errors = get_job_events(db, job.id, level="error")
+        all_results = get_job_results(db, job.id, ranked=True)
+
+    for event in errors:
+        st.error(event.message)
+    if job.status == FAILED:
+        st.error(f"Error processing documents: {job.error}")
+        return
+
+    stats = json.loads(job.stats) if job.stats else {}
+    store_stats = stats.get("page_store")
+    if store_stats:
+        st.caption(
+            f"Extracted text store: {store_stats['hits']} hits, {store_stats['misses']} misses "
+            f"({store_stats['hit_rate']:.0%} hit rate)"
+        )
+
+    if all_results:
+        # Display the overall summary generated by the worker
+        st.header("Search Summary")
+        st.caption("An AI-generated summary of all search results, providing a quick overview of the key findings.")
+        show_summary(job.summary)
+
+        cache_stats = stats.get("summary_cache")
+        if cache_stats:
+            st.caption(
+                f"Summary cache: {cache_stats['memory_hits'] + cache_stats['db_hits']} hits, "
+                f"{cache_stats['misses']} misses ({cache_stats['hit_rate']:.0%} hit rate)"
+            )
+
+        # Add prominent header for Search Results section
+        st.header("Search Results")
+        st.caption("Detailed findings organized by search term. Click to expand each section.")
+
+        # Group results by search term and display in expandable sections, most relevant first
+        df = pd.DataFrame(all_results)
+        grouped_results = df.groupby('Search Term')
+
+        for term, group in grouped_results:
+            with st.expander(f"**Results for: {term}**"):
+                st.write(f"Found {len(group)} matches")
+                for _, row in group.iterrows():
+                    st.write("**Document:**", row['Document'])
+                    st.write("**Page:**", row['Page'])
+                    if pd.notna(row['Score']):
+                        st.write("**Relevance:**", round(row['Score'], 2))
+                    st.write("**Context:**")
+                    st.write(row['Excerpt'])
+                    st.markdown("---")
+
+        # Per-document, per-stage timings recorded by the worker
+        if stats.get("timings"):
+            with st.expander("Performance breakdown"):
+                st.caption("Seconds spent in each stage. Stages can nest (sentence tokenization runs inside search), so a row can add up to more than its wall time.")
+                st.dataframe(pd.DataFrame(stats["timings"]).T.fillna(0).round(3))
+
+        # Export in the chosen format with tooltip; rows are streamed straight from the results
+        export_format = EXPORT_FORMAT_LABELS[export_label]
+        _, extension, mime = EXPORT_FORMATS[export_format]
+        try:
+            export_file = create_export(all_results, export_format)
+            st.download_button(
+                label=f"Download Results as {export_label}",
+                data=export_file,
+                file_name=f"search_results.{extension}",
+                mime=mime,
+                help=f"Download all search results in {export_label} format for offline analysis and sharing."
+            )
+        except Exception as e:
+            st.error(f"Error exporting results: {str(e)}")
+    else:
+        st.warning("No matches found for the provided search terms.")
+
+def show_search_history():
+    """Filterable history of saved results, loaded a page at a time as the user asks for more"""
+    with get_db_context() as db:
+        documents = db.query(Document.id, Document.filename).order_by(Document.filename).all()
+
+    col_term, col_document, col_dates = st.columns(3)
+    term_filter = col_term.text_input("Search term", help="Show only results for this exact search term.")
+    document_filter = col_document.selectbox(
+        "Document",
+        [None] + documents,
+        format_func=lambda doc: "All documents" if doc is None else doc.filename
+    )
+    date_range = col_dates.date_input("Saved between", value=(), help="Leave empty to show results from any date.")
+
+    filters = {
+        "search_term": term_filter.strip() or None,
+        "document_id": document_filter.id if document_filter else None,
+        "since": datetime.combine(date_range[0], datetime.min.time()) if date_range else None,
+        # The end date is inclusive
+        "until": datetime.combine(date_range[-1], datetime.min.time()) + timedelta(days=1) if date_range else None
+    }
+
+    # Loaded pages are kept across reruns until the filters change
+    state = st.session_state
+    if state.get("history_filters") != filters:
+        state.history_filters = filters
+        state.history_rows = []
+        state.history_cursor = None
+        load_history_page(filters)
+
+    if state.history_rows:
+        for row in state.history_rows:
+            st.write(f"**Document:** {row['document']}")
+            st.write(f"**Search Term:** {row['search_term']}")
+            st.write(f"**Page:** {row['page_number']}")
+            st.write(f"**Excerpt:**\n{row['excerpt']}")
+            st.write("---")
+    else:
+        st.write("No previous search results found.")
+
+    if state.history_cursor is not None and st.button("Load more"):
+        load_history_page(filters, state.history_cursor)
+        st.rerun()
+
+def load_history_page(filters, before_id=None):
+    """Append the next page of history to the session"""
+    with get_db_context() as db:
+        hits, st.session_state.history_cursor = get_search_history(db, before_id=before_id, **filters)
+        st.session_state.history_rows.extend(
+            {
+                "document": hit["filename"] or "",
+                "search_term": hit["term"],
+                "page_number": hit["page_number"],
+                "excerpt": hit["excerpt"]
+            }
+            for hit in hits
+        )
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,440 @@
+"""Search many documents from the command line, without the Streamlit app.
+
+Runs the app's pipeline (stored page text or extraction, search, saving
+results) over a directory, glob or list of files, extracting with a pool of
+worker processes; large text files are instead extracted, stored and searched
+a page at a time. Each chunk's export rows are synced to disk before its files
+are appended to a checkpoint file, so running the same command again after a
+crash or Ctrl-C resumes instead of restarting. A run that finishes removes its
+checkpoint; the next run starts from scratch.
+
+    python batch.py /data/contracts --terms terms.txt --output results.csv
+    python batch.py "/data/**/*.pdf" --terms terms.txt --workers 8 --no-db --output results.jsonl
+"""
+import argparse
+import glob
+import hashlib
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterator, List, Optional
+
+from utils.document_handler import (EXTRACT_WORKERS, EXTRACTOR_VERSION, HANDLERS, extract_documents, is_streamed,
+                                     iter_document_pages)
+from utils.export_handler import EXPORT_FORMATS, export_to_file
+from utils.fuzzy_matcher import FuzzyMatcher
+from utils.metrics import document_context, write_metrics_file
+from utils.text_processor import NormalizedPage, TermMatcher, iter_search_hits, search_hits_multi, search_version
+
+# Columns of the export file; unlike the app's export, rows come from many documents
+BATCH_COLUMNS = ['Document', 'Search Term', 'Page', 'Excerpt', 'Summary']
+
+# Files processed, saved and checkpointed together
+DEFAULT_CHUNK_SIZE = 32
+
+def find_files(inputs: List[str]) -> List[str]:
+    """Expand directories (recursively) and glob patterns into a sorted list of supported files"""
+    files = set()
+    for item in inputs:
+        if os.path.isdir(item):
+            for root, _, names in os.walk(item):
+                files.update(os.path.join(root, name) for name in names)
+        elif glob.has_magic(item):
+            files.update(path for path in glob.glob(item, recursive=True) if os.path.isfile(path))
+        else:
+            files.add(item)
+    return sorted(path for path in files if os.path.splitext(path)[1].lower() in HANDLERS)
+
+def read_terms(path: str) -> List[str]:
+    """Read one search term per line, skipping blank lines and # comments"""
+    with open(path, encoding="utf-8") as file:
+        return [line.strip() for line in file if line.strip() and not line.lstrip().startswith("#")]
+
+def hash_file(path: str) -> str:
+    """SHA-256 of a file, read in chunks; the same key as utils.page_store.compute_content_hash"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def run_fingerprint(terms: List[str], matcher: TermMatcher, inputs: List[str], use_db: bool, output) -> str:
+    """Hash of everything besides the files themselves that decides a run's results"""
+    key = {
+        "terms": terms, "mode": matcher.mode, "extractor_version": EXTRACTOR_VERSION, "search_version": search_version(),
+        "inputs": sorted(inputs), "use_db": use_db, "output": output
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode("utf-8")).hexdigest()
+
+def _file_stat(path: str) -> dict:
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return {}
+    return {"size": stat.st_size, "mtime": stat.st_mtime_ns}
+
+class Checkpoint:
+    """Append-only JSON lines file recording each finished file, so a rerun of the same command can skip it.
+
+    The first line is the run's fingerprint; a checkpoint left by a run with
+    other terms or options is started over rather than resumed. A file counts
+    as done only while its size and modification time are unchanged.
+    """
+
+    def __init__(self, path: str, fingerprint: str):
+        self.path = path
+        self.done: Dict[str, dict] = {}
+        # Size of the row log when the last chunk was recorded
+        self.rows_offset = 0
+        self.resumed = False
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as file:
+                try:
+                    self.resumed = json.loads(file.readline()).get("fingerprint") == fingerprint
+                except ValueError:
+                    pass
+                for line in file if self.resumed else ():
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # A line cut short by a crash; that file is simply processed again
+                        continue
+                    self.done[entry["path"]] = entry
+                    self.rows_offset = entry.get("rows_offset", self.rows_offset)
+            if not self.resumed:
+                print(f"{path} was left by a run with other terms or options; starting over", file=sys.stderr)
+        if not self.resumed:
+            self.start_over(fingerprint)
+
+    def start_over(self, fingerprint: str):
+        with open(self.path, "w", encoding="utf-8") as file:
+            file.write(json.dumps({"fingerprint": fingerprint}) + "\n")
+        self.done = {}
+        self.rows_offset = 0
+        self.resumed = False
+
+    def changed(self, paths: List[str]) -> List[str]:
+        """Files done earlier in this run that have been modified since"""
+        return [path for path in paths if path in self.done and self.done[path]["status"] == "done" and not self.is_done(path)]
+
+    def is_done(self, path: str, retry_errors: bool = False) -> bool:
+        entry = self.done.get(path)
+        if entry is None or (retry_errors and entry["status"] == "error"):
+            return False
+        stat = _file_stat(path)
+        return bool(stat) and entry.get("size") == stat["size"] and entry.get("mtime") == stat["mtime"]
+
+    def record(self, entries: List[dict], rows_offset: int = 0):
+        with open(self.path, "a", encoding="utf-8") as file:
+            for entry in entries:
+                entry["rows_offset"] = rows_offset
+                file.write(json.dumps(entry) + "\n")
+            file.flush()
+            os.fsync(file.fileno())
+        for entry in entries:
+            self.done[entry["path"]] = entry
+        self.rows_offset = rows_offset
+
+class RowLog:
+    """Export rows of a run as JSON lines, synced after each chunk and converted to the output format at the end.
+
+    Opening it drops anything past the checkpoint's offset: the rows of a
+    chunk that was interrupted before being recorded, and written again when
+    the chunk is.
+    """
+
+    def __init__(self, path: str, size: int = 0):
+        self.path = path
+        if size and (not os.path.exists(path) or os.path.getsize(path) < size):
+            raise Exception(f"Error resuming: {path} is missing rows recorded in the checkpoint; "
+                            "remove the checkpoint to start over")
+        self.file = open(path, "ab")
+        self.file.truncate(size)
+
+    def append(self, rows: List[dict]) -> int:
+        """Write rows and sync them to disk; returns the log's new size"""
+        for row in rows:
+            self.file.write(json.dumps(row, ensure_ascii=False, default=str).encode("utf-8"))
+            self.file.write(b"\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        return self.file.tell()
+
+    def close(self):
+        self.file.close()
+
+    def __iter__(self) -> Iterator[dict]:
+        with open(self.path, encoding="utf-8") as file:
+            for line in file:
+                yield json.loads(line)
+
+class Progress:
+    """Prints files done, throughput and an ETA after each chunk"""
+
+    def __init__(self, total: int, stream=sys.stderr):
+        self.total = total
+        self.stream = stream
+        self.started = time.monotonic()
+        self.files = self.pages = self.hits = self.errors = 0
+
+    def update(self, files: int, pages: int, hits: int, errors: int):
+        self.files += files
+        self.pages += pages
+        self.hits += hits
+        self.errors += errors
+        elapsed = time.monotonic() - self.started
+        rate = self.files / elapsed if elapsed else 0.0
+        eta = (self.total - self.files) / rate if rate else 0.0
+        print(
+            f"{self.files}/{self.total} files ({self.files / self.total:.1%}) | "
+            f"{rate:.2f} files/s, {self.pages / elapsed if elapsed else 0:.0f} pages/s | "
+            f"{self.hits} hits, {self.errors} errors | "
+            f"elapsed {time.strftime('%H:%M:%S', time.gmtime(elapsed))}, ETA {time.strftime('%H:%M:%S', time.gmtime(eta))}",
+            file=self.stream, flush=True
+        )
+
+def run_batch(files: List[str], matcher: TermMatcher, checkpoint: Checkpoint, progress: Progress,
+              executor: Optional[ProcessPoolExecutor], chunk_size: int = DEFAULT_CHUNK_SIZE, use_db: bool = True,
+              row_log: Optional[RowLog] = None):
+    """Process files a chunk at a time, checkpointing each chunk once its hits are saved and its rows are on disk.
+
+    Files are extracted on executor's workers, or one at a time in this process when executor is None.
+    """
+    for chunk_start in range(0, len(files), chunk_size):
+        chunk = files[chunk_start:chunk_start + chunk_size]
+        # Taken before reading, so a file changed meanwhile doesn't look done on the next run
+        stats = {path: _file_stat(path) for path in chunk}
+        if use_db:
+            rows, entries = _process_chunk_with_db(chunk, matcher, executor)
+        else:
+            rows, entries = _process_chunk(chunk, matcher, executor)
+        for entry in entries:
+            entry.update(stats[entry["path"]])
+        rows_offset = row_log.append(rows) if row_log is not None else 0
+        checkpoint.record(entries, rows_offset)
+        progress.update(
+            len(entries),
+            sum(entry.get("pages", 0) for entry in entries),
+            len(rows),
+            sum(1 for entry in entries if entry["status"] == "error")
+        )
+
+def _export_rows(path: str, pages: Dict[int, NormalizedPage], hits_by_term) -> List[dict]:
+    """Render a file's hits into export rows from its pages in memory"""
+    rows = []
+    with document_context(path):
+        for term, results in hits_by_term.items():
+            for page_num, windows in results.items():
+                page = pages[page_num]
+                for start, end, _ in windows:
+                    rows.append({
+                        'Document': path,
+                        'Search Term': term,
+                        'Page': page_num + 1,
+                        'Excerpt': page.excerpt(start, end),
+                        'Summary': page.first_sentence(start, end)
+                    })
+    return rows
+
+def _streams(path: str) -> bool:
+    try:
+        return is_streamed(path)
+    except OSError:
+        # Reported when the file is read
+        return False
+
+def _error_entry(path: str, error: Exception) -> dict:
+    print(f"Error processing {path}: {str(error)}", file=sys.stderr)
+    return {"path": path, "status": "error", "error": str(error)}
+
+def _process_chunk(chunk: List[str], matcher: TermMatcher, executor: Optional[ProcessPoolExecutor]):
+    """Extract and search without the database"""
+    rows, entries = [], []
+    streamed = [_streams(path) for path in chunk]
+    pooled = [path for path, stream in zip(chunk, streamed) if not stream]
+    extracted = iter(extract_documents(pooled, max_workers=1, document_names=pooled, executor=executor))
+    for path, stream in zip(chunk, streamed):
+        if stream:
+            try:
+                file_rows, page_count = _search_stream(path, matcher)
+            except Exception as e:
+                entries.append(_error_entry(path, e))
+                continue
+        else:
+            text_by_page, error = next(extracted)
+            if error:
+                entries.append(_error_entry(path, error))
+                continue
+            pages = {n: NormalizedPage(t) for n, t in text_by_page.items()}
+            with document_context(path):
+                hits_by_term = search_hits_multi(pages, matcher)
+            file_rows = _export_rows(path, pages, hits_by_term)
+            page_count = len(pages)
+        rows.extend(file_rows)
+        entries.append({"path": path, "status": "done", "pages": page_count, "hits": len(file_rows)})
+    return rows, entries
+
+def _search_stream(path: str, matcher: TermMatcher):
+    """Extract and search a large file a page at a time; returns its export rows and page count"""
+    rows = []
+    page_count = 0
+    with document_context(path):
+        for page_num, text in iter_document_pages(path):
+            page = NormalizedPage(text)
+            for _, page_hits in iter_search_hits(((page_num, page),), matcher):
+                rows.extend(_export_rows(path, {page_num: page}, {term: {page_num: windows}
+                                                                  for term, windows in page_hits.items()}))
+            page_count += 1
+    return rows, page_count
+
+def _process_chunk_with_db(chunk: List[str], matcher: TermMatcher, executor: Optional[ProcessPoolExecutor]):
+    """Reuse stored page text and earlier searches, extract the rest, search, and save documents and hits in one commit.
+
+    Terms a file was already searched for are not scanned again (see
+    utils.search_memo), and hits stored before are not saved again. Large
+    text files not stored yet are extracted, stored and searched a page at a
+    time.
+    """
+    from utils.database import get_db_context, upsert_document
+    from utils.hits import get_term_ids, hit_rows, save_hits
+    from utils.page_store import PageStore
+    from utils.search_memo import SearchMemo
+
+    rows, entries = [], []
+    with get_db_context() as db:
+        page_store = PageStore(db)
+        pages_by_file = []
+        for path in chunk:
+            try:
+                content_hash = hash_file(path)
+                pages_by_file.append([content_hash, page_store.get_pages(content_hash), None])
+            except Exception as e:
+                pages_by_file.append([None, None, e])
+
+        missing = [i for i, (content_hash, pages, error) in enumerate(pages_by_file)
+                   if pages is None and error is None and not _streams(chunk[i])]
+        extracted = extract_documents([chunk[i] for i in missing], max_workers=1,
+                                      document_names=[chunk[i] for i in missing], executor=executor)
+        for i, (text_by_page, error) in zip(missing, extracted):
+            if error:
+                pages_by_file[i][2] = error
+                continue
+            pages = {n: NormalizedPage(t) for n, t in text_by_page.items()}
+            with document_context(chunk[i]):
+                page_store.put(pages_by_file[i][0], pages)
+            pages_by_file[i][1] = pages
+
+        term_ids = get_term_ids(db, matcher.terms)
+        memo = SearchMemo(db, matcher)
+        hit_rows_by_file = []
+        for path, (content_hash, pages, error) in zip(chunk, pages_by_file):
+            if error:
+                entries.append(_error_entry(path, error))
+                continue
+            if pages is None:
+                try:
+                    file_rows, hits_by_term, page_count = _store_stream(page_store, memo, path, content_hash)
+                except Exception as e:
+                    entries.append(_error_entry(path, e))
+                    continue
+            else:
+                with document_context(path):
+                    hits_by_term, _ = memo.search(content_hash, pages)
+                file_rows = _export_rows(path, pages, hits_by_term)
+                page_count = len(pages)
+            document_id = upsert_document(db, path, page_count, content_hash)
+            hit_rows_by_file.extend(hit_rows(hits_by_term, matcher.terms, term_ids, document_id,
+                                             extractor_version=page_store.extractor_version, mode=matcher.mode))
+            rows.extend(file_rows)
+            entries.append({"path": path, "status": "done", "content_hash": content_hash,
+                            "pages": page_count, "hits": len(file_rows)})
+
+        save_hits(db, hit_rows_by_file)
+        db.commit()
+    return rows, entries
+
+def _store_stream(page_store, memo, path: str, content_hash: str):
+    """Extract, store and search a large file a page at a time; returns its export rows, hits by term and page count"""
+    rows = []
+    hits_by_term = {}
+    page_count = 0
+    with document_context(path):
+        pages = ((page_num, NormalizedPage(text)) for page_num, text in iter_document_pages(path))
+        for page_num, page, page_hits in memo.search_stream(content_hash, page_store.store_pages(content_hash, pages)):
+            page_results = {term: {page_num: windows} for term, windows in page_hits.items()}
+            rows.extend(_export_rows(path, {page_num: page}, page_results))
+            for term, windows in page_hits.items():
+                hits_by_term.setdefault(term, {})[page_num] = windows
+            page_count += 1
+    return rows, hits_by_term, page_count
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Search documents for terms in bulk")
+    parser.add_argument("inputs", nargs="+", help="files, directories (searched recursively) or glob patterns")
+    parser.add_argument("--terms", required=True, help="file with one search term per line")
+    parser.add_argument("--output", help=f"export file; format from its extension ({', '.join(EXPORT_FORMATS)})")
+    parser.add_argument("--no-db", action="store_true", help="don't read or write the database")
+    parser.add_argument("--workers", type=int, default=EXTRACT_WORKERS, help="extraction worker processes")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE, help="files saved and checkpointed together")
+    parser.add_argument("--checkpoint", default="batch_checkpoint.jsonl", help="progress file used to resume an interrupted run")
+    parser.add_argument("--retry-errors", action="store_true", help="process files that failed in an earlier run again")
+    parser.add_argument("--fuzzy", action="store_true", help="also match variants of the terms")
+    parser.add_argument("--stem", action="store_true", help="with --fuzzy, also match words with the same stem")
+    args = parser.parse_args(argv)
+
+    if args.no_db and not args.output:
+        parser.error("--no-db needs --output, or the results would go nowhere")
+    if args.output and os.path.splitext(args.output)[1].lower().lstrip('.') not in EXPORT_FORMATS:
+        parser.error(f"unsupported output format: {args.output}")
+
+    terms = read_terms(args.terms)
+    if not terms:
+        parser.error(f"no search terms in {args.terms}")
+    matcher = FuzzyMatcher(terms, stem=args.stem) if args.fuzzy else TermMatcher(terms)
+
+    use_db = not args.no_db
+    fingerprint = run_fingerprint(terms, matcher, args.inputs, use_db, args.output)
+    checkpoint = Checkpoint(args.checkpoint, fingerprint)
+    all_files = find_files(args.inputs)
+    changed = checkpoint.changed(all_files)
+    if changed:
+        # Their rows from before the change are already in the row log
+        print(f"{len(changed)} files changed since {args.checkpoint} was written; starting over", file=sys.stderr)
+        checkpoint.start_over(fingerprint)
+    files = [path for path in all_files if not checkpoint.is_done(path, args.retry_errors)]
+    skipped = len(all_files) - len(files)
+    print(f"{len(files)} files to process" + (f", resuming after {skipped} already done" if skipped else ""), file=sys.stderr)
+
+    row_log = None
+    if args.output:
+        # A JSON lines export is the row log itself; other formats are written from it at the end
+        log_path = args.output if args.output.lower().endswith(".jsonl") else args.output + ".rows.jsonl"
+        row_log = RowLog(log_path, checkpoint.rows_offset if checkpoint.resumed else 0)
+
+    progress = Progress(len(files))
+    # With one worker files are extracted in this process, without starting a pool
+    executor = ProcessPoolExecutor(max_workers=args.workers) if args.workers > 1 else None
+    try:
+        run_batch(files, matcher, checkpoint, progress, executor, args.chunk_size, use_db, row_log)
+    except KeyboardInterrupt:
+        print(f"Interrupted; {progress.files} files were saved. Run the same command again to resume.", file=sys.stderr)
+        return 130
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        if row_log is not None:
+            row_log.close()
+        write_metrics_file()
+
+    if row_log is not None and row_log.path != args.output:
+        export_to_file(row_log, args.output, columns=BATCH_COLUMNS)
+        os.remove(row_log.path)
+    os.remove(checkpoint.path)
+
+    print(f"Done: {progress.files} files, {progress.hits} hits, {progress.errors} errors", file=sys.stderr)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
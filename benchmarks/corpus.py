@@ -0,0 +1,117 @@
+"""Synthetic PDF, DOCX and TXT corpora for benchmarking the search pipeline."""
+import os
+import random
+from typing import Dict, List
+
+import docx
+
+# Filler vocabulary; accented variants are mixed in according to accent_ratio
+WORDS = (
+    "agreement party contract payment term notice clause liability service period "
+    "delivery invoice schedule obligation amendment warranty breach remedy law court "
+    "the of and to in a is that for on with as by at from this be or an will shall"
+).split()
+ACCENTED_WORDS = "café naïve résumé façade déjà coöperate entrée fiancée Zürich São".split()
+
+DEFAULT_TERMS = ["indemnification", "force majeure", "net 30 days", "confidential", "café"]
+
+def generate_pages(page_count: int, terms: List[str] = DEFAULT_TERMS, term_density: float = 0.002,
+                   accent_ratio: float = 0.02, words_per_page: int = 450, seed: int = 0) -> List[str]:
+    """Generate page texts of roughly 3000 characters.
+
+    term_density is the chance that any word slot holds one of the search terms;
+    accent_ratio is the chance it holds an accented word.
+    """
+    rng = random.Random(seed)
+    pages = []
+    for _ in range(page_count):
+        words = []
+        for position in range(words_per_page):
+            roll = rng.random()
+            if roll < term_density:
+                words.append(rng.choice(terms))
+            elif roll < term_density + accent_ratio:
+                words.append(rng.choice(ACCENTED_WORDS))
+            else:
+                words.append(rng.choice(WORDS))
+            if position % 15 == 14:
+                words[-1] += "."
+        pages.append(" ".join(words))
+    return pages
+
+def write_txt(path: str, pages: List[str]):
+    with open(path, "w", encoding="utf-8") as file:
+        file.write("\n".join(pages))
+
+def write_docx(path: str, pages: List[str]):
+    document = docx.Document()
+    for page in pages:
+        # A few paragraphs per page, like a real document
+        sentences = page.split(". ")
+        for start in range(0, len(sentences), 8):
+            document.add_paragraph(". ".join(sentences[start:start + 8]))
+    document.save(path)
+
+def _pdf_string(text: str) -> bytes:
+    """Encode a PDF literal string in WinAnsi (latin-1) with delimiters escaped"""
+    escaped = text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+    return b"(" + escaped.encode("latin-1", "replace") + b")"
+
+def write_pdf(path: str, pages: List[str], chars_per_line: int = 95):
+    """Write a minimal text PDF using the built-in Helvetica font, one page per entry"""
+    objects = []  # object bodies; object n is objects[n - 1]
+
+    def add(body: bytes) -> int:
+        objects.append(body)
+        return len(objects)
+
+    catalog = add(b"")  # filled in once the page tree exists
+    pages_root = add(b"")
+    font = add(b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>")
+
+    page_ids = []
+    for page in pages:
+        lines, line = [], ""
+        for word in page.split():
+            if line and len(line) + len(word) + 1 > chars_per_line:
+                lines.append(line)
+                line = word
+            else:
+                line = f"{line} {word}" if line else word
+        if line:
+            lines.append(line)
+
+        stream = b"BT /F1 9 Tf 11 TL 40 800 Td " + b" ".join(_pdf_string(l) + b" Tj T*" for l in lines) + b" ET"
+        content = add(b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream")
+        page_ids.append(add(
+            b"<< /Type /Page /Parent %d 0 R /MediaBox [0 0 595 842] "
+            b"/Resources << /Font << /F1 %d 0 R >> >> /Contents %d 0 R >>" % (pages_root, font, content)
+        ))
+
+    objects[catalog - 1] = b"<< /Type /Catalog /Pages %d 0 R >>" % pages_root
+    kids = b" ".join(b"%d 0 R" % page_id for page_id in page_ids)
+    objects[pages_root - 1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (kids, len(page_ids))
+
+    with open(path, "wb") as file:
+        file.write(b"%PDF-1.4\n")
+        offsets = []
+        for number, body in enumerate(objects, start=1):
+            offsets.append(file.tell())
+            file.write(b"%d 0 obj\n" % number + body + b"\nendobj\n")
+        xref = file.tell()
+        file.write(b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1))
+        for offset in offsets:
+            file.write(b"%010d 00000 n \n" % offset)
+        file.write(b"trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, catalog, xref))
+
+WRITERS = {"pdf": write_pdf, "docx": write_docx, "txt": write_txt}
+
+def generate_corpus(directory: str, page_count: int, formats=("pdf", "docx", "txt"), **page_options) -> Dict[str, str]:
+    """Write the same synthetic pages in each format; returns format -> file path"""
+    os.makedirs(directory, exist_ok=True)
+    pages = generate_pages(page_count, **page_options)
+    paths = {}
+    for fmt in formats:
+        paths[fmt] = os.path.join(directory, f"corpus_{page_count}.{fmt}")
+        WRITERS[fmt](paths[fmt], pages)
+    return paths
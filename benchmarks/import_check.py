@@ -0,0 +1,82 @@
+"""Check that importing the app does no network or database I/O and stays within a time budget.
+
+Imports run in a fresh interpreter with socket and database connects patched
+to fail, so any I/O at import time shows up as an error instead of a slow start.
+The exit status is 1 when a module does I/O or the import exceeds --budget.
+tests/test_imports.py runs the same check as part of the test suite.
+
+    python -m benchmarks.import_check --budget 1.5
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+# Allowed cold import time of the app in seconds
+IMPORT_BUDGET = float(os.getenv("IMPORT_BUDGET", "1.5"))
+
+# Modules resolve from the repository root, wherever the check is run from
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_CHILD = r"""
+import json, socket, sqlite3, sys, time
+
+attempts = []
+
+def forbid(name):
+    def blocked(*args, **kwargs):
+        attempts.append(name)
+        raise OSError(f"{name} called during import")
+    return blocked
+
+socket.socket.connect = forbid("socket.connect")
+socket.create_connection = forbid("socket.create_connection")
+socket.getaddrinfo = forbid("socket.getaddrinfo")
+sqlite3.connect = forbid("sqlite3.connect")
+try:
+    import psycopg2
+    psycopg2.connect = forbid("psycopg2.connect")
+except ImportError:
+    pass
+
+start = time.perf_counter()
+error = None
+try:
+    for module in sys.argv[1:]:
+        __import__(module)
+except Exception as e:
+    error = f"{type(e).__name__}: {e}"
+print(json.dumps({"seconds": time.perf_counter() - start, "io": attempts, "error": error}))
+"""
+
+def check_imports(modules, budget):
+    """Import modules in a clean interpreter; returns (seconds, problems)"""
+    completed = subprocess.run([sys.executable, "-c", _CHILD, *modules], capture_output=True, text=True, cwd=ROOT)
+    try:
+        result = json.loads(completed.stdout.strip().splitlines()[-1])
+    except (IndexError, ValueError):
+        return None, [f"import check failed: {completed.stderr.strip()}"]
+
+    problems = [f"I/O at import time: {name}" for name in result["io"]]
+    if result["error"]:
+        problems.append(f"import failed: {result['error']}")
+    if result["seconds"] > budget:
+        problems.append(f"import took {result['seconds']:.2f}s, budget is {budget:.2f}s")
+    return result["seconds"], problems
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check the app's cold import for I/O and time")
+    parser.add_argument("--budget", type=float, default=IMPORT_BUDGET, help="allowed import time in seconds")
+    parser.add_argument("modules", nargs="*", default=["app"], help="modules to import (default: app)")
+    args = parser.parse_args(argv)
+
+    seconds, problems = check_imports(args.modules, args.budget)
+    if seconds is not None:
+        print(f"import {' '.join(args.modules)}: {seconds:.3f}s (budget {args.budget:.2f}s)")
+    for problem in problems:
+        print(problem)
+    return 1 if problems else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,298 @@
+"""Benchmark the document search pipeline stage by stage.
+
+Generates a synthetic corpus, times each stage separately and writes the
+results as JSON. Pass --compare with an earlier results file to flag stages
+that got slower by more than --tolerance; the exit status is 1 when any did.
+
+    python -m benchmarks.run --pages 500 --output bench.json
+    python -m benchmarks.run --pages 500 --compare bench.json
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+from benchmarks.corpus import DEFAULT_TERMS, generate_corpus
+
+class PeakRSS:
+    """Samples resident set size in a background thread to find a stage's peak"""
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+
+    @staticmethod
+    def current() -> int:
+        try:
+            with open("/proc/self/statm") as statm:
+                return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except (OSError, ValueError):
+            # No /proc (e.g. macOS): fall back to the lifetime peak
+            maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+    def _sample(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, self.current())
+            time.sleep(self.interval)
+
+    def __enter__(self):
+        self.peak = self.current()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self.current())
+
+def measure(results, stage, fn, pages=0, hits=0):
+    """Run fn once, record its timing, throughput and peak RSS under results[stage], and return its value"""
+    with PeakRSS() as rss:
+        start = time.perf_counter()
+        value = fn()
+        seconds = time.perf_counter() - start
+
+    results[stage] = {
+        "seconds": round(seconds, 6),
+        "pages": pages,
+        "hits": hits,
+        "pages_per_s": round(pages / seconds, 2) if pages and seconds else None,
+        "hits_per_s": round(hits / seconds, 2) if hits and seconds else None,
+        "peak_rss_mb": round(rss.peak / (1024 * 1024), 1)
+    }
+    print(f"{stage:<24} {seconds:9.3f}s  peak RSS {results[stage]['peak_rss_mb']:8.1f} MB", flush=True)
+    return value
+
+def extract_docx_object_model(path):
+    """The former WordHandler: python-docx object model, then 3000-character virtual pages"""
+    import docx
+    from utils.document_handler import CHARS_PER_PAGE, DocumentHandler
+
+    clean_text = DocumentHandler(path).clean_text
+    pages, current_page, current_length = {}, [], 0
+    for para in docx.Document(path).paragraphs:
+        para_text = clean_text(para.text)
+        if para_text:
+            current_page.append(para_text)
+            current_length += len(para_text)
+            if current_length >= CHARS_PER_PAGE:
+                pages[len(pages)] = '\n'.join(current_page)
+                current_page, current_length = [], 0
+    if current_page:
+        pages[len(pages)] = '\n'.join(current_page)
+    return pages
+
+def table_bytes(db, table):
+    """Bytes a SQLite table and its indexes take on disk, or None when SQLite lacks the dbstat table"""
+    from sqlalchemy import text
+    try:
+        return db.execute(text(
+            "SELECT SUM(pgsize) FROM dbstat WHERE name IN (SELECT name FROM sqlite_master WHERE tbl_name = :table)"
+        ), {"table": table}).scalar()
+    except Exception:
+        return None
+
+def run_benchmarks(args):
+    workdir = tempfile.mkdtemp(prefix="docsearch-bench-")
+    # Persistence is always measured against a throwaway SQLite database
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+
+    from utils.database import bulk_insert_search_hits, bulk_insert_search_results, get_db_context, upsert_document
+    from utils.hits import get_term_ids, hit_query, hit_rows, render_query
+    from utils.page_store import PageStore
+    from utils.search_memo import SearchMemo
+    from utils.document_handler import create_document_handler
+    from utils.export_handler import create_excel_export, create_export
+    from utils.fuzzy_matcher import FuzzyMatcher
+    from utils.ranking import RANK_TOP_K, PageStats
+    from utils.text_processor import (NormalizedPage, TermMatcher, generate_summary, get_context, normalize_text,
+                                      search_hits_multi, search_terms_multi)
+    import pandas as pd
+
+    terms = args.terms or DEFAULT_TERMS
+    paths = generate_corpus(
+        workdir, args.pages, formats=args.formats, terms=terms,
+        term_density=args.term_density, accent_ratio=args.accent_ratio, seed=args.seed
+    )
+
+    stages = {}
+    text_by_page = None
+    for fmt, path in paths.items():
+        pages = measure(stages, f"extract_{fmt}", lambda: create_document_handler(path).extract_text(), args.pages)
+        # The upload path: the file's bytes are read in place, without a temporary file
+        with open(path, "rb") as file:
+            data = file.read()
+        measure(stages, f"extract_{fmt}_bytes", lambda: create_document_handler(data, path).extract_text(), args.pages)
+        del data
+        if fmt == "docx":
+            # The streaming extractor against the object model it replaced; the corpus has no tables or page breaks, so pages match
+            reference = measure(stages, "extract_docx_object_model", lambda: extract_docx_object_model(path), args.pages)
+            stages["extract_docx_object_model"]["matches_streaming"] = reference == pages
+        if fmt == "txt" or text_by_page is None:
+            text_by_page = pages
+    page_count = len(text_by_page)
+
+    measure(stages, "normalize_text", lambda: [normalize_text(t) for t in text_by_page.values()], page_count)
+
+    results_by_term = measure(stages, "search_terms", lambda: search_terms_multi(text_by_page, terms), page_count)
+    excerpts = [
+        (term, page_num, excerpt)
+        for term, pages in results_by_term.items()
+        for page_num, page_excerpts in pages.items()
+        for excerpt in page_excerpts
+    ]
+    hit_count = len(excerpts)
+    stages["search_terms"]["hits"] = hit_count
+    stages["search_terms"]["hits_per_s"] = round(hit_count / stages["search_terms"]["seconds"], 2)
+
+    def rank_pages():
+        page_stats = PageStats(terms)
+        page_stats.add_pages("bench", text_by_page, results_by_term)
+        return page_stats.top(RANK_TOP_K)
+    measure(stages, "rank_bm25", rank_pages, page_count)
+
+    measure(stages, "search_terms_fuzzy", lambda: search_terms_multi(text_by_page, FuzzyMatcher(terms)), page_count)
+
+    hit_pages = [(term, text_by_page[page_num]) for term, pages in results_by_term.items() for page_num in pages]
+    measure(stages, "get_context", lambda: [get_context(page, term) for term, page in hit_pages], hits=len(hit_pages))
+
+    summaries = measure(stages, "generate_summary", lambda: [generate_summary(e) for _, _, e in excerpts], hits=hit_count)
+
+    # The app's path: tokenize each page once, then snap contexts and cut summaries from the stored boundaries
+    def tokenize_pages():
+        pages = {page_num: NormalizedPage(text) for page_num, text in text_by_page.items()}
+        for page in pages.values():
+            page.boundaries
+        return pages
+    normalized_pages = measure(stages, "sentence_boundaries", tokenize_pages, page_count)
+    measure(stages, "search_with_summaries",
+            lambda: search_terms_multi(normalized_pages, terms, summaries=True), page_count, hit_count)
+
+    rows = [
+        {"document_id": None, "search_term": term, "page_number": page_num + 1, "excerpt": excerpt, "summary": summary}
+        for (term, page_num, excerpt), summary in zip(excerpts, summaries)
+    ]
+
+    def persist():
+        with get_db_context() as db:
+            document_id = upsert_document(db, "benchmark", page_count, "benchmark")
+            for row in rows:
+                row["document_id"] = document_id
+            bulk_insert_search_results(db, rows)
+            db.commit()
+    measure(stages, "persist_results", persist, hits=hit_count)
+
+    # The same hits stored as offsets into the page text, with overlapping windows merged
+    hits_by_term = measure(stages, "search_hits", lambda: search_hits_multi(normalized_pages, terms), page_count, hit_count)
+
+    def persist_hits():
+        with get_db_context() as db:
+            document_id = upsert_document(db, "benchmark", page_count, "benchmark")
+            written = bulk_insert_search_hits(db, hit_rows(hits_by_term, terms, get_term_ids(db, terms), document_id))
+            db.commit()
+        return written
+    hit_rows_written = measure(stages, "persist_hits", persist_hits, hits=hit_count)
+    stages["persist_hits"]["rows"] = hit_rows_written
+
+    with get_db_context() as db:
+        # Hits point into the stored pages, which the page store keeps whether or not hits are saved
+        PageStore(db).put("benchmark", normalized_pages)
+        db.commit()
+        stages["persist_results"]["table_bytes"] = table_bytes(db, "search_results")
+        stages["persist_hits"]["table_bytes"] = table_bytes(db, "search_hits")
+    for stage in ("persist_results", "persist_hits"):
+        print(f"{stage + ' size':<24} {(stages[stage]['table_bytes'] or 0) / 1024:9.0f} KB", flush=True)
+
+    def render():
+        with get_db_context() as db:
+            return render_query(db, hit_query(db))
+    measure(stages, "render_hits", render, hits=hit_rows_written)
+
+    # Searching stored pages again for the same terms reads the memo instead of scanning
+    def memo_search():
+        with get_db_context() as db:
+            hits, _ = SearchMemo(db, TermMatcher(terms)).search("benchmark", normalized_pages)
+            db.commit()
+        return hits
+    measure(stages, "search_memo_miss", memo_search, page_count, hit_count)
+    measure(stages, "search_memo_hit", memo_search, page_count, hit_count)
+
+    df = pd.DataFrame({
+        "Search Term": [row["search_term"] for row in rows],
+        "Page": [row["page_number"] for row in rows],
+        "Excerpt": [row["excerpt"] for row in rows]
+    })
+    measure(stages, "create_excel_export", lambda: create_excel_export(df), hits=hit_count)
+    export_rows = [{"Search Term": row["search_term"], "Page": row["page_number"], "Excerpt": row["excerpt"]} for row in rows]
+    for fmt in ("csv", "jsonl", "parquet"):
+        measure(stages, f"export_{fmt}", lambda: create_export(export_rows, fmt), hits=hit_count)
+
+    return {
+        "meta": {
+            "timestamp": datetime.utcnow().isoformat() + "Z",
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "pages": args.pages,
+            "formats": list(args.formats),
+            "terms": terms,
+            "term_density": args.term_density,
+            "accent_ratio": args.accent_ratio,
+            "seed": args.seed
+        },
+        "stages": stages
+    }
+
+def compare(current, baseline, tolerance):
+    """Print per-stage changes against a baseline; returns names of stages that regressed"""
+    regressions = []
+    print(f"\n{'stage':<24} {'baseline':>10} {'current':>10} {'change':>8}")
+    for stage, result in current["stages"].items():
+        before = baseline.get("stages", {}).get(stage)
+        if not before or not before["seconds"]:
+            continue
+        change = result["seconds"] / before["seconds"] - 1
+        flag = ""
+        if change > tolerance:
+            regressions.append(stage)
+            flag = "  REGRESSION"
+        print(f"{stage:<24} {before['seconds']:9.3f}s {result['seconds']:9.3f}s {change:+7.1%}{flag}")
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the document search pipeline")
+    parser.add_argument("--pages", type=int, default=200, help="pages in the synthetic corpus")
+    parser.add_argument("--formats", nargs="+", default=["pdf", "docx", "txt"], choices=["pdf", "docx", "txt"])
+    parser.add_argument("--terms", nargs="+", help="search terms (default: a built-in list)")
+    parser.add_argument("--term-density", type=float, default=0.002, help="chance each word is a search term")
+    parser.add_argument("--accent-ratio", type=float, default=0.02, help="chance each word is an accented word")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write results JSON here")
+    parser.add_argument("--compare", help="baseline results JSON to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="allowed slowdown before a stage is flagged")
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args)
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+
+    if args.compare:
+        with open(args.compare) as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+        if regressions:
+            print(f"\nRegressed stages: {', '.join(regressions)}")
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
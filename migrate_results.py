@@ -0,0 +1,36 @@
+"""Convert search results saved by older versions, with their excerpt text, into search hits.
+
+The app migrates them itself on its first search history view. Run this
+before starting the upgraded app to check first what it would do with
+--dry-run, or to keep the converted rows with --backup.
+
+    python migrate_results.py --dry-run
+    python migrate_results.py --backup search_results_backup.jsonl
+"""
+import argparse
+import sys
+
+from utils.database import get_db_context, init_db
+from utils.hits import MIGRATION_BATCH_SIZE, migrate_search_results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Convert saved search results into search hits")
+    parser.add_argument("--dry-run", action="store_true", help="report what would be converted without writing anything")
+    parser.add_argument("--backup", help="JSON lines file the converted results are appended to before they are deleted")
+    parser.add_argument("--batch-size", type=int, default=MIGRATION_BATCH_SIZE, help="results converted per transaction")
+    args = parser.parse_args(argv)
+
+    init_db()
+    try:
+        with get_db_context() as db:
+            converted, inline = migrate_search_results(db, max(1, args.batch_size), args.dry_run, args.backup)
+    except Exception as e:
+        print(f"Error migrating saved search results: {str(e)}", file=sys.stderr)
+        return 1
+    verb = "Would convert" if args.dry_run else "Converted"
+    print(f"{verb} {converted} saved search results; {inline} keep their excerpt text, "
+          f"since it wasn't found in the stored pages", file=sys.stderr)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,23 @@
+import os
+import sys
+
+import pytest
+
+# The app runs from the repository root, which has no package setup; import its modules the same way
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+@pytest.fixture
+def sqlite_db(tmp_path, monkeypatch):
+    """Point the app at a fresh SQLite database file for one test"""
+    from utils import database, search_index
+
+    url = f"sqlite:///{tmp_path / 'test.db'}"
+    monkeypatch.setenv("DATABASE_URL", url)
+    monkeypatch.setattr(database, "DATABASE_URL", url)
+    monkeypatch.setattr(database, "_engine", None)
+    monkeypatch.setattr(database, "_schema_ready", False)
+    monkeypatch.setattr(search_index, "_index_ready", False)
+    database.init_db()
+    engine = database.get_engine()
+    yield engine
+    engine.dispose()
@@ -0,0 +1,32 @@
+from utils import hits
+from utils.database import SearchResult, bulk_insert_search_results, get_db_context, upsert_document
+from utils.page_store import PageStore
+from utils.text_processor import NormalizedPage, search_terms_multi
+
+FILLER = "Lorem ipsum dolor sit amet. Sed do eiusmod tempor. " * 60
+
+def test_history_shows_results_saved_before_hits(sqlite_db, monkeypatch):
+    monkeypatch.setattr(hits, "_legacy_migrated", False, raising=False)
+    pages = {0: NormalizedPage(FILLER + "The payment is due. " + FILLER)}
+    with get_db_context() as db:
+        document_id = upsert_document(db, "a.txt", 1, "h1")
+        PageStore(db).put("h1", pages)
+        legacy = [
+            {"document_id": document_id, "search_term": term, "page_number": page_num + 1, "excerpt": excerpt,
+             "summary": summary}
+            for term, results in search_terms_multi(pages, ["payment"], summaries=True).items()
+            for page_num, contexts in results.items()
+            for excerpt, summary in contexts
+        ]
+        legacy.append({"document_id": None, "search_term": "lost", "page_number": 1, "excerpt": "text never stored",
+                       "summary": "An AI summary"})
+        bulk_insert_search_results(db, legacy)
+        db.commit()
+
+    with get_db_context() as db:
+        history, cursor = hits.get_search_history(db)
+        assert db.query(SearchResult).count() == 0
+
+    assert cursor is None
+    assert sorted((row["term"], row["page_number"], row["excerpt"], row["summary"]) for row in history) == \
+        sorted((row["search_term"], row["page_number"], row["excerpt"], row["summary"]) for row in legacy)
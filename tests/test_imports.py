@@ -0,0 +1,6 @@
+from benchmarks.import_check import IMPORT_BUDGET, check_imports
+
+def test_app_import_does_no_io_within_budget():
+    seconds, problems = check_imports(["app"], IMPORT_BUDGET)
+    assert problems == []
+    assert seconds <= IMPORT_BUDGET
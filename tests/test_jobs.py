@@ -0,0 +1,62 @@
+from types import SimpleNamespace
+
+import pytest
+
+from utils import document_handler, jobs
+from utils.database import SearchHit, get_db_context
+from utils.summarizer import BatchSummarizer
+from utils.summary_cache import SummaryCache
+
+FILLER = "Lorem ipsum dolor sit amet. " * 40
+
+class FailingClient:
+    """Async OpenAI stand-in that fails for excerpts containing `fail_on` and summarizes the rest"""
+
+    def __init__(self, fail_on):
+        self.fail_on = fail_on
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    async def create(self, model, messages, max_tokens, temperature):
+        if self.fail_on in messages[1]["content"]:
+            raise ValueError("service unavailable")
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content="AI summary"))], usage=None)
+
+@pytest.fixture
+def job_id(sqlite_db, monkeypatch):
+    """A finished job over two documents, one hit each, without AI summaries"""
+    # Extract in-process
+    monkeypatch.setattr(jobs, "EXTRACT_WORKERS", 1)
+    monkeypatch.setattr(document_handler, "EXTRACT_WORKERS", 1)
+    uploads = [("ok.txt", (FILLER + "The payment is due. " + FILLER).encode()),
+               ("bad.txt", (FILLER + "Late payment fails here. " + FILLER).encode())]
+    with get_db_context() as db:
+        job_id = jobs.submit_job(db, uploads, {"terms": ["payment"]})
+    assert jobs.work("test", once=True) == 1
+    return job_id
+
+def _hit_summaries():
+    with get_db_context() as db:
+        return sorted((summary for summary, in db.query(SearchHit.summary)), key=str)
+
+def test_failed_summaries_are_not_saved(job_id):
+    summarizer = BatchSummarizer(client=FailingClient("fails here"), cache=SummaryCache(use_db=False), max_retries=0)
+    with get_db_context() as db:
+        jobs._summarize_hits(db, job_id, summarizer)
+    assert _hit_summaries() == ["AI summary", None]
+
+    # The failed hit shows its first-sentence summary, not the error
+    with get_db_context() as db:
+        results = {row["Document"]: row["Summary"] for row in jobs.get_job_results(db, job_id)}
+    assert results["ok.txt"] == "AI summary"
+    assert not results["bad.txt"].startswith("Error generating summary")
+
+    # and is summarized by a later run once the service works
+    with get_db_context() as db:
+        jobs._summarize_hits(db, job_id, BatchSummarizer(client=FailingClient("never"), cache=SummaryCache(use_db=False)))
+    assert _hit_summaries() == ["AI summary", "AI summary"]
+
+def test_missing_api_key_is_not_saved(job_id, monkeypatch):
+    monkeypatch.delenv("OPENAI_API_KEY", raising=False)
+    with get_db_context() as db:
+        jobs._summarize_hits(db, job_id, BatchSummarizer(cache=SummaryCache(use_db=False)))
+    assert _hit_summaries() == [None, None]
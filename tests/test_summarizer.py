@@ -0,0 +1,174 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+import pytest
+
+from utils import metrics
+from utils.summarizer import (PARTIAL_SUMMARY_PROMPT, RESULTS_SUMMARY_PROMPT, BatchSummarizer, TextSummarizer,
+                              count_tokens)
+from utils.summary_cache import SummaryCache
+
+class StubClient:
+    """Stands in for the OpenAI client: records each request and answers with reply(system prompt, user content)"""
+
+    def __init__(self, reply=None):
+        self.requests = []
+        self.reply = reply or (lambda system, user: "summary")
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def create(self, model, messages, max_tokens, temperature):
+        system, user = messages[0]["content"], messages[1]["content"]
+        self.requests.append((system, user))
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=self.reply(system, user)))],
+                               usage=None)
+
+class AsyncStubClient(StubClient):
+    async def create(self, model, messages, max_tokens, temperature):
+        return StubClient.create(self, model, messages, max_tokens, temperature)
+
+@pytest.fixture
+def make_summarizer(monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEY", "test")
+
+    def make(partial_reply=None):
+        client = StubClient()
+        batch_client = AsyncStubClient(partial_reply)
+        summarizer = TextSummarizer(
+            client=client, cache=SummaryCache(use_db=False),
+            batch_summarizer=BatchSummarizer(client=batch_client, cache=SummaryCache(use_db=False))
+        )
+        return summarizer, client, batch_client
+    return make
+
+def _results(count, excerpt=None):
+    return [
+        {"Document": f"doc{i % 5}.pdf", "Search Term": "payment",
+         "Excerpt": excerpt or f"Clause {i} says invoice {i} must be paid within {i} days of delivery under section {i}."}
+        for i in range(count)
+    ]
+
+def _prompt_tokens(request):
+    system, user = request
+    return count_tokens(system) + count_tokens(user)
+
+def test_small_result_set_is_one_request(make_summarizer):
+    summarizer, client, batch_client = make_summarizer()
+    assert summarizer.summarize_search_results(_results(3)) == "summary"
+    assert len(client.requests) == 1
+    assert client.requests[0][0] == RESULTS_SUMMARY_PROMPT
+    assert batch_client.requests == []
+
+def test_large_result_set_is_summarized_in_parts(make_summarizer):
+    summarizer, client, batch_client = make_summarizer()
+    results = _results(200)
+    summarizer.summarize_search_results(results, chunk_tokens=800)
+
+    assert len(batch_client.requests) > 1
+    assert all(system == PARTIAL_SUMMARY_PROMPT for system, _ in batch_client.requests)
+    assert len(client.requests) == 1
+    # Every result is sent in exactly one part
+    sent = "".join(user for _, user in batch_client.requests)
+    for result in results:
+        assert sent.count(result["Excerpt"]) == 1
+
+def test_every_request_fits_the_budget(make_summarizer):
+    summarizer, client, batch_client = make_summarizer(lambda system, user: "finding " * 60)
+    summarizer.summarize_search_results(_results(300), chunk_tokens=600)
+
+    assert len(batch_client.requests) > 1
+    for request in batch_client.requests + client.requests:
+        assert _prompt_tokens(request) <= 600
+
+def test_partials_that_stop_shrinking_are_cut_to_the_budget(make_summarizer):
+    # Each partial summary is so long that no two fit one request
+    summarizer, client, batch_client = make_summarizer(lambda system, user: "finding " * 250)
+    summarizer.summarize_search_results(_results(100), chunk_tokens=600)
+
+    assert len(client.requests) == 1
+    assert _prompt_tokens(client.requests[0]) <= 600
+    for request in batch_client.requests:
+        assert _prompt_tokens(request) <= 600
+
+def test_oversized_excerpt_is_truncated(make_summarizer):
+    summarizer, client, _ = make_summarizer()
+    summarizer.summarize_search_results(_results(1, excerpt="payment " * 2000), chunk_tokens=500)
+
+    assert len(client.requests) == 1
+    assert _prompt_tokens(client.requests[0]) <= 500
+
+def test_near_identical_excerpts_are_sent_once(make_summarizer):
+    summarizer, client, _ = make_summarizer()
+    excerpt = "The buyer shall pay every invoice within thirty days of delivery of the goods."
+    results = _results(10, excerpt=excerpt) + [dict(_results(1)[0], Excerpt=excerpt.rstrip(".") + "!")]
+    results += _results(2)
+    summarizer.summarize_search_results(results)
+
+    _, user = client.requests[0]
+    assert user.count("Context:") == 3
+    assert "Similar excerpts: 11, in 5 document(s)" in user
+
+class _RateLimitedHandler(BaseHTTPRequestHandler):
+    """Chat completions endpoint that answers the first request with a 429 and a retry-after, then succeeds"""
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        server = self.server
+        with server.lock:
+            server.request_times.append(time.monotonic())
+            first = len(server.request_times) == 1
+        if first:
+            body = {"error": {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}}
+            self._send(429, body, {"retry-after-ms": str(int(server.retry_after * 1000))})
+            return
+        self._send(200, {
+            "id": "chatcmpl-stub", "object": "chat.completion", "created": 0, "model": "gpt-4o",
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": "stub summary"},
+                         "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": 10, "completion_tokens": 2, "total_tokens": 12}
+        })
+
+    def _send(self, status, body, headers=None):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+@pytest.fixture
+def rate_limited_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _RateLimitedHandler)
+    server.lock = threading.Lock()
+    server.request_times = []
+    server.retry_after = 0.5
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def test_rate_limited_request_waits_for_retry_after(rate_limited_server):
+    openai = pytest.importorskip("openai")
+    client = openai.AsyncOpenAI(api_key="test", base_url=f"http://127.0.0.1:{rate_limited_server.server_port}/v1",
+                                max_retries=0)
+    batch = BatchSummarizer(client=client, cache=SummaryCache(use_db=False), max_concurrency=1, max_retries=2)
+
+    assert list(batch.summarize_many(["The buyer pays within thirty days."])) == [(0, "stub summary")]
+    assert batch.errors == {}
+    first, second = rate_limited_server.request_times
+    # Backoff alone would wait at least a second; the server asked for half that
+    assert 0.5 <= second - first < 0.9
+
+def test_batch_spans_reach_the_callers_run():
+    batch = BatchSummarizer(client=AsyncStubClient(), cache=SummaryCache(use_db=False))
+    with metrics.record_run() as run:
+        assert sorted(batch.summarize_many(["first text", "second text"])) == [(0, "summary"), (1, "summary")]
+    assert run.totals["(all documents)"]["llm_request"][0] == 2
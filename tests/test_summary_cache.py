@@ -0,0 +1,83 @@
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import event
+
+from utils import summary_cache
+from utils.database import SummaryCacheEntry, get_db_context
+from utils.summary_cache import SummaryCache
+
+@pytest.fixture
+def writes(sqlite_db):
+    """Statements that change the database, recorded as they run"""
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith(("INSERT", "UPDATE", "DELETE")):
+            statements.append(statement.split()[0].upper())
+
+    event.listen(sqlite_db, "before_cursor_execute", record)
+    yield statements
+    event.remove(sqlite_db, "before_cursor_execute", record)
+
+def _set_column(column, when_by_key):
+    with get_db_context() as db:
+        for key, when in when_by_key.items():
+            db.query(SummaryCacheEntry).filter(SummaryCacheEntry.cache_key == key).update({column: when})
+        db.commit()
+
+def _stored_keys():
+    with get_db_context() as db:
+        return sorted(key for key, in db.query(SummaryCacheEntry.cache_key))
+
+def test_memory_tier_expires_after_ttl():
+    cache = SummaryCache(ttl_seconds=3600, use_db=False)
+    cache.put("key", "summary")
+    assert cache.get("key") == "summary"
+
+    expired = SummaryCache(ttl_seconds=0, use_db=False)
+    expired.put("key", "summary")
+    assert expired.get("key") is None
+    assert expired.stats()["misses"] == 1
+
+def test_database_tier_expires_after_ttl(sqlite_db):
+    SummaryCache().put("old", "old summary")
+    SummaryCache().put("new", "new summary")
+    _set_column(SummaryCacheEntry.created_at, {"old": datetime.utcnow() - timedelta(days=30)})
+
+    cache = SummaryCache(ttl_seconds=7 * 24 * 3600)
+    assert cache.get("old") is None
+    assert cache.get("new") == "new summary"
+    assert _stored_keys() == ["new"]
+
+def test_lookups_within_touch_interval_do_not_write(writes):
+    cache = SummaryCache(touch_seconds=3600)
+    for i in range(3):
+        cache.put(f"key{i}", f"summary{i}")
+
+    del writes[:]
+    # A new cache has an empty memory tier, so every lookup reads the database
+    fresh = SummaryCache(touch_seconds=3600)
+    assert [fresh.get(f"key{i}") for i in range(3)] == ["summary0", "summary1", "summary2"]
+    assert fresh.stats()["db_hits"] == 3
+    assert writes == []
+
+def test_eviction_keeps_the_most_recently_used_rows(writes, monkeypatch):
+    monkeypatch.setattr(summary_cache, "EVICT_EVERY", 5)
+    # No memory tier, so lookups reach the database and refresh last use
+    cache = SummaryCache(max_entries=0, max_rows=3, touch_seconds=3600)
+    for i in range(4):
+        cache.put(f"key{i}", f"summary{i}")
+    hours_ago = datetime.utcnow() - timedelta(hours=2)
+    _set_column(SummaryCacheEntry.last_used_at, {f"key{i}": hours_ago + timedelta(seconds=i) for i in range(4)})
+    assert _stored_keys() == ["key0", "key1", "key2", "key3"]
+
+    # A stale last use is queued, not written, until the next store
+    del writes[:]
+    assert cache.get("key0") == "summary0"
+    assert writes == []
+
+    # The fifth store writes the queued last use and evicts down to max_rows
+    cache.put("key4", "summary4")
+    assert "UPDATE" in writes and "DELETE" in writes
+    assert _stored_keys() == ["key0", "key3", "key4"]
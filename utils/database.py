@@ -1,44 +1,142 @@
-from sqlalchemy import create_engine, Column, Integer, String, Text, DateTime, ForeignKey, Float, text
+from sqlalchemy import create_engine, event, Column, Integer, String, Text, DateTime, ForeignKey, Float, Boolean, Index, LargeBinary, UniqueConstraint, insert, inspect, text
+from sqlalchemy.exc import InterfaceError, OperationalError, TimeoutError as PoolTimeoutError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
-from sqlalchemy.pool import QueuePool
+from sqlalchemy.pool import QueuePool, StaticPool
+from sqlalchemy.dialects import postgresql, sqlite
+import csv
+import io
 import os
+import threading
 from datetime import datetime
 import time
 from contextlib import contextmanager
+from utils import metrics
 
-# Get database URL from environment
-DATABASE_URL = os.getenv('DATABASE_URL')
+# Rows per statement when bulk inserting search results
+RESULT_BATCH_SIZE = int(os.getenv("RESULT_BATCH_SIZE", "5000"))
+
+# On Postgres, batches of at least this many rows are written with COPY instead of INSERT
+COPY_MIN_ROWS = int(os.getenv("COPY_MIN_ROWS", "1000"))
+
+# Get database URL from environment; without one, a SQLite file in the working directory is used
+DATABASE_URL = os.getenv('DATABASE_URL') or "sqlite:///document_search.db"
 #DATABASE_URL = "postgresql://postgres:password@db:5432/mydatabase"
 
-if DATABASE_URL and DATABASE_URL.startswith("postgres://"):
+if DATABASE_URL.startswith("postgres://"):
     DATABASE_URL = DATABASE_URL.replace("postgres://", "postgresql://", 1)
 
-# Create database engine with connection pooling and retry settings
-engine = create_engine(
-    DATABASE_URL,
-    poolclass=QueuePool,
-    pool_size=5,
-    max_overflow=10,
-    pool_timeout=30,
-    pool_recycle=1800,  # Recycle connections after 30 minutes
-    pool_pre_ping=True  # Enable connection health checks
-)
+# Connections kept open per process, and extra ones allowed under load
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+
+# Seconds to wait for a free connection before giving up
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+
+# Connections older than this many seconds are replaced
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+
+# Check each connection as it is taken from the pool, so dropped connections are replaced transparently
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "1") != "0"
+
+# Attempts to open a session while the database is unreachable, and the first delay between them (doubled each time)
+DB_CONNECT_RETRIES = int(os.getenv("DB_CONNECT_RETRIES", "3"))
+DB_CONNECT_RETRY_DELAY = float(os.getenv("DB_CONNECT_RETRY_DELAY", "1"))
+
+# Milliseconds a SQLite connection waits for another writer to finish
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "10000"))
+
+# Sessions are bound to the engine when it is first created, so importing this module does no I/O
+SessionLocal = sessionmaker(autocommit=False, autoflush=False)
+
+_engine = None
+_schema_ready = False
+_init_lock = threading.Lock()
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    try:
+        # WAL lets readers run alongside the one writer; NORMAL sync is durable in WAL mode except on power loss
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        # Negative sizes are in KiB
+        cursor.execute("PRAGMA cache_size=-20000")
+    finally:
+        cursor.close()
+
+def _count_connect(dbapi_connection, connection_record):
+    metrics.increment("db_connections_opened")
+
+def get_engine():
+    """Create the database engine on first use, with pool settings from the environment"""
+    global _engine
+    with _init_lock:
+        if _engine is None:
+            if DATABASE_URL.startswith("sqlite"):
+                in_memory = DATABASE_URL in ("sqlite://", "sqlite:///:memory:")
+                options = {
+                    # Sessions are used from worker threads as well as the one that opened the pool
+                    "connect_args": {"check_same_thread": False},
+                    # An in-memory database exists only on its single connection
+                    "poolclass": StaticPool if in_memory else QueuePool
+                }
+            else:
+                options = {"poolclass": QueuePool}
+            if options["poolclass"] is QueuePool:
+                options.update(
+                    pool_size=DB_POOL_SIZE,
+                    max_overflow=DB_MAX_OVERFLOW,
+                    pool_timeout=DB_POOL_TIMEOUT,
+                    pool_recycle=DB_POOL_RECYCLE
+                )
+            _engine = create_engine(DATABASE_URL, pool_pre_ping=DB_POOL_PRE_PING, **options)
+            if _engine.dialect.name == "sqlite":
+                event.listen(_engine, "connect", _set_sqlite_pragmas)
+            event.listen(_engine, "connect", _count_connect)
+            SessionLocal.configure(bind=_engine)
+        return _engine
+
+def get_pool_stats():
+    """Return the connection pool's size and how many connections are in use, idle and in overflow"""
+    if _engine is None:
+        return {}
+    pool = _engine.pool
+    if not isinstance(pool, QueuePool):
+        return {}
+    return {
+        "size": pool.size(),
+        "checked_out": pool.checkedout(),
+        "idle": pool.checkedin(),
+        "overflow": max(pool.overflow(), 0),
+        "max_overflow": DB_MAX_OVERFLOW
+    }
 
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+metrics.register_gauge("db_pool_connections", lambda: [({"state": state}, value) for state, value in get_pool_stats().items()])
 
 Base = declarative_base()
 
 class Document(Base):
     __tablename__ = "documents"
+    # Unique so documents can be upserted by content
+    __table_args__ = (
+        Index("uq_documents_content_hash", "content_hash", unique=True),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     filename = Column(String, index=True)
     upload_date = Column(DateTime, default=datetime.utcnow)
     page_count = Column(Integer)
+    content_hash = Column(String(64))
     search_results = relationship("SearchResult", back_populates="document")
 
 class SearchResult(Base):
+    """Legacy: a result saved with its excerpt text, before hits were stored as offsets.
+
+    Rows are converted into SearchHits by `utils.hits.migrate_search_results`
+    and nothing else reads them.
+    """
     __tablename__ = "search_results"
 
     id = Column(Integer, primary_key=True, index=True)
@@ -47,36 +145,352 @@ class SearchResult(Base):
     page_number = Column(Integer)
     excerpt = Column(Text)
     summary = Column(Text)
+    # Null for results saved before this column existed
+    created_at = Column(DateTime, default=datetime.utcnow)
+    # The background job that produced the result, if any
+    job_id = Column(Integer, ForeignKey("jobs.id"), index=True)
+    # BM25 relevance of the page for the term (see utils.ranking); null when not ranked
+    score = Column(Float)
     document = relationship("Document", back_populates="search_results")
 
-# Create all tables
-Base.metadata.create_all(bind=engine)
+class SearchTerm(Base):
+    """A search term, stored once and referenced by id from each hit"""
+    __tablename__ = "search_terms"
 
-def get_db():
-    """Get database session with retry logic"""
-    max_retries = 3
-    retry_delay = 1  # seconds
+    id = Column(Integer, primary_key=True)
+    term = Column(String, nullable=False, unique=True)
+
+class SearchHit(Base):
+    """A match window stored as character offsets into the stored page text (see utils.hits).
+
+    Excerpts and first-sentence summaries are cut from the page when read, so
+    a hit costs a few integers instead of a copy of the text around it. A hit
+    is stored once per document, term, matcher mode and window, and linked to
+    every job that finds it through job_hits.
+    """
+    __tablename__ = "search_hits"
+    # History pages are read newest first by id, optionally filtered (see utils.hits.get_search_history)
+    __table_args__ = (
+        Index("ix_search_hits_term_document", "term_id", "document_id", "id"),
+        Index("ix_search_hits_document_id", "document_id", "id"),
+        Index("ix_search_hits_created_at", "created_at"),
+    )
+
+    id = Column(Integer, primary_key=True)
+    document_id = Column(Integer, ForeignKey("documents.id"))
+    term_id = Column(Integer, ForeignKey("search_terms.id"), nullable=False)
+    page_number = Column(Integer, nullable=False)
+    # Version of the stored page text the offsets point into
+    extractor_version = Column(String(32), nullable=False)
+    # [start_offset, end_offset) in the page's raw text; overlapping windows of a term on a page are merged
+    start_offset = Column(Integer, nullable=False)
+    end_offset = Column(Integer, nullable=False)
+    # Occurrences of the term inside the window
+    matches = Column(Integer, nullable=False, default=1)
+    # Only set for AI summaries; the first-sentence summary is rendered on read
+    summary = Column(Text)
+    # Only set for migrated results whose excerpt couldn't be found in the stored page text
+    excerpt = Column(Text)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    # Matcher settings the hit was found with (see TermMatcher.mode); null for migrated results
+    mode = Column(String(64))
+    # The job that found the hit first
+    job_id = Column(Integer, ForeignKey("jobs.id"), index=True)
+    # Only set for migrated results; scores of a job's hits are kept in job_hits
+    score = Column(Float)
+
+class JobHit(Base):
+    """A search hit in a job's results, with its score in that job"""
+    __tablename__ = "job_hits"
+    # Results of a running job are polled by id, so new ones are found even when they link older hits
+    __table_args__ = (
+        UniqueConstraint("job_id", "hit_id", name="uq_job_hits_hit"),
+        Index("ix_job_hits_job_id", "job_id", "id"),
+    )
+
+    id = Column(Integer, primary_key=True)
+    job_id = Column(Integer, ForeignKey("jobs.id"), nullable=False)
+    hit_id = Column(Integer, ForeignKey("search_hits.id"), nullable=False)
+    # BM25 relevance of the page for the term among the job's pages (see utils.ranking); null when not ranked
+    score = Column(Float)
+
+class SearchMemoEntry(Base):
+    """Hits of one normalized term in one file's stored pages, so repeated searches skip the scan (see utils.search_memo)"""
+    __tablename__ = "search_memos"
+    __table_args__ = (
+        UniqueConstraint("content_hash", "pattern", "mode", "version", name="uq_search_memos_search"),
+    )
+
+    id = Column(Integer, primary_key=True)
+    content_hash = Column(String(64), nullable=False)
+    # The term after normalize_text
+    pattern = Column(Text, nullable=False)
+    # Matcher settings, e.g. exact or fuzzy with its thresholds
+    mode = Column(String(64), nullable=False)
+    # Extractor and search versions; memos of other versions are ignored
+    version = Column(String(32), nullable=False)
+    # Packed (page number, start, end, matches) windows; empty when the term doesn't occur
+    hits = Column(LargeBinary, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+
+class DocumentPage(Base):
+    """Extracted page text, keyed by the SHA-256 of the source file and the extractor version"""
+    __tablename__ = "document_pages"
+    __table_args__ = (
+        UniqueConstraint("content_hash", "extractor_version", "page_number", name="uq_document_pages_page"),
+    )
+
+    id = Column(Integer, primary_key=True)
+    content_hash = Column(String(64), nullable=False)
+    extractor_version = Column(String(32), nullable=False)
+    page_number = Column(Integer, nullable=False)
+    text = Column(Text)
+    # Packed sentence start offsets (see utils.text_processor.pack_boundaries), so stored pages aren't tokenized again
+    sentence_offsets = Column(LargeBinary)
+    # Tokenizer that computed them; other tokenizers' boundaries are ignored (see utils.text_processor.tokenizer_name)
+    sentence_tokenizer = Column(String(16))
+    # Set once the page has been added to the full-text index (see utils.search_index)
+    indexed = Column(Boolean, default=False)
+
+class SummaryCacheEntry(Base):
+    """Cached LLM summary, keyed by a hash of the full request (see utils.summary_cache)"""
+    __tablename__ = "summary_cache"
 
-    for attempt in range(max_retries):
+    cache_key = Column(String(64), primary_key=True)
+    summary = Column(Text, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    last_used_at = Column(DateTime, default=datetime.utcnow, nullable=False, index=True)
+
+class Job(Base):
+    """An analysis queued by the app and run by a worker process (see utils.jobs)"""
+    __tablename__ = "jobs"
+    # Workers claim the oldest queued job
+    __table_args__ = (
+        Index("ix_jobs_status_id", "status", "id"),
+    )
+
+    id = Column(Integer, primary_key=True)
+    status = Column(String(16), nullable=False, default="queued")
+    # JSON: search terms and analysis settings
+    options = Column(Text, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    started_at = Column(DateTime)
+    finished_at = Column(DateTime)
+    # Updated while a worker runs the job; a stale heartbeat means the worker died
+    heartbeat_at = Column(DateTime)
+    worker = Column(String)
+    attempts = Column(Integer, default=0, nullable=False)
+    files_done = Column(Integer, default=0, nullable=False)
+    files_total = Column(Integer, default=0, nullable=False)
+    message = Column(Text)
+    error = Column(Text)
+    summary = Column(Text)
+    # JSON: stage timings and cache counters from the worker
+    stats = Column(Text)
+
+class JobFile(Base):
+    """An uploaded file waiting to be analyzed by a job; stored so any worker can read it"""
+    __tablename__ = "job_files"
+
+    id = Column(Integer, primary_key=True)
+    job_id = Column(Integer, ForeignKey("jobs.id"), nullable=False, index=True)
+    position = Column(Integer, nullable=False)
+    filename = Column(String, nullable=False)
+    content = Column(LargeBinary, nullable=False)
+
+class JobEvent(Base):
+    """A progress or error record of a job, shown while it runs"""
+    __tablename__ = "job_events"
+
+    id = Column(Integer, primary_key=True)
+    job_id = Column(Integer, ForeignKey("jobs.id"), nullable=False, index=True)
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    level = Column(String(16), nullable=False, default="info")
+    message = Column(Text, nullable=False)
+
+def _migrate_schema(engine):
+    """Add columns and indexes introduced after a table was first created"""
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    column_type = column.type.compile(dialect=engine.dialect)
+                    conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"))
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
+
+def init_db():
+    """Create and migrate the schema; runs once per process and is safe to call repeatedly"""
+    global _schema_ready
+    if _schema_ready:
+        return
+    engine = get_engine()
+    with _init_lock:
+        if not _schema_ready:
+            inspector = inspect(engine)
+            link_hits = inspector.has_table("search_hits") and not inspector.has_table("job_hits")
+            # Create all tables
+            Base.metadata.create_all(bind=engine)
+            _migrate_schema(engine)
+            if link_hits:
+                # Hits saved before jobs shared them belong to the job that saved them
+                with engine.begin() as conn:
+                    conn.execute(text(
+                        "INSERT INTO job_hits (job_id, hit_id, score) "
+                        "SELECT job_id, id, score FROM search_hits WHERE job_id IS NOT NULL ORDER BY id"
+                    ))
+            _schema_ready = True
+
+def _open_session():
+    """Open a session holding a pooled connection, retrying while the database is unreachable"""
+    retry_delay = DB_CONNECT_RETRY_DELAY
+    for attempt in range(DB_CONNECT_RETRIES):
         try:
+            init_db()
             db = SessionLocal()
-            # Test the connection with properly formatted SQL
-            db.execute(text("SELECT 1"))
-            yield db
-        except Exception as e:
-            if attempt == max_retries - 1:  # Last attempt
-                raise Exception(f"Database connection failed after {max_retries} attempts: {str(e)}")
+            try:
+                # Checking out the connection now surfaces connection errors here, where they can be retried;
+                # pool_pre_ping already validates it, so no test query is needed
+                with metrics.span("db_checkout", log=False):
+                    db.connection()
+            except Exception:
+                db.close()
+                raise
+            return db
+        except PoolTimeoutError:
+            # Every connection is busy; retrying would only add to the queue
+            metrics.increment("db_pool_timeouts")
+            raise
+        except (OperationalError, InterfaceError) as e:
+            metrics.increment("db_connect_errors")
+            if attempt == DB_CONNECT_RETRIES - 1:  # Last attempt
+                raise Exception(f"Database connection failed after {DB_CONNECT_RETRIES} attempts: {str(e)}")
             time.sleep(retry_delay)
             retry_delay *= 2  # Exponential backoff
-            continue
-        finally:
-            db.close()
 
 @contextmanager
 def get_db_context():
     """Context manager for database sessions with automatic cleanup"""
-    db = next(get_db())
+    db = _open_session()
     try:
         yield db
     finally:
-        db.close()
\ No newline at end of file
+        db.close()
+
+def get_db():
+    """Yield one database session and close it afterwards, for frameworks that take generator dependencies"""
+    with get_db_context() as db:
+        yield db
+
+def upsert_document(db, filename, page_count, content_hash):
+    """Insert a document or update the one with the same content, in one statement; returns its id"""
+    dialect = db.get_bind().dialect.name
+    if dialect == "postgresql":
+        stmt = postgresql.insert(Document)
+    elif dialect == "sqlite":
+        stmt = sqlite.insert(Document)
+    else:
+        doc = db.query(Document).filter(Document.content_hash == content_hash).first()
+        if not doc:
+            doc = Document(filename=filename, page_count=page_count, content_hash=content_hash)
+            db.add(doc)
+            db.flush()
+        return doc.id
+
+    stmt = stmt.values(
+        filename=filename,
+        page_count=page_count,
+        content_hash=content_hash,
+        upload_date=datetime.utcnow()
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[Document.content_hash],
+        set_={"page_count": stmt.excluded.page_count}
+    ).returning(Document.id)
+    with metrics.span("upsert_document"):
+        return db.execute(stmt).scalar_one()
+
+def copy_rows(db, table, columns, rows, force_not_null=()):
+    """Write row dicts into table with Postgres COPY; missing keys and None are written as NULL"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow([row.get(column) for column in columns])
+    buffer.seek(0)
+
+    options = "FORMAT csv"
+    if force_not_null:
+        # Without it an empty string would be read back as NULL
+        options += f", FORCE_NOT_NULL ({', '.join(force_not_null)})"
+    cursor = db.connection().connection.cursor()
+    try:
+        cursor.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH ({options})", buffer)
+    finally:
+        cursor.close()
+
+def _bulk_insert(db, model, columns, rows, batch_size, commit_per_batch, counter, force_not_null=()):
+    """Insert row dicts into model's table in batches, with COPY on Postgres for large batches"""
+    use_copy = db.get_bind().dialect.name == "postgresql"
+    written = 0
+    batch = []
+
+    def flush():
+        with metrics.span("persist_results"):
+            if use_copy and len(batch) >= COPY_MIN_ROWS:
+                # COPY skips column defaults, so the timestamp is written explicitly
+                created_at = datetime.utcnow().isoformat()
+                for row in batch:
+                    row.setdefault("created_at", created_at)
+                copy_rows(db, model.__tablename__, columns, batch, force_not_null)
+            else:
+                db.execute(insert(model), batch)
+            if commit_per_batch:
+                db.commit()
+        metrics.increment(counter, len(batch))
+
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            flush()
+            written += len(batch)
+            batch = []
+
+    if batch:
+        flush()
+        written += len(batch)
+
+    return written
+
+def bulk_insert_search_results(db, rows, batch_size=RESULT_BATCH_SIZE, commit_per_batch=False):
+    """Legacy: insert search result dicts in batches, like `bulk_insert_search_hits`.
+
+    Only benchmarks write SearchResults now, to compare them with hits. Each
+    row has document_id, search_term, page_number, excerpt and summary, and
+    optionally job_id and score. Returns the number of rows written.
+    """
+    columns = ["document_id", "search_term", "page_number", "excerpt", "summary", "created_at", "job_id", "score"]
+    return _bulk_insert(db, SearchResult, columns, rows, batch_size, commit_per_batch, "result_rows_written",
+                        force_not_null=("search_term", "excerpt", "summary"))
+
+def bulk_insert_search_hits(db, rows, batch_size=RESULT_BATCH_SIZE, commit_per_batch=False):
+    """Insert search hit dicts in batches instead of one ORM object per row.
+
+    Each row has document_id, term_id, page_number, extractor_version,
+    start_offset, end_offset and matches, and optionally mode, job_id,
+    score, summary and excerpt.
+    Batches use executemany INSERTs, or COPY on Postgres once a batch reaches
+    COPY_MIN_ROWS. With commit_per_batch, each batch is committed on its own so
+    large runs don't hold one long transaction. Returns the number of rows written.
+    """
+    columns = ["document_id", "term_id", "page_number", "extractor_version", "start_offset", "end_offset",
+               "matches", "summary", "excerpt", "created_at", "mode", "job_id", "score"]
+    return _bulk_insert(db, SearchHit, columns, rows, batch_size, commit_per_batch, "hit_rows_written")
+
+def bulk_insert_job_hits(db, rows, batch_size=RESULT_BATCH_SIZE, commit_per_batch=False):
+    """Link hits to a job in batches, like `bulk_insert_search_hits`; each row has job_id, hit_id and score"""
+    return _bulk_insert(db, JobHit, ["job_id", "hit_id", "score"], rows, batch_size, commit_per_batch,
+                        "job_hit_rows_written")
@@ -1,126 +1,510 @@
-import docx
-import PyPDF2
-from typing import Dict, Optional
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from typing import BinaryIO, Dict, Iterator, List, Optional, Sequence, Tuple, Union
+import codecs
+import io
+import mmap
 import os
 import re
+import shutil
+import subprocess
+import tempfile
+import time
+import zipfile
+from xml.etree import ElementTree
+from utils import metrics
+
+# Bump whenever extraction output changes so stored page text is re-extracted
+EXTRACTOR_VERSION = "2"
+
+# Worker processes used by extract_documents; 0 or 1 extracts serially in-process, which is easier to debug
+EXTRACT_WORKERS = int(os.getenv("EXTRACT_WORKERS", os.cpu_count() or 1))
+
+# PDFs with more pages than this are split into page ranges extracted by separate workers
+PDF_PAGES_PER_TASK = int(os.getenv("PDF_PAGES_PER_TASK", "200"))
+
+# Characters per virtual page for formats without real pages
+CHARS_PER_PAGE = 3000
+
+# Bytes decoded per chunk when streaming a text file
+TEXT_CHUNK_SIZE = 1 << 20
+
+# Text files at least this large are extracted page by page in-process (see iter_document_pages) instead of whole by a worker
+STREAM_MIN_BYTES = int(os.getenv("STREAM_MIN_BYTES", str(64 << 20)))
+
+# What a handler reads: a file path, the file's bytes, or a binary file object
+DocumentSource = Union[str, bytes, bytearray, memoryview, BinaryIO]
+
+_W = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+_W_P = _W + 'p'
+_W_R = _W + 'r'
+_W_T = _W + 't'
+_W_BR = _W + 'br'
+_W_TYPE = _W + 'type'
+_W_LAST_RENDERED_PAGE_BREAK = _W + 'lastRenderedPageBreak'
+_MC_FALLBACK = '{http://schemas.openxmlformats.org/markup-compatibility/2006}Fallback'
+# Run content other than w:t and w:br, as python-docx renders it
+_RUN_CHARACTERS = {_W + 'tab': '\t', _W + 'ptab': '\t', _W + 'cr': '\n', _W + 'noBreakHyphen': '-'}
+_PAGE_BREAK_MARKUP = re.compile(rb'<(?:\w+:)?lastRenderedPageBreak\b|<(?:\w+:)?br\b[^>]*\btype="page"')
+
+_CONTROL_CHARS = re.compile(r'[\x00-\x08\x0B-\x0C\x0E-\x1F\x7F]')
+_WHITESPACE_RUN = re.compile(r'\s+')
+
+def _is_path(source: DocumentSource) -> bool:
+    return isinstance(source, (str, os.PathLike))
+
+@contextmanager
+def open_source(source: DocumentSource) -> Iterator[BinaryIO]:
+    """Open any document source as a binary file object, without copying in-memory bytes to disk.
+
+    Bytes are wrapped in a BytesIO, which shares their buffer rather than
+    copying it. A file object passed in is rewound and left open.
+    """
+    if _is_path(source):
+        with open(source, 'rb') as file:
+            yield file
+    elif isinstance(source, (bytes, bytearray, memoryview)):
+        yield io.BytesIO(source)
+    else:
+        if source.seekable():
+            source.seek(0)
+        yield source
+
+def iter_source_chunks(source: DocumentSource, chunk_size: int = TEXT_CHUNK_SIZE) -> Iterator[bytes]:
+    """Yield a source's bytes in chunks; files on disk are memory-mapped instead of read into buffers"""
+    if _is_path(source):
+        with open(source, 'rb') as file:
+            size = os.fstat(file.fileno()).st_size
+            if not size:
+                # Empty files can't be mapped
+                return
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                for offset in range(0, size, chunk_size):
+                    yield mapped[offset:offset + chunk_size]
+    elif isinstance(source, (bytes, bytearray, memoryview)):
+        view = memoryview(source)
+        for offset in range(0, len(view), chunk_size):
+            yield view[offset:offset + chunk_size]
+    else:
+        if source.seekable():
+            source.seek(0)
+        yield from iter(lambda: source.read(chunk_size), b'')
 
 class DocumentHandler:
-    """Base class for document handlers"""
+    """Base class for document handlers.
+
+    The source is a file path, the file's bytes (bytes, bytearray or
+    memoryview) or a binary file object, so uploads can be read straight from
+    memory.
+    """
+    def __init__(self, source: DocumentSource):
+        self.source = source
+
+    def iter_pages(self) -> Iterator[Tuple[int, str]]:
+        """Lazily yield (page number, text content) pairs"""
+        raise NotImplementedError("Must be implemented by subclass")
+
     def extract_text(self) -> Dict[int, str]:
         """Extract text from document and return dict of page numbers and text content"""
-        raise NotImplementedError("Must be implemented by subclass")
+        return dict(self.iter_pages())
 
     def clean_text(self, text: str) -> str:
         """Clean text by removing problematic characters"""
         if not text:
             return ""
         # Remove NUL characters and other control characters except newlines and tabs
-        text = re.sub(r'[\x00-\x08\x0B-\x0C\x0E-\x1F\x7F]', '', text)
+        text = _CONTROL_CHARS.sub('', text)
         # Replace multiple spaces with single space
-        text = re.sub(r'\s+', ' ', text)
+        text = _WHITESPACE_RUN.sub(' ', text)
         return text.strip()
 
 class PDFHandler(DocumentHandler):
-    def __init__(self, file_path: str):
-        self.file_path = file_path
+    def page_count(self) -> int:
+        """Return the number of pages in the PDF"""
+        try:
+            import PyPDF2
+            with open_source(self.source) as file:
+                return len(PyPDF2.PdfReader(file).pages)
+        except Exception as e:
+            raise Exception(f"Error processing PDF: {str(e)}")
 
-    def extract_text(self) -> Dict[int, str]:
-        """Extract text from PDF file"""
-        text_by_page = {}
+    def iter_pages(self) -> Iterator[Tuple[int, str]]:
+        """Yield text from each page of the PDF file"""
+        return self.iter_page_range(0, None)
 
+    def extract_page_range(self, start: int, stop: Optional[int]) -> Dict[int, str]:
+        """Extract text from pages [start, stop) of the PDF file; stop=None reads to the end"""
+        return dict(self.iter_page_range(start, stop))
+
+    def iter_page_range(self, start: int, stop: Optional[int]) -> Iterator[Tuple[int, str]]:
+        """Yield text from pages [start, stop) of the PDF file; stop=None reads to the end"""
         try:
-            with open(self.file_path, 'rb') as file:
+            import PyPDF2
+            with open_source(self.source) as file:
                 pdf_reader = PyPDF2.PdfReader(file)
+                if stop is None:
+                    stop = len(pdf_reader.pages)
 
-                for page_num in range(len(pdf_reader.pages)):
+                for page_num in range(start, min(stop, len(pdf_reader.pages))):
                     page = pdf_reader.pages[page_num]
                     # Clean the extracted text
-                    text_by_page[page_num] = self.clean_text(page.extract_text())
+                    yield page_num, self.clean_text(page.extract_text())
 
         except Exception as e:
             raise Exception(f"Error processing PDF: {str(e)}")
 
-        return text_by_page
-
 class WordHandler(DocumentHandler):
-    def __init__(self, file_path: str):
-        self.file_path = file_path
-
-    def extract_text(self) -> Dict[int, str]:
-        """Extract text from Word document"""
-        text_by_page = {}
+    """Streams text from a .docx file without building python-docx's object model.
 
+    The main document part is parsed incrementally and each element is
+    dropped as soon as it is read, so memory is bounded by a page rather
+    than by the document. Paragraphs in tables and text boxes are included.
+    When the document records page breaks (explicit ones, or those Word
+    last rendered), pages follow them; otherwise paragraphs are grouped into
+    virtual pages of about CHARS_PER_PAGE characters.
+    """
+    def iter_pages(self) -> Iterator[Tuple[int, str]]:
+        """Yield real or virtual pages of text from Word document"""
         try:
-            doc = docx.Document(self.file_path)
-            paragraphs = [para for para in doc.paragraphs if para.text.strip()]
+            with open_source(self.source) as file, zipfile.ZipFile(file) as archive:
+                part = _main_document_part(archive)
+                with archive.open(part) as xml:
+                    real_pages = _has_page_breaks(xml)
+                with archive.open(part) as xml:
+                    yield from self._iter_xml_pages(xml, real_pages)
 
-            # Word documents don't have explicit pages, so we'll group paragraphs
-            # into virtual pages of roughly 3000 characters each
-            current_page = []
-            current_length = 0
-            page_num = 0
+        except Exception as e:
+            raise Exception(f"Error processing Word document: {str(e)}")
 
-            for para in paragraphs:
-                para_text = self.clean_text(para.text)
-                if para_text:
+    def _iter_xml_pages(self, xml: BinaryIO, real_pages: bool) -> Iterator[Tuple[int, str]]:
+        current_page = []
+        current_length = 0
+        page_num = 0
+        # Text pieces of each open paragraph; text box paragraphs nest inside others
+        paragraphs = []
+        elements = []
+        # Depth inside mc:Fallback, which repeats the content of the mc:Choice before it
+        fallback_depth = 0
+
+        for event, elem in ElementTree.iterparse(xml, events=('start', 'end')):
+            if event == 'start':
+                elements.append(elem)
+                if elem.tag == _W_P:
+                    paragraphs.append([])
+                elif elem.tag == _MC_FALLBACK:
+                    fallback_depth += 1
+                continue
+
+            elements.pop()
+            parent = elements[-1] if elements else None
+            tag = elem.tag
+            page_break = False
+
+            if tag == _W_P:
+                para_text = self.clean_text(''.join(paragraphs.pop()))
+                if para_text and not fallback_depth:
                     current_page.append(para_text)
                     current_length += len(para_text)
+            elif tag == _MC_FALLBACK:
+                fallback_depth -= 1
+            elif parent is not None and parent.tag == _W_R and paragraphs and not fallback_depth:
+                if tag == _W_T:
+                    paragraphs[-1].append(elem.text or '')
+                elif tag == _W_BR:
+                    break_type = elem.get(_W_TYPE)
+                    paragraphs[-1].append('\n' if break_type in (None, 'textWrapping') else '')
+                    page_break = break_type == 'page'
+                elif tag == _W_LAST_RENDERED_PAGE_BREAK:
+                    page_break = True
+                elif tag in _RUN_CHARACTERS:
+                    paragraphs[-1].append(_RUN_CHARACTERS[tag])
 
-                    # Start a new page after ~3000 characters
-                    if current_length >= 3000:
-                        text_by_page[page_num] = '\n'.join(current_page)
-                        current_page = []
-                        current_length = 0
-                        page_num += 1
+            # Nothing is read from an element after its end, so drop it to keep memory flat
+            if parent is not None:
+                parent.remove(elem)
 
-            # Add any remaining text as the last page
-            if current_page:
-                text_by_page[page_num] = '\n'.join(current_page)
+            if real_pages and page_break:
+                # The paragraph's text so far belongs to the page that just ended
+                para_text = self.clean_text(''.join(paragraphs[-1]))
+                paragraphs[-1].clear()
+                if para_text:
+                    current_page.append(para_text)
+                if current_page:
+                    yield page_num, '\n'.join(current_page)
+                    current_page = []
+                    current_length = 0
+                    page_num += 1
+            elif not real_pages and current_length >= CHARS_PER_PAGE:
+                # Start a new page after ~3000 characters
+                yield page_num, '\n'.join(current_page)
+                current_page = []
+                current_length = 0
+                page_num += 1
+
+        # Add any remaining text as the last page
+        if current_page:
+            yield page_num, '\n'.join(current_page)
+
+def _main_document_part(archive: zipfile.ZipFile) -> str:
+    """Name of the package's main document part, from its relationships; usually word/document.xml"""
+    try:
+        with archive.open('_rels/.rels') as rels:
+            for relationship in ElementTree.parse(rels).getroot():
+                if relationship.get('Type', '').endswith('/officeDocument'):
+                    return relationship.get('Target').lstrip('/')
+    except KeyError:
+        pass
+    return 'word/document.xml'
+
+def _has_page_breaks(xml: BinaryIO, chunk_size: int = TEXT_CHUNK_SIZE) -> bool:
+    """Scan the raw XML for page break elements, without parsing it"""
+    tail = b''
+    for chunk in iter(lambda: xml.read(chunk_size), b''):
+        if _PAGE_BREAK_MARKUP.search(tail + chunk):
+            return True
+        # Keep enough of the previous chunk to match a tag split between chunks
+        tail = chunk[-256:]
+    return False
 
+class LegacyWordHandler(DocumentHandler):
+    """Reads binary Word 97-2003 (.doc) files with the antiword tool, which python-docx can't open"""
+    def iter_pages(self) -> Iterator[Tuple[int, str]]:
+        """Yield virtual pages of the text antiword extracts"""
+        antiword = shutil.which('antiword')
+        if antiword is None:
+            raise Exception("Error processing Word document: .doc files need antiword installed; "
+                            "otherwise save the file as .docx")
+        tmp_path = None
+        try:
+            if _is_path(self.source):
+                path = os.fspath(self.source)
+            else:
+                # antiword seeks around in its input, so in-memory files go through a temporary file
+                with open_source(self.source) as file, tempfile.NamedTemporaryFile(suffix='.doc', delete=False) as tmp_file:
+                    shutil.copyfileobj(file, tmp_file)
+                path = tmp_path = tmp_file.name
+            completed = subprocess.run([antiword, '-m', 'UTF-8.txt', path], capture_output=True, check=True)
+        except subprocess.CalledProcessError as e:
+            raise Exception(f"Error processing Word document: {e.stderr.decode('utf-8', 'replace').strip()}")
         except Exception as e:
             raise Exception(f"Error processing Word document: {str(e)}")
+        finally:
+            if tmp_path:
+                os.unlink(tmp_path)
 
-        return text_by_page
+        # Paginated like a plain text file
+        yield from TextHandler(completed.stdout).iter_pages()
 
-class TextHandler(DocumentHandler):
-    def __init__(self, file_path: str):
-        self.file_path = file_path
+def _decode_chunks(source: DocumentSource) -> Iterator[str]:
+    """Decode a UTF-8 source chunk by chunk; characters split across chunks are carried over"""
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    for data in iter_source_chunks(source):
+        yield decoder.decode(data)
+    yield decoder.decode(b'', final=True)
 
-    def extract_text(self) -> Dict[int, str]:
-        """Extract text from plain text file"""
-        text_by_page = {}
+class TextHandler(DocumentHandler):
+    def iter_pages(self) -> Iterator[Tuple[int, str]]:
+        """Yield virtual pages from plain text file, decoding it in bounded chunks.
 
+        Produces the same pages as cleaning the whole file and splitting it every
+        3000 characters, but only holds about one chunk in memory at a time.
+        """
         try:
-            with open(self.file_path, 'r', encoding='utf-8') as file:
-                content = file.read()
-                content = self.clean_text(content)
+            buffer = ''
+            page_num = 0
+            last_char = ''
 
-                # Split into virtual pages of roughly 3000 characters
-                chars_per_page = 3000
-                pages = [content[i:i + chars_per_page] 
-                        for i in range(0, len(content), chars_per_page)]
+            for chunk in _decode_chunks(self.source):
+                chunk = _WHITESPACE_RUN.sub(' ', _CONTROL_CHARS.sub('', chunk))
+                # Whitespace runs can span chunks, and leading whitespace is dropped
+                if chunk.startswith(' ') and last_char in ('', ' '):
+                    chunk = chunk[1:]
+                if not chunk:
+                    continue
+                last_char = chunk[-1]
+                buffer += chunk
 
-                for i, page_content in enumerate(pages):
-                    text_by_page[i] = page_content.strip()
+                # Keep at least one character back so trailing whitespace can still be stripped
+                page_start = 0
+                while len(buffer) - page_start > CHARS_PER_PAGE:
+                    yield page_num, buffer[page_start:page_start + CHARS_PER_PAGE].strip()
+                    page_start += CHARS_PER_PAGE
+                    page_num += 1
+                buffer = buffer[page_start:]
+
+            buffer = buffer.rstrip(' ')
+            if buffer:
+                yield page_num, buffer.strip()
 
         except Exception as e:
             raise Exception(f"Error processing text file: {str(e)}")
 
-        return text_by_page
+# Handler for each supported file extension
+HANDLERS = {
+    '.pdf': PDFHandler,
+    '.docx': WordHandler,
+    '.doc': LegacyWordHandler,
+    '.txt': TextHandler
+}
 
-def create_document_handler(file_path: str) -> Optional[DocumentHandler]:
-    """Factory method to create appropriate document handler based on file extension"""
-    ext = os.path.splitext(file_path)[1].lower()
+def create_document_handler(source: DocumentSource, filename: Optional[str] = None) -> Optional[DocumentHandler]:
+    """Factory method to create appropriate document handler based on file extension.
 
-    handlers = {
-        '.pdf': PDFHandler,
-        '.docx': WordHandler,
-        '.doc': WordHandler,
-        '.txt': TextHandler
-    }
+    The extension comes from filename, or from the source when it is a path;
+    in-memory sources need a filename.
+    """
+    if filename is None and _is_path(source):
+        filename = os.fspath(source)
+    ext = os.path.splitext(filename or '')[1].lower()
 
-    handler_class = handlers.get(ext)
+    handler_class = HANDLERS.get(ext)
     if handler_class:
-        return handler_class(file_path)
+        return handler_class(source)
+
+    raise ValueError(f"Unsupported file format: {ext}")
+
+def _task_source(source: DocumentSource) -> DocumentSource:
+    """A source that can be sent to a worker process: paths and bytes as they are, others read into bytes"""
+    if _is_path(source) or isinstance(source, (bytes, bytearray)):
+        return source
+    if isinstance(source, memoryview):
+        return source.tobytes()
+    with open_source(source) as file:
+        return file.read()
+
+def _extract_file(source: DocumentSource, filename: Optional[str]) -> Tuple[Dict[int, str], float]:
+    """Worker task: extract a whole document, returning its pages and the seconds it took"""
+    start = time.perf_counter()
+    text_by_page = create_document_handler(source, filename).extract_text()
+    return text_by_page, time.perf_counter() - start
+
+def _extract_pdf_pages(source: DocumentSource, start: int, stop: int) -> Tuple[Dict[int, str], float]:
+    """Worker task: extract one page range of a PDF, returning its pages and the seconds it took"""
+    started = time.perf_counter()
+    text_by_page = PDFHandler(source).extract_page_range(start, stop)
+    return text_by_page, time.perf_counter() - started
+
+def _record_extraction(source: DocumentSource, document: Optional[str], page_count: int, seconds: float):
+    # Timings are measured in the worker and recorded here, where the current run is tracked
+    filename = document or os.fspath(source)
+    fmt = os.path.splitext(filename)[1].lower().lstrip('.')
+    metrics.observe("extract", seconds, document or os.path.basename(filename), format=fmt)
+    metrics.increment("pages_extracted", page_count, format=fmt)
+
+def is_streamed(source: DocumentSource, filename: Optional[str] = None) -> bool:
+    """Whether a document should be extracted with `iter_document_pages` rather than `extract_documents`"""
+    if filename is None and _is_path(source):
+        filename = os.fspath(source)
+    if HANDLERS.get(os.path.splitext(filename or '')[1].lower()) is not TextHandler:
+        return False
+    if _is_path(source):
+        size = os.path.getsize(source)
+    elif isinstance(source, (bytes, bytearray, memoryview)):
+        size = memoryview(source).nbytes
+    else:
+        return False
+    return size >= STREAM_MIN_BYTES
+
+def iter_document_pages(source: DocumentSource, filename: Optional[str] = None) -> Iterator[Tuple[int, str]]:
+    """Extract a document in this process a page at a time, recording its extraction like `extract_documents`.
+
+    Only the time spent extracting counts towards the extract stage, not the
+    time the caller spends on each page.
+    """
+    pages = create_document_handler(source, filename).iter_pages()
+    seconds = 0.0
+    page_count = 0
+    while True:
+        start = time.perf_counter()
+        try:
+            page = next(pages)
+        except StopIteration:
+            break
+        finally:
+            seconds += time.perf_counter() - start
+        page_count += 1
+        yield page
+    _record_extraction(source, filename, page_count, seconds)
+
+def extract_documents(sources: Sequence[DocumentSource], max_workers: Optional[int] = None,
+                      document_names: Optional[Sequence[str]] = None,
+                      executor: Optional[ProcessPoolExecutor] = None) -> List[Tuple[Optional[Dict[int, str]], Optional[Exception]]]:
+    """Extract many documents in parallel with a process pool.
+
+    Sources are file paths or in-memory files (see DocumentHandler); in-memory
+    ones need document_names, whose extensions pick the handler. Large PDFs are
+    split into page ranges so a single big file also spreads across workers.
+    Returns one (text_by_page, error) pair per source, in input order; a
+    failure in one file only sets that file's error. Extraction time is
+    recorded per document, under document_names when given. Callers that
+    extract in several rounds can pass their own executor to reuse its workers.
+    """
+    workers = EXTRACT_WORKERS if max_workers is None else max_workers
+    names = list(document_names) if document_names else [None] * len(sources)
+
+    if executor is not None:
+        return _extract_with(executor, sources, names)
+
+    if workers <= 1:
+        # Serial extraction reads in-memory sources in place
+        results = []
+        for source, name in zip(sources, names):
+            try:
+                text_by_page, seconds = _extract_file(source, name)
+                _record_extraction(source, name, len(text_by_page), seconds)
+                results.append((text_by_page, None))
+            except Exception as e:
+                metrics.increment("extraction_errors")
+                results.append((None, e))
+        return results
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return _extract_with(executor, sources, names)
+
+def _extract_with(executor: ProcessPoolExecutor, sources: Sequence[DocumentSource],
+                  names: Sequence[Optional[str]]) -> List[Tuple[Optional[Dict[int, str]], Optional[Exception]]]:
+    # Submit every task up front, keeping each file's futures in page order
+    futures_by_file = []
+    for source, name in zip(sources, names):
+        try:
+            handler = create_document_handler(source, name)
+            page_count = handler.page_count() if isinstance(handler, PDFHandler) else 0
+            # Bytes are pickled straight to the worker processes; no temporary file is written
+            source = _task_source(source)
+            if page_count > PDF_PAGES_PER_TASK:
+                futures = [
+                    executor.submit(_extract_pdf_pages, source, start, start + PDF_PAGES_PER_TASK)
+                    for start in range(0, page_count, PDF_PAGES_PER_TASK)
+                ]
+            else:
+                futures = [executor.submit(_extract_file, source, name)]
+            futures_by_file.append((futures, None))
+        except Exception as e:
+            futures_by_file.append(([], e))
+
+    results = []
+    for source, name, (futures, error) in zip(sources, names, futures_by_file):
+        text_by_page = {}
+        seconds = 0.0
+        try:
+            for future in futures:
+                pages, task_seconds = future.result()
+                text_by_page.update(pages)
+                seconds += task_seconds
+        except Exception as e:
+            error = e
+        if error:
+            metrics.increment("extraction_errors")
+            results.append((None, error))
+        else:
+            _record_extraction(source, name, len(text_by_page), seconds)
+            results.append((text_by_page, None))
+    return results
+
+def extract_uploads(uploads: Sequence[Tuple[str, DocumentSource]], max_workers: Optional[int] = None,
+                    executor: Optional[ProcessPoolExecutor] = None) -> List[Tuple[Optional[Dict[int, str]], Optional[Exception]]]:
+    """Extract (filename, bytes) uploads in parallel, straight from memory.
 
-    raise ValueError(f"Unsupported file format: {ext}")
\ No newline at end of file
+    Returns one (text_by_page, error) pair per upload, in the same order.
+    """
+    return extract_documents([data for _, data in uploads], max_workers, [filename for filename, _ in uploads], executor)
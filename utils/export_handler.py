@@ -1,24 +1,169 @@
-import pandas as pd
+import csv
 import io
+import json
+from collections.abc import Mapping
+from itertools import chain, islice
+from typing import BinaryIO, Iterable, List, Optional, Sequence
+from utils import metrics
 
-def create_excel_export(df):
-    """Create Excel file from search results"""
-    # Select only required columns for export
-    export_df = df[['Search Term', 'Page', 'Excerpt']]
-    
-    # Create Excel file in memory
+# Columns written by the exports, in order
+EXPORT_COLUMNS = ['Search Term', 'Page', 'Excerpt']
+
+# Excel's row limit per worksheet, header included
+EXCEL_MAX_ROWS = 1048576
+
+# Rows sampled from the start of an export to size the Excel columns
+WIDTH_SAMPLE_ROWS = 1000
+
+# Rows buffered per Parquet row group
+PARQUET_BATCH_ROWS = 50000
+
+SHEET_NAME = 'Search Results'
+
+def _row_values(row, columns: Sequence[str]) -> list:
+    """Accept dicts and mappings keyed by column name, or sequences already in column order"""
+    if isinstance(row, Mapping):
+        return [row.get(column) for column in columns]
+    mapping = getattr(row, '_mapping', None)  # SQLAlchemy rows
+    if mapping is not None and all(column in mapping for column in columns):
+        return [mapping[column] for column in columns]
+    return list(row)
+
+def _write_xlsx(rows: Iterable, output: BinaryIO, columns: Sequence[str], max_rows_per_sheet: int = EXCEL_MAX_ROWS) -> int:
+    """Stream rows into a write-only workbook, starting a new sheet whenever one is full"""
+    from openpyxl import Workbook
+    from openpyxl.cell import WriteOnlyCell
+    from openpyxl.styles import Font
+    from openpyxl.utils import get_column_letter
+
+    rows = iter(rows)
+    sample = list(islice(rows, WIDTH_SAMPLE_ROWS))
+    widths = [len(column) for column in columns]
+    for values in sample:
+        for idx, value in enumerate(values):
+            if value is not None:
+                widths[idx] = max(widths[idx], len(str(value)))
+
+    workbook = Workbook(write_only=True)
+    header_font = Font(bold=True)
+    sheet = None
+    sheet_rows = max_rows_per_sheet
+    count = 0
+
+    for values in chain(sample, rows):
+        if sheet_rows >= max_rows_per_sheet:
+            sheet = workbook.create_sheet(SHEET_NAME if sheet is None else f"{SHEET_NAME} ({len(workbook.worksheets) + 1})")
+            # Widths must be set before any row is written to a write-only sheet
+            for idx, width in enumerate(widths):
+                sheet.column_dimensions[get_column_letter(idx + 1)].width = min(width + 2, 50)
+            header = []
+            for column in columns:
+                cell = WriteOnlyCell(sheet, value=column)
+                cell.font = header_font
+                header.append(cell)
+            sheet.append(header)
+            sheet_rows = 1
+        sheet.append(values)
+        sheet_rows += 1
+        count += 1
+
+    if sheet is None:
+        # An empty export still gets a sheet with the header
+        sheet = workbook.create_sheet(SHEET_NAME)
+        sheet.append(list(columns))
+
+    workbook.save(output)
+    return count
+
+def _write_csv(rows: Iterable, output: BinaryIO, columns: Sequence[str]) -> int:
+    text = io.TextIOWrapper(output, encoding='utf-8', newline='')
+    writer = csv.writer(text)
+    writer.writerow(columns)
+    count = 0
+    for values in rows:
+        writer.writerow(values)
+        count += 1
+    text.flush()
+    text.detach()
+    return count
+
+def _write_jsonl(rows: Iterable, output: BinaryIO, columns: Sequence[str]) -> int:
+    count = 0
+    for values in rows:
+        output.write(json.dumps(dict(zip(columns, values)), ensure_ascii=False, default=str).encode('utf-8'))
+        output.write(b'\n')
+        count += 1
+    return count
+
+def _write_parquet(rows: Iterable, output: BinaryIO, columns: Sequence[str]) -> int:
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise Exception("Error exporting Parquet: install pyarrow to enable Parquet exports")
+
+    rows = iter(rows)
+    writer = None
+    count = 0
+    try:
+        while True:
+            batch = list(islice(rows, PARQUET_BATCH_ROWS))
+            if not batch and writer is not None:
+                break
+            table = pa.table({column: [values[idx] for values in batch] for idx, column in enumerate(columns)})
+            if writer is None:
+                # Column types come from the first batch; columns with no values there are strings
+                schema = pa.schema([
+                    pa.field(field.name, pa.string()) if pa.types.is_null(field.type) else field
+                    for field in table.schema
+                ])
+                writer = pq.ParquetWriter(output, schema)
+            writer.write_table(table.cast(writer.schema))
+            count += len(batch)
+            if len(batch) < PARQUET_BATCH_ROWS:
+                break
+    finally:
+        if writer is not None:
+            writer.close()
+    return count
+
+# Format -> (writer, file extension, MIME type)
+EXPORT_FORMATS = {
+    'xlsx': (_write_xlsx, 'xlsx', 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'),
+    'csv': (_write_csv, 'csv', 'text/csv'),
+    'jsonl': (_write_jsonl, 'jsonl', 'application/x-ndjson'),
+    'parquet': (_write_parquet, 'parquet', 'application/vnd.apache.parquet'),
+}
+
+def export_rows(rows: Iterable, output: BinaryIO, fmt: str = 'xlsx', columns: Optional[List[str]] = None) -> int:
+    """Stream result rows to a binary file object in the given format; returns the number of rows written.
+
+    Rows can come from a generator or a database cursor and are consumed one at
+    a time, so memory stays flat however many there are. Each row is a dict
+    keyed by column name or a sequence in column order.
+    """
+    if fmt not in EXPORT_FORMATS:
+        raise Exception(f"Error exporting results: unsupported format {fmt}")
+    columns = columns or EXPORT_COLUMNS
+    writer = EXPORT_FORMATS[fmt][0]
+
+    with metrics.span("export", format=fmt):
+        count = writer((_row_values(row, columns) for row in rows), output, columns)
+    metrics.increment("export_rows", count, format=fmt)
+    return count
+
+def export_to_file(rows: Iterable, path: str, fmt: Optional[str] = None, columns: Optional[List[str]] = None) -> int:
+    """Stream result rows to a file, taking the format from its extension unless given"""
+    fmt = fmt or path.rsplit('.', 1)[-1].lower()
+    with open(path, 'wb') as output:
+        return export_rows(rows, output, fmt, columns)
+
+def create_export(rows: Iterable, fmt: str = 'xlsx', columns: Optional[List[str]] = None) -> bytes:
+    """Export result rows in memory, e.g. for a download button"""
     output = io.BytesIO()
-    with pd.ExcelWriter(output, engine='openpyxl') as writer:
-        export_df.to_excel(writer, index=False, sheet_name='Search Results')
-        
-        # Auto-adjust column widths
-        worksheet = writer.sheets['Search Results']
-        for idx, col in enumerate(export_df.columns):
-            max_length = max(
-                export_df[col].astype(str).apply(len).max(),
-                len(col)
-            )
-            worksheet.column_dimensions[chr(65 + idx)].width = min(max_length + 2, 50)
-    
-    output.seek(0)
+    export_rows(rows, output, fmt, columns)
     return output.getvalue()
+
+def create_excel_export(df):
+    """Create Excel file from search results"""
+    return create_export(df[EXPORT_COLUMNS].itertuples(index=False, name=None), 'xlsx')
@@ -0,0 +1,180 @@
+import os
+from typing import Dict, List, Optional, Set, Tuple
+from utils.text_processor import TermMatcher, _ALNUM_RUN
+
+# Minimum trigram similarity (shared / total distinct trigrams) for a word to be checked as a variant
+FUZZY_MIN_SIMILARITY = float(os.getenv("FUZZY_MIN_SIMILARITY", "0.3"))
+
+# Edits allowed per word; unset scales with word length (see allowed_edits)
+FUZZY_MAX_EDITS = int(os.getenv("FUZZY_MAX_EDITS")) if os.getenv("FUZZY_MAX_EDITS") else None
+
+# Distinct words whose match result is remembered per matcher
+WORD_CACHE_SIZE = 200000
+
+def trigrams(word: str) -> Set[str]:
+    """Return the word's trigrams, padded like pg_trgm so short words and word edges count"""
+    padded = f"  {word} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def trigram_similarity(a: Set[str], b: Set[str]) -> float:
+    if not a or not b:
+        return 0.0
+    shared = len(a & b)
+    return shared / (len(a) + len(b) - shared)
+
+def bounded_edit_distance(a: str, b: str, max_distance: int) -> int:
+    """Levenshtein distance between a and b, or max_distance + 1 as soon as it must exceed max_distance"""
+    limit = max_distance + 1
+    if abs(len(a) - len(b)) > max_distance:
+        return limit
+    if a == b:
+        return 0
+
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, start=1):
+        # Only cells within max_distance of the diagonal can stay in bounds
+        current = [i] + [limit] * len(b)
+        for j in range(max(1, i - max_distance), min(len(b), i + max_distance) + 1):
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != b[j - 1]))
+        if min(current) > max_distance:
+            return limit
+        previous = current
+    return min(previous[-1], limit)
+
+def allowed_edits(word: str, max_edits: Optional[int] = FUZZY_MAX_EDITS) -> int:
+    """Edits allowed when matching a variant of a term word.
+
+    Words with digits must match exactly, since "net 31 days" is not a variant
+    of "net 30 days". Otherwise max_edits applies, or by default 0 edits up to
+    two characters, 1 up to five and 2 beyond.
+    """
+    if any(char.isdigit() for char in word):
+        return 0
+    if max_edits is not None:
+        return max_edits
+    if len(word) <= 2:
+        return 0
+    return 1 if len(word) <= 5 else 2
+
+class FuzzyMatcher(TermMatcher):
+    """TermMatcher that also finds variants of the terms' words, such as OCR errors and inflections.
+
+    Exact matches are found as before. In addition, each word of the page is
+    compared with the words of the terms: candidates come from an in-memory
+    trigram index over the term words, are kept when their trigram similarity
+    reaches min_similarity, and are then verified with a bounded edit distance.
+    With stem=True, words with the same Porter stem also match. A multi-word
+    term matches a run of consecutive page words that each match in order.
+    The result for each distinct page word is cached, so a page costs one
+    dictionary lookup per word after the vocabulary has been seen.
+    """
+
+    def __init__(self, terms, max_edits: Optional[int] = FUZZY_MAX_EDITS,
+                 min_similarity: float = FUZZY_MIN_SIMILARITY, stem: bool = False):
+        super().__init__(terms)
+        self.max_edits = max_edits
+        self.min_similarity = min_similarity
+        self.stem = stem
+        self._stemmer = None
+        if stem:
+            from nltk.stem import PorterStemmer
+            self._stemmer = PorterStemmer()
+
+        # Distinct words across all patterns, and each pattern as a list of word ids
+        self.words = []
+        word_ids = {}
+        self._pattern_words = []
+        for pattern in self.patterns:
+            ids = []
+            for word in pattern.split():
+                if word not in word_ids:
+                    word_ids[word] = len(self.words)
+                    self.words.append(word)
+                ids.append(word_ids[word])
+            self._pattern_words.append(ids)
+
+        self._word_trigrams = [trigrams(word) for word in self.words]
+        self._word_edits = [allowed_edits(word, max_edits) for word in self.words]
+        # Term words by stem, so a page word's stem is looked up rather than compared with each of them
+        self._stem_index: Dict[str, List[int]] = {}
+        if self._stemmer:
+            for word_id, word in enumerate(self.words):
+                self._stem_index.setdefault(self._stem(word), []).append(word_id)
+        self._trigram_index: Dict[str, List[int]] = {}
+        for word_id, grams in enumerate(self._word_trigrams):
+            for gram in grams:
+                self._trigram_index.setdefault(gram, []).append(word_id)
+
+        # Patterns starting with each word id
+        self._patterns_from = {}
+        for pattern_id, ids in enumerate(self._pattern_words):
+            self._patterns_from.setdefault(ids[0], []).append(pattern_id)
+
+        self._cache: Dict[str, Tuple[int, ...]] = {}
+
+    @property
+    def mode(self):
+        return f"fuzzy:{self.max_edits}:{self.min_similarity}:{int(self.stem)}"
+
+    def with_terms(self, terms):
+        return FuzzyMatcher(terms, max_edits=self.max_edits, min_similarity=self.min_similarity, stem=self.stem)
+
+    def _stem(self, word: str) -> Optional[str]:
+        return self._stemmer.stem(word) if self._stemmer else None
+
+    def match_word(self, word: str) -> Tuple[int, ...]:
+        """Return the ids of the term words that `word` is a variant of"""
+        matched = self._cache.get(word)
+        if matched is not None:
+            return matched
+
+        grams = trigrams(word)
+        shared = {}
+        for gram in grams:
+            for word_id in self._trigram_index.get(gram, ()):
+                shared[word_id] = shared.get(word_id, 0) + 1
+
+        # Only term words sharing a trigram can be similar enough
+        matched = set()
+        for word_id, count in shared.items():
+            if count / (len(grams) + len(self._word_trigrams[word_id]) - count) < self.min_similarity:
+                continue
+            edits = self._word_edits[word_id]
+            if bounded_edit_distance(word, self.words[word_id], edits) <= edits:
+                matched.add(word_id)
+        if self._stemmer:
+            matched.update(self._stem_index.get(self._stem(word), ()))
+        matched = tuple(sorted(matched))
+
+        if len(self._cache) >= WORD_CACHE_SIZE:
+            self._cache.clear()
+        self._cache[word] = matched
+        return matched
+
+    def is_variant(self, word: str, term_word: str) -> bool:
+        """Whether a word is accepted as a variant of one word of the terms"""
+        return self.words.index(term_word) in self.match_word(word)
+
+    def scan(self, normalized_text):
+        """Yield (pattern_id, start, end) for exact and variant matches, in text order.
+
+        Matches of the same pattern never overlap; an exact match inside a word
+        and a variant match of that word count once.
+        """
+        hits = list(super().scan(normalized_text))
+
+        page_words = [(match.start(), match.end(), self.match_word(match.group()))
+                      for match in _ALNUM_RUN.finditer(normalized_text)]
+        for index, (start, _, matched) in enumerate(page_words):
+            for word_id in matched:
+                for pattern_id in self._patterns_from.get(word_id, ()):
+                    ids = self._pattern_words[pattern_id]
+                    last = index + len(ids) - 1
+                    if last < len(page_words) and all(ids[k] in page_words[index + k][2] for k in range(1, len(ids))):
+                        hits.append((pattern_id, start, page_words[last][1]))
+
+        last_end = [0] * len(self.patterns)
+        for pattern_id, start, end in sorted(hits, key=lambda hit: (hit[1], -hit[2])):
+            if start >= last_end[pattern_id]:
+                last_end[pattern_id] = end
+                yield pattern_id, start, end
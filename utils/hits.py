@@ -0,0 +1,419 @@
+"""Search hits stored as offsets into the stored page text, rendered into excerpts when read.
+
+A hit is (document, term, page, start, end) against the page text kept by
+utils.page_store, instead of a copy of the excerpt and its first sentence.
+Overlapping windows of a term on a page are merged when searching (see
+`utils.text_processor.search_hits_multi`), so repeated occurrences don't
+store near-identical excerpts either. A hit is stored once for the
+document, term and matcher mode; jobs that find it again link to it.
+"""
+import json
+import os
+from typing import Dict, Iterable, List, Optional, Tuple
+from sqlalchemy import exists, func, insert, select, tuple_
+from sqlalchemy.exc import IntegrityError
+from utils import metrics
+from utils.database import (Document, DocumentPage, JobHit, SearchHit, SearchResult, SearchTerm, bulk_insert_job_hits,
+                            bulk_insert_search_hits)
+from utils.document_handler import EXTRACTOR_VERSION
+from utils.text_processor import render_excerpt, sentence_boundaries, unpack_boundaries
+
+# Search results per page of the history view
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", "50"))
+
+# Stored pages loaded per query when rendering hits
+RENDER_BATCH_SIZE = int(os.getenv("RENDER_BATCH_SIZE", "500"))
+
+# Legacy search results converted per transaction by migrate_search_results
+MIGRATION_BATCH_SIZE = int(os.getenv("MIGRATION_BATCH_SIZE", "2000"))
+
+# Set once this process has seen no legacy search results left; see get_search_history
+_legacy_migrated = False
+
+def get_term_ids(db, terms: Iterable[str]) -> Dict[str, int]:
+    """Return term -> id, adding terms seen for the first time; safe against concurrent writers"""
+    terms = list(dict.fromkeys(terms))
+    term_ids = dict(db.query(SearchTerm.term, SearchTerm.id).filter(SearchTerm.term.in_(terms)).all())
+    for term in terms:
+        if term in term_ids:
+            continue
+        try:
+            with db.begin_nested():
+                db.execute(insert(SearchTerm).values(term=term))
+        except IntegrityError:
+            # Another worker added it first
+            pass
+    if len(term_ids) < len(terms):
+        term_ids = dict(db.query(SearchTerm.term, SearchTerm.id).filter(SearchTerm.term.in_(terms)).all())
+    return term_ids
+
+def hit_counts(hits_by_term) -> Dict[str, Dict[int, int]]:
+    """Turn term -> {page number: windows} into term -> {page number: match count}, e.g. for ranking"""
+    return {
+        term: {page_num: sum(matches for _, _, matches in windows) for page_num, windows in pages.items()}
+        for term, pages in hits_by_term.items()
+    }
+
+def hit_rows(hits_by_term, terms: List[str], term_ids: Dict[str, int], document_id: int,
+             job_id: Optional[int] = None, extractor_version: str = EXTRACTOR_VERSION,
+             scores: Optional[Dict[Tuple[str, int], float]] = None, mode: Optional[str] = None) -> List[Dict]:
+    """Build `save_hits` rows from term -> {page number: [(start, end, matches)]}.
+
+    Rows follow the order of terms, then pages. With scores, only pages with
+    a (term, page number) score are kept, and the score is saved with them.
+    mode is the matcher's (see TermMatcher.mode).
+    """
+    rows = []
+    for term in terms:
+        for page_num, windows in hits_by_term.get(term, {}).items():
+            score = None
+            if scores is not None:
+                if (term, page_num) not in scores:
+                    continue
+                score = scores[(term, page_num)]
+            for start, end, matches in windows:
+                rows.append({
+                    'document_id': document_id,
+                    'term_id': term_ids[term],
+                    'page_number': page_num + 1,
+                    'extractor_version': extractor_version,
+                    'start_offset': start,
+                    'end_offset': end,
+                    'matches': matches,
+                    'mode': mode,
+                    'job_id': job_id,
+                    'score': score
+                })
+    return rows
+
+def _hit_key(row) -> tuple:
+    return (row['document_id'], row['term_id'], row['mode'], row['extractor_version'], row['page_number'],
+            row['start_offset'], row['end_offset'])
+
+def _stored_hits(db, rows: List[Dict]) -> Dict[tuple, int]:
+    """Ids of stored hits with the same document, term, mode and window as rows, keyed by `_hit_key`"""
+    groups = {}
+    for row in rows:
+        groups.setdefault((row['document_id'], row['mode'], row['extractor_version']), set()).add(row['term_id'])
+    stored = {}
+    for (document_id, mode, extractor_version), term_ids in groups.items():
+        found = (
+            db.query(SearchHit.id, SearchHit.term_id, SearchHit.page_number, SearchHit.start_offset, SearchHit.end_offset)
+            .filter(SearchHit.document_id == document_id, SearchHit.mode == mode,
+                    SearchHit.extractor_version == extractor_version, SearchHit.term_id.in_(term_ids))
+            .order_by(SearchHit.id)
+            .all()
+        )
+        for hit_id, term_id, page_number, start, end in found:
+            # Concurrent writers may have stored a hit twice; the first copy is used
+            stored.setdefault((document_id, term_id, mode, extractor_version, page_number, start, end), hit_id)
+    return stored
+
+def save_hits(db, rows: List[Dict], job_id: Optional[int] = None, commit_per_batch: bool = False) -> int:
+    """Save `hit_rows`, storing only hits not stored before; with job_id, link every hit to the job.
+
+    A hit is the same when its document, term, matcher mode and window are,
+    so searching a file again (e.g. a rerun of the same search) reuses its
+    hits instead of storing copies. Row scores are saved on the job's links.
+    Returns the number of hits newly stored.
+    """
+    if not rows:
+        return 0
+    with metrics.span("save_hits"):
+        stored = _stored_hits(db, rows)
+        new_rows = {}
+        for row in rows:
+            key = _hit_key(row)
+            if key not in stored and key not in new_rows:
+                new_rows[key] = dict(row, score=None)
+        bulk_insert_search_hits(db, list(new_rows.values()), commit_per_batch=commit_per_batch)
+        metrics.increment("hits_reused", len(rows) - len(new_rows))
+
+        if job_id is not None:
+            if new_rows:
+                stored.update(_stored_hits(db, list(new_rows.values())))
+            links = {}
+            for row in rows:
+                links.setdefault(stored[_hit_key(row)], row.get('score'))
+            # E.g. a file uploaded twice in one job
+            hit_ids = list(links)
+            for batch_start in range(0, len(hit_ids), RENDER_BATCH_SIZE):
+                for hit_id, in db.query(JobHit.hit_id).filter(
+                        JobHit.job_id == job_id, JobHit.hit_id.in_(hit_ids[batch_start:batch_start + RENDER_BATCH_SIZE])):
+                    del links[hit_id]
+            bulk_insert_job_hits(db, [{'job_id': job_id, 'hit_id': hit_id, 'score': score}
+                                      for hit_id, score in links.items()], commit_per_batch=commit_per_batch)
+    return len(new_rows)
+
+def render_hits(db, hits: List[Dict]) -> List[Tuple[str, str]]:
+    """Return (excerpt, summary) for each hit, loading the stored pages it points into.
+
+    Each hit has content_hash, page_number, extractor_version, start_offset,
+    end_offset, excerpt and summary. A stored summary (an AI summary) wins
+    over the first sentence, and a stored excerpt over the page text; a hit
+    whose page is gone renders as empty text.
+    """
+    keys = list({(hit['content_hash'], hit['page_number'] - 1, hit['extractor_version'])
+                 for hit in hits if hit['excerpt'] is None})
+    pages = {}
+    with metrics.span("render_hits"):
+        for batch_start in range(0, len(keys), RENDER_BATCH_SIZE):
+            rows = (
+                db.query(DocumentPage.content_hash, DocumentPage.page_number, DocumentPage.extractor_version,
+                         DocumentPage.text, DocumentPage.sentence_offsets, DocumentPage.sentence_tokenizer)
+                .filter(tuple_(DocumentPage.content_hash, DocumentPage.page_number, DocumentPage.extractor_version)
+                        .in_(keys[batch_start:batch_start + RENDER_BATCH_SIZE]))
+                .all()
+            )
+            for content_hash, page_number, extractor_version, page_text, sentence_offsets, sentence_tokenizer in rows:
+                page_text = page_text or ""
+                # Pages stored before boundaries were kept are tokenized once, however many hits they have
+                boundaries = unpack_boundaries(sentence_offsets, sentence_tokenizer) or sentence_boundaries(page_text)
+                pages[(content_hash, page_number, extractor_version)] = (page_text, boundaries)
+
+        rendered = []
+        for hit in hits:
+            if hit['excerpt'] is not None:
+                rendered.append((hit['excerpt'], hit['summary'] or ""))
+                continue
+            page = pages.get((hit['content_hash'], hit['page_number'] - 1, hit['extractor_version']))
+            if page is None:
+                rendered.append(("", hit['summary'] or ""))
+                continue
+            excerpt, summary = render_excerpt(page[0], page[1], hit['start_offset'], hit['end_offset'])
+            rendered.append((excerpt, hit['summary'] or summary))
+    metrics.increment("hits_rendered", len(hits))
+    return rendered
+
+def hit_query(db, job_id: Optional[int] = None):
+    """Query the columns `render_hits` needs, plus id, filename, term and score.
+
+    With job_id, only that job's hits, with their score in the job and the
+    id of their link to it as result_id.
+    """
+    if job_id is None:
+        return (
+            db.query(SearchHit.id, Document.filename, SearchTerm.term, SearchHit.page_number, SearchHit.score,
+                     Document.content_hash, SearchHit.extractor_version, SearchHit.start_offset, SearchHit.end_offset,
+                     SearchHit.excerpt, SearchHit.summary)
+            .join(SearchTerm, SearchHit.term_id == SearchTerm.id)
+            .outerjoin(Document, SearchHit.document_id == Document.id)
+        )
+    return (
+        db.query(SearchHit.id, Document.filename, SearchTerm.term, SearchHit.page_number, JobHit.score,
+                 Document.content_hash, SearchHit.extractor_version, SearchHit.start_offset, SearchHit.end_offset,
+                 SearchHit.excerpt, SearchHit.summary, JobHit.id.label("result_id"))
+        .select_from(JobHit)
+        .join(SearchHit, JobHit.hit_id == SearchHit.id)
+        .join(SearchTerm, SearchHit.term_id == SearchTerm.id)
+        .outerjoin(Document, SearchHit.document_id == Document.id)
+        .filter(JobHit.job_id == job_id)
+    )
+
+def render_query(db, query) -> List[Dict]:
+    """Run a `hit_query` and return its rows as dicts with the excerpt and summary rendered"""
+    hits = [row._asdict() for row in query]
+    for hit, (excerpt, summary) in zip(hits, render_hits(db, hits)):
+        hit['excerpt'] = excerpt
+        hit['summary'] = summary
+    return hits
+
+def get_search_history(db, before_id=None, limit=HISTORY_PAGE_SIZE, search_term=None, document_id=None,
+                       since=None, until=None):
+    """Return one page of saved search hits, newest first, and the cursor for the next page.
+
+    Pages are keyed on SearchHit.id rather than OFFSET, so every page costs
+    the same however deep it is: pass the returned cursor as before_id to get
+    the next one; it is None on the last page. Rows are dicts with id,
+    filename, term, page_number, score, excerpt and summary. Filters match the
+    search term exactly, a document id, and created_at >= since and < until.
+    Results saved by older versions are migrated to hits on this process's
+    first call, so they show up too (see migrate_search_results).
+    """
+    _migrate_legacy_results(db)
+    query = hit_query(db)
+    if before_id is not None:
+        query = query.filter(SearchHit.id < before_id)
+    if search_term:
+        query = query.filter(SearchTerm.term == search_term)
+    if document_id is not None:
+        query = query.filter(SearchHit.document_id == document_id)
+    if since is not None:
+        query = query.filter(SearchHit.created_at >= since)
+    if until is not None:
+        query = query.filter(SearchHit.created_at < until)
+
+    with metrics.span("history_page"):
+        # One extra row tells whether another page follows
+        results = render_query(db, query.order_by(SearchHit.id.desc()).limit(limit + 1))
+    next_before_id = results[limit - 1]['id'] if len(results) > limit else None
+    return results[:limit], next_before_id
+
+def _migrate_legacy_results(db):
+    global _legacy_migrated
+    if _legacy_migrated:
+        return
+    try:
+        if db.query(SearchResult.id).first() is not None:
+            converted, _ = migrate_search_results(db)
+            print(f"Migrated {converted} saved search results to search hits")
+        _legacy_migrated = True
+    except Exception as e:
+        db.rollback()
+        print(f"Error migrating saved search results: {str(e)}")
+
+def migrate_search_results(db, batch_size: int = MIGRATION_BATCH_SIZE, dry_run: bool = False,
+                           backup: Optional[str] = None) -> Tuple[int, int]:
+    """Convert results saved with their excerpt text into hits, deleting them as they go.
+
+    Each excerpt is looked up in the document's stored page text, newest
+    extractor version first, and saved as offsets when found; its summary is
+    dropped when it is the excerpt's first sentence, which is rendered anyway.
+    Excerpts that can't be found (e.g. the page text was never stored) keep
+    their text inline. Batches are committed one at a time and claimed with
+    SKIP LOCKED on Postgres, so several processes can migrate at once.
+
+    With dry_run=True nothing is written. With backup, each batch of results
+    is appended to that JSON lines file before it is deleted. Returns the
+    number of results converted and how many of them kept their excerpt inline.
+    """
+    if dry_run:
+        return _count_convertible(db, batch_size)
+
+    converted = inline = 0
+    backup_file = open(backup, "a", encoding="utf-8") if backup else None
+    try:
+        while True:
+            legacy = (
+                _legacy_query(db)
+                .order_by(SearchResult.id)
+                .with_for_update(skip_locked=True, of=SearchResult)
+                .limit(batch_size)
+                .all()
+            )
+            if not legacy:
+                db.rollback()
+                return converted, inline
+
+            rows = _convert_results(db, legacy)
+            term_ids = get_term_ids(db, [row['term'] for row in rows])
+            for row in rows:
+                row['term_id'] = term_ids[row.pop('term')]
+
+            with metrics.span("migrate_results"):
+                deleted = (
+                    db.query(SearchResult)
+                    .filter(SearchResult.id.in_([row.id for row in legacy]))
+                    .delete(synchronize_session=False)
+                )
+                if deleted < len(legacy):
+                    # Another process migrated some of these first (SQLite can't skip locked rows); read again
+                    db.rollback()
+                    continue
+                last_id = db.query(func.max(SearchHit.id)).scalar() or 0
+                bulk_insert_search_hits(db, rows)
+                # Results of a job stay in its results
+                db.execute(insert(JobHit).from_select(
+                    ["job_id", "hit_id", "score"],
+                    select(SearchHit.job_id, SearchHit.id, SearchHit.score).where(
+                        SearchHit.id > last_id, SearchHit.mode.is_(None), SearchHit.job_id.isnot(None),
+                        ~exists().where(JobHit.hit_id == SearchHit.id)
+                    )
+                ))
+                if backup_file:
+                    _write_backup(backup_file, legacy)
+                db.commit()
+            converted += len(rows)
+            inline += sum(1 for row in rows if row['excerpt'] is not None)
+            metrics.increment("results_migrated", len(rows))
+    finally:
+        if backup_file:
+            backup_file.close()
+
+def _legacy_query(db):
+    return (
+        db.query(SearchResult.id, SearchResult.document_id, SearchResult.search_term, SearchResult.page_number,
+                 SearchResult.excerpt, SearchResult.summary, SearchResult.created_at, SearchResult.job_id,
+                 SearchResult.score, Document.content_hash)
+        .outerjoin(Document, SearchResult.document_id == Document.id)
+    )
+
+def _count_convertible(db, batch_size: int) -> Tuple[int, int]:
+    """Convert every result without writing anything; returns what migrate_search_results would"""
+    converted = inline = 0
+    last_id = 0
+    while True:
+        legacy = _legacy_query(db).filter(SearchResult.id > last_id).order_by(SearchResult.id).limit(batch_size).all()
+        if not legacy:
+            db.rollback()
+            return converted, inline
+        rows = _convert_results(db, legacy)
+        converted += len(rows)
+        inline += sum(1 for row in rows if row['excerpt'] is not None)
+        last_id = legacy[-1].id
+
+def _write_backup(file, legacy):
+    """Append results about to be deleted to a JSON lines file, synced to disk"""
+    for row in legacy:
+        file.write(json.dumps({
+            'id': row.id,
+            'document_id': row.document_id,
+            'search_term': row.search_term,
+            'page_number': row.page_number,
+            'excerpt': row.excerpt,
+            'summary': row.summary,
+            'created_at': row.created_at.isoformat() if row.created_at else None,
+            'job_id': row.job_id,
+            'score': row.score
+        }, ensure_ascii=False))
+        file.write("\n")
+    file.flush()
+    os.fsync(file.fileno())
+
+def _convert_results(db, legacy) -> List[Dict]:
+    """Hit rows for legacy results, with the term instead of its id; excerpts not found in page text stay inline"""
+    keys = list({(row.content_hash, row.page_number - 1) for row in legacy
+                 if row.content_hash and row.page_number is not None})
+    pages = {}
+    for batch_start in range(0, len(keys), RENDER_BATCH_SIZE):
+        stored = (
+            db.query(DocumentPage.content_hash, DocumentPage.page_number, DocumentPage.extractor_version,
+                     DocumentPage.text, DocumentPage.sentence_offsets, DocumentPage.sentence_tokenizer)
+            .filter(tuple_(DocumentPage.content_hash, DocumentPage.page_number)
+                    .in_(keys[batch_start:batch_start + RENDER_BATCH_SIZE]))
+            .all()
+        )
+        for content_hash, page_number, extractor_version, page_text, sentence_offsets, sentence_tokenizer in stored:
+            pages.setdefault((content_hash, page_number), []).append(
+                (extractor_version, page_text or "", unpack_boundaries(sentence_offsets, sentence_tokenizer)))
+
+    rows = []
+    for row in legacy:
+        hit = {
+            'document_id': row.document_id,
+            'term': row.search_term or "",
+            'page_number': row.page_number or 1,
+            'extractor_version': EXTRACTOR_VERSION,
+            'start_offset': 0,
+            'end_offset': 0,
+            'matches': 1,
+            'summary': row.summary,
+            'excerpt': row.excerpt or "",
+            'created_at': row.created_at,
+            'job_id': row.job_id,
+            'score': row.score
+        }
+        # The current extractor's text first, then older versions
+        versions = sorted(pages.get((row.content_hash, (row.page_number or 1) - 1), ()),
+                          key=lambda page: page[0] != EXTRACTOR_VERSION)
+        for extractor_version, page_text, boundaries in versions:
+            start = page_text.find(row.excerpt) if row.excerpt else -1
+            if start < 0:
+                continue
+            end = start + len(row.excerpt)
+            excerpt, first_sentence = render_excerpt(page_text, boundaries, start, end)
+            hit.update(extractor_version=extractor_version, start_offset=start, end_offset=end, excerpt=None,
+                       summary=None if row.summary == first_sentence else row.summary)
+            break
+        rows.append(hit)
+    return rows
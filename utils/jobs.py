@@ -0,0 +1,573 @@
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Sequence, Tuple
+from sqlalchemy import bindparam, insert, select, update
+from utils import metrics
+from utils.database import Document, Job, JobEvent, JobFile, JobHit, SearchHit, get_db_context, upsert_document
+from utils.document_handler import EXTRACT_WORKERS, extract_uploads, is_streamed, iter_document_pages
+from utils.fuzzy_matcher import FuzzyMatcher
+from utils.hits import get_term_ids, hit_counts, hit_query, hit_rows, render_query, save_hits
+from utils.page_store import PageStore, compute_content_hash, get_store_stats
+from utils.ranking import RANK_TOP_K, PageStats
+from utils.search_index import index_pending_pages, search_stored_documents
+from utils.search_memo import SearchMemo
+from utils.summary_cache import get_summary_cache
+from utils.text_processor import NormalizedPage, TermMatcher, search_hits_multi
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+FINISHED = (DONE, FAILED)
+
+# Seconds an idle worker waits before looking for a job again
+JOB_POLL_SECONDS = float(os.getenv("JOB_POLL_SECONDS", "1"))
+
+# A running job's heartbeat is refreshed this often...
+JOB_HEARTBEAT_SECONDS = float(os.getenv("JOB_HEARTBEAT_SECONDS", "15"))
+
+# ...and a job whose heartbeat is older than this is requeued, its worker presumed dead
+JOB_STALE_SECONDS = float(os.getenv("JOB_STALE_SECONDS", "120"))
+
+# Runs of one job before it is failed instead of requeued
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+
+# Run a worker thread inside the app process; set to 0 when worker.py processes run the jobs
+EMBEDDED_WORKER = os.getenv("EMBEDDED_WORKER", "1") != "0"
+
+# Files loaded and extracted together; progress is committed after each file
+JOB_FILES_PER_ROUND = int(os.getenv("JOB_FILES_PER_ROUND", str(max(EXTRACT_WORKERS, 1))))
+
+class JobLost(Exception):
+    """The job was requeued or finished by someone else while this worker ran it"""
+
+def submit_job(db, uploads: Sequence[Tuple[str, bytes]], options: Dict) -> int:
+    """Queue an analysis of (filename, bytes) uploads; returns the job id.
+
+    The files are stored with the job so a worker on any host can run it.
+    options holds the search terms and settings, see run_job.
+    """
+    job = Job(status=QUEUED, options=json.dumps(options), files_total=len(uploads), message="Waiting for a worker")
+    db.add(job)
+    db.flush()
+    db.execute(insert(JobFile), [
+        {"job_id": job.id, "position": position, "filename": filename, "content": content}
+        for position, (filename, content) in enumerate(uploads)
+    ])
+    db.commit()
+    metrics.increment("jobs_submitted")
+    return job.id
+
+def claim_job(db, worker_id: str) -> Optional[int]:
+    """Claim the oldest queued job for this worker; returns its id, or None when the queue is empty.
+
+    On Postgres, FOR UPDATE SKIP LOCKED lets workers pass over rows another
+    worker is claiming instead of waiting for it. SQLite ignores the locking
+    clause; there the conditional UPDATE decides, since only one writer can
+    change the status from queued.
+    """
+    for _ in range(3):
+        job_id = (
+            db.query(Job.id)
+            .filter(Job.status == QUEUED)
+            .order_by(Job.id)
+            .with_for_update(skip_locked=True)
+            .limit(1)
+            .scalar()
+        )
+        if job_id is None:
+            db.rollback()
+            return None
+
+        now = datetime.utcnow()
+        claimed = db.execute(
+            update(Job)
+            .where(Job.id == job_id, Job.status == QUEUED)
+            .values(status=RUNNING, worker=worker_id, started_at=now, heartbeat_at=now,
+                    attempts=Job.attempts + 1, message="Starting")
+        ).rowcount
+        db.commit()
+        if claimed:
+            metrics.increment("jobs_claimed")
+            return job_id
+    return None
+
+def requeue_stale_jobs(db, stale_seconds: float = JOB_STALE_SECONDS) -> int:
+    """Requeue running jobs whose worker stopped sending heartbeats, or fail them after JOB_MAX_ATTEMPTS"""
+    cutoff = datetime.utcnow() - timedelta(seconds=stale_seconds)
+    stale = db.query(Job.id, Job.attempts).filter(Job.status == RUNNING, Job.heartbeat_at < cutoff).all()
+
+    requeued = 0
+    for job_id, attempts in stale:
+        if attempts >= JOB_MAX_ATTEMPTS:
+            values = {"status": FAILED, "finished_at": datetime.utcnow(),
+                      "error": f"Worker stopped responding {attempts} times"}
+        else:
+            values = {"status": QUEUED, "worker": None, "message": "Requeued after its worker stopped responding"}
+        changed = db.execute(
+            update(Job).where(Job.id == job_id, Job.status == RUNNING, Job.heartbeat_at < cutoff).values(**values)
+        ).rowcount
+        if changed:
+            if values["status"] == FAILED:
+                _delete_files(db, job_id)
+            add_event(db, job_id, values.get("error") or values["message"], "error")
+            requeued += 1
+    db.commit()
+    return requeued
+
+def _delete_files(db, job_id: int):
+    """Drop a finished job's uploads; its results point at the stored pages, not at them"""
+    db.query(JobFile).filter(JobFile.job_id == job_id).delete(synchronize_session=False)
+
+def purge_finished_job_files(db) -> int:
+    """Delete uploads still kept for finished jobs, e.g. ones finished by a version that kept them; returns rows deleted"""
+    finished = db.query(Job.id).filter(Job.status.in_(FINISHED))
+    deleted = db.query(JobFile).filter(JobFile.job_id.in_(finished)).delete(synchronize_session=False)
+    db.commit()
+    return deleted
+
+def add_event(db, job_id: int, message: str, level: str = "info"):
+    db.add(JobEvent(job_id=job_id, message=message, level=level))
+
+def _update_job(db, job_id: int, worker_id: str, **values):
+    """Update this worker's running job, refreshing its heartbeat; raises JobLost if it isn't ours any more"""
+    changed = db.execute(
+        update(Job)
+        .where(Job.id == job_id, Job.worker == worker_id, Job.status == RUNNING)
+        .values(heartbeat_at=datetime.utcnow(), **values)
+    ).rowcount
+    if not changed:
+        raise JobLost(f"Job {job_id} is no longer assigned to {worker_id}")
+
+def _heartbeat(job_id: int, worker_id: str, stop: threading.Event):
+    # Keeps the job alive through long steps, such as extracting one huge file
+    while not stop.wait(JOB_HEARTBEAT_SECONDS):
+        try:
+            with get_db_context() as db:
+                db.execute(
+                    update(Job)
+                    .where(Job.id == job_id, Job.worker == worker_id, Job.status == RUNNING)
+                    .values(heartbeat_at=datetime.utcnow())
+                )
+                db.commit()
+        except Exception as e:
+            print(f"Error updating heartbeat of job {job_id}: {str(e)}")
+
+def run_job(job_id: int, worker_id: str, executor: Optional[ProcessPoolExecutor] = None):
+    """Run a claimed job to completion, recording progress as it goes.
+
+    Files are extracted with executor when given, e.g. the worker's own pool
+    (see work), and otherwise with a pool started for each round of files.
+
+    options: terms (list), fuzzy, stem, include_history, ai_excerpt_summaries,
+    rank and top_k. Without rank, every hit is saved with the job's id as
+    each file finishes, so results can be shown while the job runs, and BM25
+    scores are filled in at the end. With rank (RANK_PER_TERM or
+    RANK_OVERALL), hits are only kept in the search memo at first; once all
+    pages are scored, hits are saved for the top_k best pages alone. AI
+    excerpt summaries are written last, for the hits that were kept. Files
+    are only scanned for terms that weren't searched in them before, and
+    hits stored by earlier searches are linked to the job instead of copied.
+    """
+    from utils.summarizer import BatchSummarizer, TextSummarizer
+
+    stop = threading.Event()
+    heartbeat = threading.Thread(target=_heartbeat, args=(job_id, worker_id, stop), daemon=True)
+    heartbeat.start()
+    try:
+        with get_db_context() as db, metrics.record_run() as run_timings, metrics.span("job"):
+            job = db.get(Job, job_id)
+            options = json.loads(job.options)
+            terms = options["terms"]
+            if options.get("fuzzy"):
+                matcher = FuzzyMatcher(terms, stem=options.get("stem", False))
+            else:
+                matcher = TermMatcher(terms)
+            rank = options.get("rank")
+            term_ids = get_term_ids(db, matcher.terms)
+            page_stats = PageStats(matcher.terms)
+            memo = SearchMemo(db, matcher)
+            # Document id -> content hash, to look up the hits on the pages picked by the ranking
+            documents = {}
+
+            # Drop results of an earlier attempt that didn't finish; the hits themselves stay for reuse
+            db.query(JobHit).filter(JobHit.job_id == job_id).delete(synchronize_session=False)
+            files = (
+                db.query(JobFile.id, JobFile.filename)
+                .filter(JobFile.job_id == job_id)
+                .order_by(JobFile.position)
+                .all()
+            )
+            _update_job(db, job_id, worker_id, files_done=0, files_total=len(files), message="Analyzing documents")
+            db.commit()
+
+            content_hashes = _analyze_files(db, job_id, worker_id, files, memo, term_ids, page_stats, documents, rank,
+                                            executor)
+
+            history = {}
+            if options.get("include_history"):
+                _update_job(db, job_id, worker_id, message="Searching previously analyzed documents")
+                db.commit()
+                history = _search_history(db, job_id, matcher, content_hashes, term_ids, page_stats, rank)
+
+            _update_job(db, job_id, worker_id, message="Ranking results")
+            db.commit()
+            if rank:
+                _save_ranked(db, job_id, memo, term_ids, page_stats, documents, history,
+                             options.get("top_k", RANK_TOP_K), rank)
+            else:
+                _save_scores(db, job_id, term_ids, page_stats)
+
+            _update_job(db, job_id, worker_id, message="Summarizing results")
+            db.commit()
+            if options.get("ai_excerpt_summaries"):
+                _summarize_hits(db, job_id, BatchSummarizer())
+            # The summary covers every saved result, most relevant first
+            results = get_job_results(db, job_id, ranked=True)
+            summary = TextSummarizer().summarize_search_results(results) if results else None
+
+            stats = {
+                "timings": run_timings.by_document(),
+                "page_store": get_store_stats(),
+                "summary_cache": get_summary_cache().stats()
+            }
+            _update_job(db, job_id, worker_id, status=DONE, finished_at=datetime.utcnow(),
+                        summary=summary, stats=json.dumps(stats), message="Finished")
+            _delete_files(db, job_id)
+            db.commit()
+            metrics.increment("jobs_finished", status=DONE)
+    except JobLost as e:
+        print(f"Stopped job {job_id}: {str(e)}")
+    except Exception as e:
+        print(f"Error running job {job_id}: {str(e)}")
+        metrics.increment("jobs_finished", status=FAILED)
+        try:
+            with get_db_context() as db:
+                failed = db.execute(
+                    update(Job)
+                    .where(Job.id == job_id, Job.worker == worker_id, Job.status == RUNNING)
+                    .values(status=FAILED, finished_at=datetime.utcnow(), error=str(e), message="Failed")
+                ).rowcount
+                if failed:
+                    _delete_files(db, job_id)
+                add_event(db, job_id, f"Job failed: {str(e)}", "error")
+                db.commit()
+        except Exception as db_error:
+            print(f"Error recording failure of job {job_id}: {str(db_error)}")
+    finally:
+        stop.set()
+        heartbeat.join()
+
+def _analyze_files(db, job_id: int, worker_id: str, files, memo: SearchMemo, term_ids: Dict[str, int],
+                   page_stats: PageStats, documents: Dict[int, str], rank: Optional[str],
+                   executor: Optional[ProcessPoolExecutor] = None) -> List[str]:
+    """Extract (or load stored pages for) and search each file, adding its pages to page_stats.
+
+    Unranked, each file's hits are saved right away; ranked, they are only
+    counted. Large text uploads are extracted, stored and searched a page at
+    a time. Returns the content hashes analyzed.
+    """
+    matcher = memo.matcher
+    page_store = PageStore(db)
+    content_hashes = []
+    done = 0
+
+    for round_start in range(0, len(files), JOB_FILES_PER_ROUND):
+        batch = files[round_start:round_start + JOB_FILES_PER_ROUND]
+        # Load only this round's uploads, so memory doesn't grow with the job's size
+        contents = dict(db.query(JobFile.id, JobFile.content).filter(JobFile.id.in_([f.id for f in batch])).all())
+
+        pages_by_file = []
+        for file in batch:
+            with metrics.document_context(file.filename):
+                with metrics.span("hash_upload"):
+                    content_hash = compute_content_hash(contents[file.id])
+                pages_by_file.append([content_hash, page_store.get_pages(content_hash), None])
+
+        # Extract the remaining files together so they spread across worker processes
+        missing = [i for i, (_, pages, _) in enumerate(pages_by_file) if pages is None]
+        streamed = {i: contents[batch[i].id] for i in missing if is_streamed(contents[batch[i].id], batch[i].filename)}
+        missing = [i for i in missing if i not in streamed]
+        extracted = extract_uploads([(batch[i].filename, contents[batch[i].id]) for i in missing], executor=executor)
+        del contents
+        for i, (text_by_page, error) in zip(missing, extracted):
+            if error:
+                pages_by_file[i][2] = error
+                continue
+            with metrics.document_context(batch[i].filename):
+                # Sentence boundaries are computed once here, stored, and reused by the search
+                pages = {n: NormalizedPage(t) for n, t in text_by_page.items()}
+                page_store.put(pages_by_file[i][0], pages)
+            pages_by_file[i][1] = pages
+
+        for i, (file, (content_hash, pages, error)) in enumerate(zip(batch, pages_by_file)):
+            with metrics.document_context(file.filename):
+                if i in streamed:
+                    try:
+                        hits_by_term, pages = _store_stream(page_store, memo, file.filename, content_hash, streamed.pop(i))
+                    except Exception as e:
+                        error = e
+                else:
+                    hits_by_term = None
+                if error:
+                    add_event(db, job_id, f"Error processing {file.filename}: {str(error)}", "error")
+                else:
+                    document_id = upsert_document(db, file.filename, len(pages), content_hash)
+                    documents[document_id] = content_hash
+                    if hits_by_term is None:
+                        hits_by_term, _ = memo.search(content_hash, pages)
+                    page_stats.add_pages(document_id, pages, hit_counts(hits_by_term))
+                    if not rank:
+                        save_hits(db, hit_rows(hits_by_term, matcher.terms, term_ids, document_id, job_id,
+                                               page_store.extractor_version, mode=matcher.mode), job_id)
+                    content_hashes.append(content_hash)
+            done += 1
+            _update_job(db, job_id, worker_id, files_done=done, message=f"Analyzed {file.filename}")
+            db.commit()
+
+    return content_hashes
+
+def _store_stream(page_store: PageStore, memo: SearchMemo, filename: str, content_hash: str, content: bytes):
+    """Extract, store and search an upload a page at a time; returns its hits by term and page number -> length"""
+    hits_by_term = {}
+    page_lengths = {}
+    pages = ((page_num, NormalizedPage(text)) for page_num, text in iter_document_pages(content, filename))
+    for page_num, page, page_hits in memo.search_stream(content_hash, page_store.store_pages(content_hash, pages)):
+        page_lengths[page_num] = len(page.text)
+        for term, windows in page_hits.items():
+            hits_by_term.setdefault(term, {})[page_num] = windows
+    return hits_by_term, page_lengths
+
+def _search_history(db, job_id: int, matcher: TermMatcher, exclude_hashes: List[str], term_ids: Dict[str, int],
+                    page_stats: PageStats, rank: Optional[str]) -> Dict[int, Dict]:
+    """Search previously analyzed documents, adding all of their pages to page_stats.
+
+    Every stored page counts towards the document frequencies and the average
+    page length, with hits or not; only its length is read for that. Unranked,
+    the hits are saved for this job; ranked, they are returned by document id
+    for _save_ranked to pick from.
+    """
+    stored_results = search_stored_documents(db, matcher, exclude_hashes=exclude_hashes, hits=True)
+    document_ids = dict(db.query(Document.content_hash, Document.id).all())
+    lengths_by_file = {}
+    for content_hash, page_num, length in PageStore(db).page_lengths(exclude_hashes):
+        if content_hash in document_ids:
+            lengths_by_file.setdefault(content_hash, {})[page_num] = length
+
+    history = {}
+    rows = []
+    for content_hash, page_lengths in lengths_by_file.items():
+        document_id = document_ids[content_hash]
+        hits_by_term = stored_results.get(content_hash, {})
+        page_stats.add_pages(document_id, page_lengths, hit_counts(hits_by_term))
+        if not hits_by_term:
+            continue
+
+        if rank:
+            history[document_id] = hits_by_term
+        else:
+            rows.extend(hit_rows(hits_by_term, matcher.terms, term_ids, document_id, job_id, mode=matcher.mode))
+
+    save_hits(db, rows, job_id, commit_per_batch=True)
+    db.commit()
+    return history
+
+def _save_ranked(db, job_id: int, memo: SearchMemo, term_ids: Dict[str, int], page_stats: PageStats,
+                 documents: Dict[int, str], history: Dict[int, Dict], top_k: Optional[int], rank: str):
+    """Save hits for the best pages only, with their scores, taking them from the search memo"""
+    matcher = memo.matcher
+    selected = {}
+    for (document_id, page_num), term, score in page_stats.top(top_k, rank):
+        selected.setdefault(document_id, {})[(term, page_num)] = score
+
+    page_store = PageStore(db)
+    rows = []
+    for document_id, scores in selected.items():
+        if document_id in history:
+            hits_by_term = history[document_id]
+        else:
+            hits_by_term = memo.lookup(documents[document_id])
+        if hits_by_term is None:
+            # Not memoized, e.g. a concurrent version bump; search the selected pages again
+            pages = page_store.get_pages(documents[document_id])
+            page_nums = {page_num for _, page_num in scores}
+            hits_by_term = search_hits_multi({n: pages[n] for n in sorted(page_nums)}, matcher)
+        rows.extend(hit_rows(hits_by_term, matcher.terms, term_ids, document_id, job_id,
+                             page_store.extractor_version, scores, matcher.mode))
+
+    # Best first, like the ranking, so result ids follow relevance
+    rows.sort(key=lambda row: -row['score'])
+    save_hits(db, rows, job_id, commit_per_batch=True)
+    db.commit()
+
+def _save_scores(db, job_id: int, term_ids: Dict[str, int], page_stats: PageStats):
+    """Fill in the BM25 score of every hit saved unranked"""
+    scored = page_stats.top(None)
+    if not scored:
+        return
+    hits = SearchHit.__table__
+    links = JobHit.__table__
+    db.execute(
+        update(links)
+        .where(
+            links.c.job_id == bindparam('b_job_id'),
+            links.c.hit_id.in_(
+                select(hits.c.id).where(
+                    hits.c.term_id == bindparam('b_term_id'),
+                    hits.c.document_id == bindparam('b_document_id'),
+                    hits.c.page_number == bindparam('b_page')
+                )
+            )
+        )
+        .values(score=bindparam('b_score')),
+        [
+            {'b_job_id': job_id, 'b_term_id': term_ids[term], 'b_document_id': document_id, 'b_page': page_num + 1,
+             'b_score': score}
+            for (document_id, page_num), term, score in scored
+        ]
+    )
+    db.commit()
+
+def _summarize_hits(db, job_id: int, summarizer):
+    """Replace the job's first-sentence summaries with AI summaries, summarizing each distinct excerpt once.
+
+    Hits that already have an AI summary, e.g. from an earlier job, keep it.
+    Hits are shared between jobs, so excerpts that couldn't be summarized
+    (an API error, or no API key) keep no summary and are tried again by
+    later jobs, instead of showing the error message everywhere.
+    """
+    from utils.summarizer import API_KEY_MISSING_MESSAGE
+
+    hits = render_query(db, hit_query(db, job_id).filter(SearchHit.summary.is_(None)))
+    if not hits:
+        return
+    excerpts = list(dict.fromkeys(hit['excerpt'] for hit in hits))
+    summaries = {}
+    for index, summary in summarizer.summarize_many(excerpts):
+        if summary != API_KEY_MISSING_MESSAGE:
+            summaries[excerpts[index]] = summary
+    for index in summarizer.errors:
+        summaries.pop(excerpts[index], None)
+    rows = [{'b_id': hit['id'], 'b_summary': summaries[hit['excerpt']]} for hit in hits if hit['excerpt'] in summaries]
+    if not rows:
+        return
+    table = SearchHit.__table__
+    db.execute(update(table).where(table.c.id == bindparam('b_id')).values(summary=bindparam('b_summary')), rows)
+    db.commit()
+
+def get_job(db, job_id: int) -> Optional[Job]:
+    return db.get(Job, job_id)
+
+def get_job_events(db, job_id: int, level: Optional[str] = None) -> List[JobEvent]:
+    query = db.query(JobEvent).filter(JobEvent.job_id == job_id)
+    if level:
+        query = query.filter(JobEvent.level == level)
+    return query.order_by(JobEvent.id).all()
+
+def get_job_results(db, job_id: int, after_id: int = 0, limit: Optional[int] = None, ranked: bool = False) -> List[Dict]:
+    """Return a job's saved hits as display rows, in the order they were found or, with ranked, best first.
+
+    Excerpts and summaries are rendered from the stored page text. Pass the
+    last seen row's "id" as after_id to fetch only newer results.
+    """
+    query = hit_query(db, job_id).filter(JobHit.id > after_id)
+    if ranked:
+        query = query.order_by(JobHit.score.desc().nullslast(), JobHit.id)
+    else:
+        query = query.order_by(JobHit.id)
+    if limit:
+        query = query.limit(limit)
+    return [
+        {'id': hit['result_id'], 'Document': hit['filename'], 'Search Term': hit['term'], 'Page': hit['page_number'],
+         'Excerpt': hit['excerpt'], 'Summary': hit['summary'], 'Score': hit['score']}
+        for hit in render_query(db, query)
+    ]
+
+def work(worker_id: Optional[str] = None, once: bool = False, poll_seconds: float = JOB_POLL_SECONDS,
+         stop: Optional[threading.Event] = None) -> int:
+    """Claim and run jobs until stopped; with once=True, return when the queue is empty. Returns jobs run.
+
+    Every job is extracted with one pool of EXTRACT_WORKERS processes, started
+    with the worker, so each round of files doesn't pay for starting them.
+    """
+    worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+    try:
+        with get_db_context() as db:
+            purged = purge_finished_job_files(db)
+        if purged:
+            print(f"Deleted {purged} uploads of finished jobs")
+    except Exception as e:
+        print(f"Error deleting uploads of finished jobs: {str(e)}")
+
+    ran = 0
+    executor = _start_extraction_pool()
+    try:
+        while stop is None or not stop.is_set():
+            job_id = None
+            try:
+                with get_db_context() as db:
+                    requeue_stale_jobs(db)
+                    job_id = claim_job(db, worker_id)
+            except Exception as e:
+                print(f"Error claiming a job: {str(e)}")
+
+            if job_id is None:
+                if _backfill_index():
+                    # Keep indexing between polls until every stored page is indexed
+                    continue
+                if once:
+                    break
+                if stop is not None:
+                    stop.wait(poll_seconds)
+                else:
+                    time.sleep(poll_seconds)
+                continue
+
+            if executor is not None:
+                try:
+                    executor.submit(int).result()
+                except BrokenProcessPool:
+                    # A worker process died, e.g. killed for memory; the pool can't be used again
+                    print("Extraction worker processes crashed; starting new ones")
+                    executor.shutdown(wait=False)
+                    executor = _start_extraction_pool()
+            run_job(job_id, worker_id, executor)
+            ran += 1
+            # Publish metrics for a textfile collector when METRICS_FILE is set
+            metrics.write_metrics_file()
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+    return ran
+
+def _start_extraction_pool() -> Optional[ProcessPoolExecutor]:
+    # 0 or 1 extracts serially in-process, as extract_documents does
+    return ProcessPoolExecutor(max_workers=EXTRACT_WORKERS) if EXTRACT_WORKERS > 1 else None
+
+def _backfill_index() -> int:
+    """Index a batch of stored pages that predate the full-text index; returns how many were indexed"""
+    try:
+        with get_db_context() as db:
+            indexed = index_pending_pages(db)
+            db.commit()
+        return indexed
+    except Exception as e:
+        print(f"Error indexing stored pages: {str(e)}")
+        return 0
+
+_embedded_worker = None
+
+def start_embedded_worker() -> threading.Thread:
+    """Run a worker in a background thread of this process, once; for single-process deployments"""
+    global _embedded_worker
+    if _embedded_worker is None:
+        _embedded_worker = threading.Thread(target=work, name="embedded-job-worker", daemon=True)
+        _embedded_worker.start()
+    return _embedded_worker
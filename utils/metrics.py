@@ -0,0 +1,197 @@
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional
+
+logger = logging.getLogger("docsearch.metrics")
+
+# Set METRICS_LOG=1 to print one JSON line per span to stderr without configuring logging
+if os.getenv("METRICS_LOG") and not logger.handlers:
+    logger.addHandler(logging.StreamHandler())
+    logger.setLevel(logging.INFO)
+
+# When set, write_metrics_file() writes Prometheus text exposition format here
+METRICS_FILE = os.getenv("METRICS_FILE")
+
+# When set, start_metrics_server() serves /metrics on this port
+METRICS_PORT = os.getenv("METRICS_PORT")
+
+_lock = threading.Lock()
+_stage_totals = {}  # (stage, labels) -> [count, total seconds]
+_counters = {}  # (name, labels) -> value
+_gauges = {}  # name -> callable returning [(labels, value)]
+
+_current_run = contextvars.ContextVar("current_run", default=None)
+_current_document = contextvars.ContextVar("current_document", default=None)
+
+class RunTimings:
+    """Per-document, per-stage totals for one analysis run, for the in-app performance breakdown"""
+
+    def __init__(self):
+        self.totals = {}  # document -> stage -> [count, seconds]
+
+    def add(self, stage: str, seconds: float, document: Optional[str]):
+        stages = self.totals.setdefault(document or "(all documents)", {})
+        totals = stages.setdefault(stage, [0, 0.0])
+        totals[0] += 1
+        totals[1] += seconds
+
+    def by_document(self) -> Dict[str, Dict[str, float]]:
+        """Return document -> stage -> total seconds"""
+        return {
+            document: {stage: totals[1] for stage, totals in stages.items()}
+            for document, stages in self.totals.items()
+        }
+
+def _label_key(labels: dict) -> tuple:
+    return tuple(sorted((k, str(v)) for k, v in labels.items() if v is not None))
+
+def observe(stage: str, seconds: float, document: Optional[str] = None, log: bool = True, **labels):
+    """Record a finished stage: aggregate metrics, a structured log line and the current run, if any.
+
+    `document` defaults to the one set by document_context(); it goes to logs
+    and the run breakdown only, keeping metric label cardinality low. Pass
+    log=False for hot paths that run once per hit.
+    """
+    document = document or _current_document.get()
+    key = (stage, _label_key(labels))
+    with _lock:
+        totals = _stage_totals.setdefault(key, [0, 0.0])
+        totals[0] += 1
+        totals[1] += seconds
+
+    run = _current_run.get()
+    if run is not None:
+        run.add(stage, seconds, document)
+
+    if log and logger.isEnabledFor(logging.INFO):
+        logger.info(json.dumps({"event": "stage", "stage": stage, "seconds": round(seconds, 6),
+                                "document": document, **labels}))
+
+@contextmanager
+def span(stage: str, document: Optional[str] = None, log: bool = True, **labels):
+    """Time the enclosed block as one pipeline stage"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - start, document, log, **labels)
+
+def increment(name: str, amount: float = 1, **labels):
+    """Add to a counter"""
+    key = (name, _label_key(labels))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+def register_gauge(name: str, read):
+    """Report the current values of read(), a list of (labels, value), each time metrics are rendered"""
+    with _lock:
+        _gauges[name] = read
+
+@contextmanager
+def document_context(document: str):
+    """Attribute spans recorded inside the block to a document"""
+    token = _current_document.set(document)
+    try:
+        yield
+    finally:
+        _current_document.reset(token)
+
+@contextmanager
+def record_run():
+    """Collect every span recorded in this thread inside the block into a RunTimings"""
+    run = RunTimings()
+    token = _current_run.set(run)
+    try:
+        yield run
+    finally:
+        _current_run.reset(token)
+
+def _format_labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        f'{k}="' + v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+        for k, v in labels
+    )
+    return "{" + ",".join(escaped) + "}"
+
+def render_prometheus() -> str:
+    """Render all metrics in Prometheus text exposition format"""
+    with _lock:
+        stage_totals = sorted(_stage_totals.items())
+        counters = sorted(_counters.items())
+        gauges = sorted(_gauges.items())
+
+    lines = [
+        "# HELP docsearch_stage_seconds Time spent in each pipeline stage.",
+        "# TYPE docsearch_stage_seconds summary"
+    ]
+    for (stage, labels), (count, total) in stage_totals:
+        label_text = _format_labels((("stage", stage),) + labels)
+        lines.append(f"docsearch_stage_seconds_count{label_text} {count}")
+        lines.append(f"docsearch_stage_seconds_sum{label_text} {total:.6f}")
+
+    names = []
+    for (name, _), _ in counters:
+        if name not in names:
+            names.append(name)
+    for name in names:
+        lines.append(f"# TYPE docsearch_{name}_total counter")
+        for (counter_name, labels), value in counters:
+            if counter_name == name:
+                lines.append(f"docsearch_{name}_total{_format_labels(labels)} {value:g}")
+
+    for name, read in gauges:
+        try:
+            values = read()
+        except Exception as e:
+            print(f"Error reading metric {name}: {str(e)}")
+            continue
+        lines.append(f"# TYPE docsearch_{name} gauge")
+        for labels, value in values:
+            lines.append(f"docsearch_{name}{_format_labels(_label_key(labels))} {value:g}")
+
+    return "\n".join(lines) + "\n"
+
+def write_metrics_file(path: Optional[str] = METRICS_FILE):
+    """Write current metrics to a file for a node exporter textfile collector or similar"""
+    if not path:
+        return
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as file:
+        file.write(render_prometheus())
+    os.replace(tmp_path, path)
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render_prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+_server = None
+
+def start_metrics_server(port: Optional[str] = METRICS_PORT) -> Optional[int]:
+    """Serve /metrics from a background thread, once per process; returns the port or None when disabled"""
+    global _server
+    if not port:
+        return None
+    with _lock:
+        if _server is None:
+            _server = ThreadingHTTPServer(("0.0.0.0", int(port)), _MetricsRequestHandler)
+            threading.Thread(target=_server.serve_forever, daemon=True).start()
+    return _server.server_port
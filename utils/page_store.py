@@ -0,0 +1,174 @@
+import hashlib
+import threading
+from typing import Dict, Iterable, Iterator, Optional, Tuple
+from sqlalchemy import bindparam, func, insert, update
+from sqlalchemy.exc import IntegrityError
+from utils import metrics
+from utils.database import DocumentPage
+from utils.document_handler import EXTRACTOR_VERSION
+from utils.search_index import index_document_pages, init_search_index
+from utils.text_processor import NormalizedPage, pack_boundaries, sentence_boundaries, tokenizer_name, unpack_boundaries
+
+# Pages inserted per statement when storing a stream of pages
+PAGE_BATCH_SIZE = 200
+
+# Hit/miss counters shared by every store in this process
+_stats = {"hits": 0, "misses": 0}
+_stats_lock = threading.Lock()
+
+def compute_content_hash(data: bytes) -> str:
+    """Return the SHA-256 hex digest identifying a file's contents"""
+    return hashlib.sha256(data).hexdigest()
+
+def get_store_stats() -> Dict[str, float]:
+    """Return page store hit/miss counters and the hit rate"""
+    with _stats_lock:
+        hits, misses = _stats["hits"], _stats["misses"]
+    total = hits + misses
+    return {"hits": hits, "misses": misses, "hit_rate": hits / total if total else 0.0}
+
+def _record(outcome: str):
+    with _stats_lock:
+        _stats[outcome] += 1
+    metrics.increment(f"page_store_{outcome}")
+
+class PageStore:
+    """Persistent store of extracted page text keyed by file content hash and extractor version"""
+
+    def __init__(self, db, extractor_version: str = EXTRACTOR_VERSION):
+        self.db = db
+        self.extractor_version = extractor_version
+        # Create the index up front; on SQLite its DDL would block on this session's own write lock
+        init_search_index()
+
+    def get_pages(self, content_hash: str) -> Optional[Dict[int, NormalizedPage]]:
+        """Load all stored pages of a file in one query, or None if it was never extracted.
+
+        Pages come ready to search, with their stored sentence boundaries.
+        Pages stored before boundaries were kept, or tokenized by another
+        tokenizer, are tokenized once here and their boundaries written back.
+        """
+        with metrics.span("page_store_load"):
+            rows = (
+                self.db.query(DocumentPage.id, DocumentPage.page_number, DocumentPage.text, DocumentPage.sentence_offsets,
+                              DocumentPage.sentence_tokenizer)
+                .filter(
+                    DocumentPage.content_hash == content_hash,
+                    DocumentPage.extractor_version == self.extractor_version
+                )
+                .order_by(DocumentPage.page_number)
+                .all()
+            )
+        if not rows:
+            _record("misses")
+            return None
+
+        _record("hits")
+        pages = {}
+        backfill = []
+        tokenizer = tokenizer_name()
+        for page_id, page_number, page_text, sentence_offsets, sentence_tokenizer in rows:
+            boundaries = unpack_boundaries(sentence_offsets, sentence_tokenizer)
+            page = NormalizedPage(page_text or "", boundaries)
+            if boundaries is None:
+                backfill.append({"page_id": page_id, "sentence_offsets": pack_boundaries(page.boundaries),
+                                 "sentence_tokenizer": tokenizer})
+            pages[page_number] = page
+
+        if backfill:
+            # Core executemany, since an ORM bulk update takes its keys from the rows themselves
+            table = DocumentPage.__table__
+            self.db.connection().execute(
+                update(table).where(table.c.id == bindparam("page_id"))
+                .values(sentence_offsets=bindparam("sentence_offsets"), sentence_tokenizer=bindparam("sentence_tokenizer")),
+                backfill
+            )
+        return pages
+
+    def page_lengths(self, exclude_hashes: Iterable[str] = ()) -> Iterator[Tuple[str, int, int]]:
+        """Yield (content hash, page number, length) of every stored page, measured by the database.
+
+        The page text itself is not loaded, so this is cheap enough to cover
+        every stored file, e.g. for ranking statistics.
+        """
+        query = (
+            self.db.query(DocumentPage.content_hash, DocumentPage.page_number,
+                          func.coalesce(func.length(DocumentPage.text), 0))
+            .filter(DocumentPage.extractor_version == self.extractor_version)
+        )
+        excluded = list(exclude_hashes)
+        if excluded:
+            query = query.filter(DocumentPage.content_hash.notin_(excluded))
+        with metrics.span("page_store_lengths"):
+            yield from query.order_by(DocumentPage.content_hash, DocumentPage.page_number).yield_per(PAGE_BATCH_SIZE * 50)
+
+    def put(self, content_hash: str, text_by_page: Dict[int, str]):
+        """Store and index extracted pages; a concurrent store of the same file is ignored.
+
+        Values may be `NormalizedPage`s, whose sentence boundaries are stored and
+        stay cached on the page for searching it afterwards.
+        """
+        for _ in self.store_pages(content_hash, text_by_page.items()):
+            pass
+
+    def store_pages(self, content_hash: str, pages: Iterable[Tuple[int, str]],
+                    batch_size: int = PAGE_BATCH_SIZE) -> Iterator[Tuple[int, str]]:
+        """Store and index a stream of (page number, text) pairs in batches, passing each page through.
+
+        Lets callers search pages while they are being extracted and written,
+        holding only one batch in memory.
+        """
+        batch = []
+        storing = True
+        complete = False
+
+        try:
+            for page in pages:
+                batch.append(page)
+                if len(batch) >= batch_size:
+                    storing = storing and self._insert_batch(content_hash, batch)
+                    yield from batch
+                    batch = []
+
+            if batch:
+                if storing:
+                    self._insert_batch(content_hash, batch)
+                yield from batch
+            complete = True
+        finally:
+            # A partly stored file would look like a complete one to get_pages()
+            if not complete and storing:
+                self.discard(content_hash)
+
+    def discard(self, content_hash: str):
+        """Remove all stored pages of a file"""
+        self.db.query(DocumentPage).filter(
+            DocumentPage.content_hash == content_hash,
+            DocumentPage.extractor_version == self.extractor_version
+        ).delete(synchronize_session=False)
+
+    def _insert_batch(self, content_hash: str, batch) -> bool:
+        """Insert one batch of pages; returns False if another writer already stored this file"""
+        rows = []
+        tokenizer = tokenizer_name()
+        for page_number, page in batch:
+            if isinstance(page, NormalizedPage):
+                page_text, boundaries = page.text, page.boundaries
+            else:
+                page_text, boundaries = page, sentence_boundaries(page or "")
+            rows.append({
+                "content_hash": content_hash,
+                "extractor_version": self.extractor_version,
+                "page_number": page_number,
+                "text": page_text,
+                "sentence_offsets": pack_boundaries(boundaries),
+                "sentence_tokenizer": tokenizer
+            })
+        try:
+            # Savepoint so a duplicate insert doesn't discard the caller's pending work
+            with metrics.span("page_store_write"), self.db.begin_nested():
+                self.db.execute(insert(DocumentPage), rows)
+                index_document_pages(self.db, content_hash, self.extractor_version)
+        except IntegrityError:
+            return False
+        return True
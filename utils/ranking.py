@@ -0,0 +1,121 @@
+import os
+from array import array
+from typing import Dict, Hashable, Iterable, List, Optional, Tuple
+from utils import metrics
+
+# BM25 term frequency saturation
+BM25_K1 = float(os.getenv("BM25_K1", "1.2"))
+
+# BM25 length normalization; 0 ignores page length, 1 normalizes fully
+BM25_B = float(os.getenv("BM25_B", "0.75"))
+
+# Pages kept per term, or overall, when results are ranked
+RANK_TOP_K = int(os.getenv("RANK_TOP_K", "20"))
+
+# Ranking modes: the best pages for each term, or the best pages for all terms together
+RANK_PER_TERM = "term"
+RANK_OVERALL = "overall"
+
+class PageStats:
+    """Term frequencies and lengths of a set of pages, kept compact for vectorized BM25 scoring.
+
+    Every searched page is added, including pages without hits, since they
+    count towards the document frequencies and the average page length.
+    Hits are stored sparsely as parallel arrays of (page, term, count), one
+    entry per page and term with at least one match. Page length is measured
+    in characters, which BM25's length normalization only uses relatively.
+    """
+
+    def __init__(self, terms: Iterable[str]):
+        self.terms = list(terms)
+        self._term_ids = {term: term_id for term_id, term in enumerate(self.terms)}
+        self.keys: List[Hashable] = []
+        self._lengths = array('l')
+        self._hit_pages = array('l')
+        self._hit_terms = array('l')
+        self._hit_counts = array('l')
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add_page(self, key: Hashable, length: int, counts: Dict[str, int]):
+        """Add one page under a caller-chosen key, e.g. (document id, page number), with its match count per term"""
+        page = len(self.keys)
+        self.keys.append(key)
+        self._lengths.append(length)
+        for term, count in counts.items():
+            if count:
+                self._hit_pages.append(page)
+                self._hit_terms.append(self._term_ids[term])
+                self._hit_counts.append(count)
+
+    def add_pages(self, key_prefix: Hashable, pages: Dict, results_by_term: Dict[str, Dict[int, object]]):
+        """Add a document's pages from search results: term -> {page number: contexts, or a match count}.
+
+        pages maps page number to the page, its text, or just its length.
+        """
+        for page_num, page in pages.items():
+            counts = {}
+            for term, term_pages in results_by_term.items():
+                hits = term_pages.get(page_num)
+                if hits:
+                    counts[term] = hits if isinstance(hits, int) else len(hits)
+            length = page if isinstance(page, int) else len(getattr(page, 'text', page))
+            self.add_page((key_prefix, page_num), length, counts)
+
+    def scores(self, k1: float = BM25_K1, b: float = BM25_B):
+        """Return (page indexes, term ids, BM25 scores) as NumPy arrays, one entry per page and term with hits"""
+        import numpy as np
+
+        # The arrays are shared with NumPy through the buffer protocol, not copied
+        pages = np.asarray(self._hit_pages)
+        terms = np.asarray(self._hit_terms)
+        counts = np.asarray(self._hit_counts).astype(np.float64)
+        lengths = np.asarray(self._lengths).astype(np.float64)
+        if not len(pages):
+            return pages, terms, counts
+
+        page_count = len(lengths)
+        average_length = lengths.mean() or 1.0
+        document_frequency = np.bincount(terms, minlength=len(self.terms))
+        idf = np.log((page_count - document_frequency + 0.5) / (document_frequency + 0.5) + 1.0)
+        length_norm = k1 * (1.0 - b + b * lengths[pages] / average_length)
+        return pages, terms, idf[terms] * counts * (k1 + 1.0) / (counts + length_norm)
+
+    def top(self, k: Optional[int] = RANK_TOP_K, mode: str = RANK_PER_TERM,
+            k1: float = BM25_K1, b: float = BM25_B) -> List[Tuple[Hashable, str, float]]:
+        """Return (page key, term, score) for the best pages, best first.
+
+        With mode RANK_PER_TERM, the k best pages are kept for each term and a
+        result's score is its term's BM25 score on the page. With RANK_OVERALL,
+        pages are scored by the sum over all terms, the k best pages are kept
+        with every term that matched on them, and each result carries the page's
+        total. k=None keeps every page.
+        """
+        import numpy as np
+
+        with metrics.span("rank"):
+            pages, terms, scores = self.scores(k1, b)
+            if not len(pages):
+                return []
+
+            if mode == RANK_OVERALL:
+                totals = np.bincount(pages, weights=scores, minlength=len(self.keys))
+                scores = totals[pages]
+                # Best page first, then term order within a page
+                order = np.lexsort((terms, pages, -scores))
+                if k is not None:
+                    best_pages = np.argsort(-totals, kind='stable')[:k]
+                    best_pages = best_pages[totals[best_pages] > 0]
+                    order = order[np.isin(pages[order], best_pages)]
+            else:
+                # Group by term, best score first within each term
+                order = np.lexsort((-scores, terms))
+                if k is not None:
+                    sorted_terms = terms[order]
+                    rank = np.arange(len(order)) - np.searchsorted(sorted_terms, sorted_terms, side='left')
+                    order = order[rank < k]
+                order = order[np.argsort(-scores[order], kind='stable')]
+
+        return [(self.keys[page], self.terms[term], float(score))
+                for page, term, score in zip(pages[order].tolist(), terms[order].tolist(), scores[order].tolist())]
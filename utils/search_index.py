@@ -0,0 +1,359 @@
+from typing import Dict, Iterable, List, Optional
+from sqlalchemy import bindparam, inspect, text
+from utils import metrics
+import threading
+from utils.database import get_engine, init_db, DocumentPage
+from utils.document_handler import EXTRACTOR_VERSION
+from utils.fuzzy_matcher import FuzzyMatcher, trigrams
+from utils.text_processor import (NormalizedPage, TermMatcher, normalize_text, search_hits_multi, search_terms_multi,
+                                  unpack_boundaries)
+
+# SQLite keeps the index in a contentless FTS5 table whose rowid is document_pages.id;
+# Postgres keeps a tsvector column on document_pages itself
+FTS_TABLE = "document_pages_fts"
+
+# Every distinct indexed word, for finding variants in fuzzy searches. Postgres looks
+# words up with a pg_trgm index when the extension is available; otherwise words are
+# found through a table of (trigram, word) rows
+WORD_TABLE = "search_words"
+WORD_TRIGRAM_TABLE = "search_word_trigrams"
+
+# Pages loaded per query when fetching candidate page text
+LOAD_BATCH_SIZE = 500
+
+# Words looked up per query when adding new words to the word index
+WORD_BATCH_SIZE = 500
+
+# Indexed words a term's first word may be part of before its pages are scanned instead of looked up
+MAX_WORD_VARIANTS = 200
+
+_index_backend = None
+_word_backend = None
+_index_ready = False
+_init_lock = threading.Lock()
+
+def init_search_index():
+    """Create the full-text index for the database backend, once per process.
+
+    Returns the backend name, or None when indexed search isn't available and
+    stored documents can only be searched by scanning.
+    """
+    global _index_backend, _word_backend, _index_ready
+    with _init_lock:
+        if not _index_ready:
+            _index_backend = _create_index()
+            if _index_backend is not None:
+                _word_backend = _create_word_index(_index_backend)
+            _index_ready = True
+        return _index_backend
+
+def word_index_backend() -> Optional[str]:
+    """Return "pg_trgm" or "table" for the word index used by fuzzy searches, or None without one"""
+    init_search_index()
+    return _word_backend
+
+def _create_index():
+    init_db()
+    engine = get_engine()
+    dialect = engine.dialect.name
+    try:
+        with engine.begin() as conn:
+            if dialect == "postgresql":
+                conn.execute(text("ALTER TABLE document_pages ADD COLUMN IF NOT EXISTS search_vector tsvector"))
+                conn.execute(text(
+                    "CREATE INDEX IF NOT EXISTS ix_document_pages_search_vector "
+                    "ON document_pages USING GIN (search_vector)"
+                ))
+            elif dialect == "sqlite":
+                conn.execute(text(f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5(body, content='')"))
+            else:
+                return None
+    except Exception as e:
+        print(f"Full-text index unavailable, falling back to scanning: {str(e)}")
+        return None
+    return dialect
+
+def _create_word_index(dialect: str) -> Optional[str]:
+    """Create the word index for fuzzy search and fill it from the full-text index the first time"""
+    engine = get_engine()
+    is_new = not inspect(engine).has_table(WORD_TABLE)
+    backend = "table"
+    if dialect == "postgresql":
+        try:
+            with engine.begin() as conn:
+                conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+            backend = "pg_trgm"
+        except Exception as e:
+            print(f"pg_trgm unavailable, using a trigram table for fuzzy search: {str(e)}")
+
+    try:
+        with engine.begin() as conn:
+            conn.execute(text(f"CREATE TABLE IF NOT EXISTS {WORD_TABLE} (word VARCHAR PRIMARY KEY)"))
+            if backend == "pg_trgm":
+                conn.execute(text(
+                    f"CREATE INDEX IF NOT EXISTS ix_{WORD_TABLE}_trgm ON {WORD_TABLE} USING GIN (word gin_trgm_ops)"
+                ))
+            else:
+                conn.execute(text(
+                    f"CREATE TABLE IF NOT EXISTS {WORD_TRIGRAM_TABLE} "
+                    "(trigram VARCHAR(3) NOT NULL, word VARCHAR NOT NULL, PRIMARY KEY (trigram, word))"
+                ))
+
+            if is_new:
+                # Words of pages indexed before the word index existed
+                if dialect == "postgresql":
+                    words = conn.execute(text(
+                        "SELECT word FROM ts_stat('SELECT search_vector FROM document_pages WHERE search_vector IS NOT NULL')"
+                    )).scalars().all()
+                else:
+                    conn.execute(text(f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE}_vocab USING fts5vocab({FTS_TABLE}, 'row')"))
+                    words = conn.execute(text(f"SELECT term FROM {FTS_TABLE}_vocab")).scalars().all()
+                _add_words(conn, words, backend)
+    except Exception as e:
+        print(f"Word index unavailable, fuzzy search of stored documents will scan: {str(e)}")
+        return None
+    return backend
+
+def _add_words(conn, words: Iterable[str], backend: str) -> int:
+    """Add words not seen before to the word index; returns how many were new"""
+    words = sorted(set(words))
+    added = 0
+    lookup = text(f"SELECT word FROM {WORD_TABLE} WHERE word IN :words").bindparams(bindparam("words", expanding=True))
+    for batch_start in range(0, len(words), WORD_BATCH_SIZE):
+        batch = words[batch_start:batch_start + WORD_BATCH_SIZE]
+        known = set(conn.execute(lookup, {"words": batch}).scalars())
+        new_words = [word for word in batch if word not in known]
+        if not new_words:
+            continue
+        conn.execute(
+            text(f"INSERT INTO {WORD_TABLE} (word) VALUES (:word) ON CONFLICT DO NOTHING"),
+            [{"word": word} for word in new_words]
+        )
+        if backend == "table":
+            conn.execute(
+                text(f"INSERT INTO {WORD_TRIGRAM_TABLE} (trigram, word) VALUES (:trigram, :word) ON CONFLICT DO NOTHING"),
+                [{"trigram": gram, "word": word} for word in new_words for gram in trigrams(word)]
+            )
+        added += len(new_words)
+    return added
+
+def _index_rows(db, rows) -> int:
+    """Add (page id, page text) rows to the full-text index"""
+    backend = init_search_index()
+    if backend is None or not rows:
+        return 0
+
+    # Index the normalized text so index tokens line up with what search_terms matches
+    params = [{"id": page_id, "body": normalize_text(page_text or "")} for page_id, page_text in rows]
+    if backend == "postgresql":
+        db.execute(
+            text("UPDATE document_pages SET search_vector = to_tsvector('simple', :body), indexed = true WHERE id = :id"),
+            params
+        )
+    else:
+        db.execute(text(f"INSERT INTO {FTS_TABLE} (rowid, body) VALUES (:id, :body)"), params)
+        db.execute(text("UPDATE document_pages SET indexed = 1 WHERE id = :id"), [{"id": p["id"]} for p in params])
+
+    if _word_backend is not None:
+        words = set()
+        for p in params:
+            words.update(p["body"].split())
+        added = _add_words(db, words, _word_backend)
+        metrics.increment("index_words_added", added)
+    return len(params)
+
+def index_document_pages(db, content_hash: str, extractor_version: str = EXTRACTOR_VERSION) -> int:
+    """Index the stored pages of one file that are not indexed yet"""
+    rows = (
+        db.query(DocumentPage.id, DocumentPage.text)
+        .filter(
+            DocumentPage.content_hash == content_hash,
+            DocumentPage.extractor_version == extractor_version,
+            DocumentPage.indexed.isnot(True)
+        )
+        .all()
+    )
+    return _index_rows(db, rows)
+
+def index_pending_pages(db, batch_size: int = LOAD_BATCH_SIZE, extractor_version: str = EXTRACTOR_VERSION) -> int:
+    """Index up to batch_size stored pages that predate the index; call repeatedly to backfill.
+
+    Idle job workers call this (see utils.jobs.work), so pages stored before
+    the index existed are indexed in the background. Until then they are
+    scanned by every search of stored documents.
+    """
+    if init_search_index() is None:
+        return 0
+
+    rows = (
+        db.query(DocumentPage.id, DocumentPage.text)
+        .filter(DocumentPage.indexed.isnot(True), DocumentPage.extractor_version == extractor_version)
+        .order_by(DocumentPage.id)
+        .limit(batch_size)
+        .all()
+    )
+    return _index_rows(db, rows)
+
+def _words_like(db, pattern: str) -> Optional[List[str]]:
+    """Indexed words matching a LIKE pattern, or None when there are more than MAX_WORD_VARIANTS"""
+    words = db.execute(
+        text(f"SELECT word FROM {WORD_TABLE} WHERE word LIKE :pattern LIMIT :limit"),
+        {"pattern": pattern, "limit": MAX_WORD_VARIANTS + 1}
+    ).scalars().all()
+    return None if len(words) > MAX_WORD_VARIANTS else words
+
+def find_candidate_pages(db, normalized_term: str) -> Optional[List[int]]:
+    """Return ids of indexed pages that may contain the term, or None when the index can't narrow them down.
+
+    Terms match anywhere in the page text, like a scan does, so the first
+    word of the term may be the end of a longer word (or any part of it for a
+    one-word term) and the last word the start of one. Words the first one is
+    part of are looked up in the word index; candidates contain one of them
+    and the term's other words, and are verified by the caller. A term whose
+    first word is part of too many indexed words can't be looked up usefully.
+    """
+    tokens = normalized_term.split()
+    backend = init_search_index()
+    if backend is None or word_index_backend() is None:
+        return None
+    if not tokens:
+        return []
+
+    # Normalized tokens are plain [a-z0-9], so they are safe in LIKE patterns and inside the query syntax
+    first = _words_like(db, f"%{tokens[0]}%" if len(tokens) == 1 else f"%{tokens[0]}")
+    if first is None:
+        return None
+    if not first:
+        return []
+
+    if backend == "postgresql":
+        groups = ["(" + " | ".join(first) + ")"] + tokens[1:-1] + ([tokens[-1] + ":*"] if len(tokens) > 1 else [])
+        query = text("SELECT id FROM document_pages WHERE search_vector @@ to_tsquery('simple', :query)")
+        params = {"query": " & ".join(groups)}
+    else:
+        groups = ["(" + " OR ".join(f'"{word}"' for word in first) + ")"]
+        groups += [f'"{token}"' for token in tokens[1:-1]] + ([f'"{tokens[-1]}"*'] if len(tokens) > 1 else [])
+        query = text(f"SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH :query")
+        params = {"query": " AND ".join(groups)}
+
+    return [row[0] for row in db.execute(query, params)]
+
+def find_similar_words(db, word: str, min_similarity: float) -> List[str]:
+    """Return indexed words whose trigram similarity to `word` is at least min_similarity"""
+    backend = word_index_backend()
+    if backend == "pg_trgm":
+        db.execute(text("SELECT set_limit(:limit)"), {"limit": min_similarity})
+        return list(db.execute(text(f"SELECT word FROM {WORD_TABLE} WHERE word % :word"), {"word": word}).scalars())
+    if backend is None:
+        return []
+
+    grams = trigrams(word)
+    query = text(
+        f"SELECT word, COUNT(*) FROM {WORD_TRIGRAM_TABLE} WHERE trigram IN :grams GROUP BY word"
+    ).bindparams(bindparam("grams", expanding=True))
+    similar = []
+    for candidate, shared in db.execute(query, {"grams": sorted(grams)}):
+        if shared / (len(grams) + len(trigrams(candidate)) - shared) >= min_similarity:
+            similar.append(candidate)
+    return similar
+
+def find_fuzzy_candidate_pages(db, matcher: FuzzyMatcher) -> Optional[List[int]]:
+    """Return ids of indexed pages that contain a variant of every word of some term, or None like find_candidate_pages.
+
+    Variants are indexed words that are trigram-similar to a term word and pass
+    the matcher's edit distance or stem check. Words that only share a stem
+    without being trigram-similar are not looked up here.
+    """
+    backend = init_search_index()
+    page_ids = set()
+    for pattern in matcher.patterns:
+        # Exact occurrences, including ones inside longer words
+        exact = find_candidate_pages(db, pattern)
+        if exact is None:
+            return None
+        page_ids.update(exact)
+
+        groups = []
+        for word in pattern.split():
+            variants = {word}
+            variants.update(
+                candidate for candidate in find_similar_words(db, word, matcher.min_similarity)
+                if matcher.is_variant(candidate, word)
+            )
+            groups.append(sorted(variants))
+
+        # Index words are plain [a-z0-9], so they are safe inside the query syntax
+        if backend == "postgresql":
+            query = text("SELECT id FROM document_pages WHERE search_vector @@ to_tsquery('simple', :query)")
+            params = {"query": " & ".join("(" + " | ".join(group) + ")" for group in groups)}
+        else:
+            query = text(f"SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH :query")
+            params = {"query": " AND ".join("(" + " OR ".join(f'"{w}"' for w in group) + ")" for group in groups)}
+        page_ids.update(row[0] for row in db.execute(query, params))
+    return sorted(page_ids)
+
+def search_stored_documents(db, terms, exclude_hashes: Iterable[str] = (),
+                            extractor_version: str = EXTRACTOR_VERSION, summaries: bool = False,
+                            hits: bool = False) -> Dict[str, Dict[str, Dict[int, List[str]]]]:
+    """Search every stored document, using the full-text index to pick candidate pages.
+
+    Candidate pages are verified with the same matcher `search_terms_multi` uses;
+    pass a FuzzyMatcher to find variants too. Pages that are not indexed yet, or
+    every page when no index is available or a term can't be looked up in it,
+    fall back to a plain scan. Returns content hash -> term -> {page number: [contexts]},
+    with (excerpt, summary) pairs as contexts when summaries=True, or with
+    (start, end, matches) windows like `search_hits_multi` when hits=True.
+    """
+    matcher = terms if isinstance(terms, TermMatcher) else TermMatcher(terms)
+    excluded = set(exclude_hashes)
+    page_ids = set()
+    backend = init_search_index()
+
+    with metrics.span("index_lookup"):
+        if backend is not None:
+            if isinstance(matcher, FuzzyMatcher):
+                candidates = find_fuzzy_candidate_pages(db, matcher)
+            else:
+                candidates = set()
+                for pattern in matcher.patterns:
+                    found = find_candidate_pages(db, pattern)
+                    if found is None:
+                        candidates = None
+                        break
+                    candidates.update(found)
+            if candidates is None:
+                metrics.increment("index_fallback_scans")
+                backend = None
+            else:
+                page_ids.update(candidates)
+
+        unindexed = db.query(DocumentPage.id).filter(DocumentPage.extractor_version == extractor_version)
+        if backend is not None:
+            unindexed = unindexed.filter(DocumentPage.indexed.isnot(True))
+        page_ids.update(page_id for page_id, in unindexed)
+    metrics.increment("index_candidate_pages", len(page_ids))
+
+    results = {}
+    page_ids = sorted(page_ids)
+    for batch_start in range(0, len(page_ids), LOAD_BATCH_SIZE):
+        rows = (
+            db.query(DocumentPage.content_hash, DocumentPage.page_number, DocumentPage.text, DocumentPage.sentence_offsets,
+                     DocumentPage.sentence_tokenizer)
+            .filter(
+                DocumentPage.id.in_(page_ids[batch_start:batch_start + LOAD_BATCH_SIZE]),
+                DocumentPage.extractor_version == extractor_version
+            )
+            .all()
+        )
+        for content_hash, page_number, page_text, sentence_offsets, sentence_tokenizer in rows:
+            if content_hash in excluded:
+                continue
+            page = NormalizedPage(page_text or "", unpack_boundaries(sentence_offsets, sentence_tokenizer))
+            if hits:
+                page_results = search_hits_multi({page_number: page}, matcher)
+            else:
+                page_results = search_terms_multi({page_number: page}, matcher, summaries)
+            for term, pages in page_results.items():
+                results.setdefault(content_hash, {}).setdefault(term, {}).update(pages)
+
+    return results
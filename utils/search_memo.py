@@ -0,0 +1,157 @@
+"""Memoized searches: a file's hits for each normalized term, reused when the term is searched again.
+
+A memo is keyed by the file's content hash, the term after normalize_text,
+the matcher's mode (exact, or fuzzy with its settings) and a version made of
+EXTRACTOR_VERSION and `search_version` (SEARCH_VERSION and the sentence
+tokenizer). Searching a file for a mix of old and new terms scans its pages
+for the new terms only. A change of version makes older memos invisible;
+they are replaced as files are searched again.
+"""
+from array import array
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+from sqlalchemy import insert
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
+from utils import metrics
+from utils.database import SearchMemoEntry
+from utils.document_handler import EXTRACTOR_VERSION
+from utils.text_processor import NormalizedPage, TermMatcher, iter_search_hits, search_hits_multi, search_version
+
+Windows = Dict[int, List[Tuple[int, int, int]]]
+
+def pack_hits(windows_by_page: Windows) -> bytes:
+    """Serialize page number -> [(start, end, matches)] windows for storage"""
+    values = array('I')
+    for page_num, windows in windows_by_page.items():
+        for start, end, matches in windows:
+            values.extend((page_num, start, end, matches))
+    return values.tobytes()
+
+def unpack_hits(data: bytes) -> Windows:
+    """Load windows stored by `pack_hits`"""
+    values = array('I')
+    values.frombytes(data)
+    windows_by_page = {}
+    for i in range(0, len(values), 4):
+        windows_by_page.setdefault(values[i], []).append((values[i + 1], values[i + 2], values[i + 3]))
+    return windows_by_page
+
+class SearchMemo:
+    """Memoized `search_hits_multi` of stored files for one matcher; changes are saved with the caller's commit"""
+
+    def __init__(self, db, matcher: TermMatcher, extractor_version: str = EXTRACTOR_VERSION):
+        self.db = db
+        self.matcher = matcher
+        self.version = f"{extractor_version}.{search_version()}"
+
+    def lookup(self, content_hash: str) -> Optional[Dict[str, Windows]]:
+        """Return term -> windows by page from the memos alone, or None if any term wasn't searched yet"""
+        memo = self._load(content_hash)
+        if len(memo) < len(self.matcher.patterns):
+            return None
+        return self._by_term(memo)
+
+    def search(self, content_hash: str, pages) -> Tuple[Dict[str, Windows], Set[str]]:
+        """Search a file's pages like `search_hits_multi`, scanning only for terms without a memo.
+
+        Returns term -> {page number: [(start, end, matches)]} and the set of
+        terms whose hits came from memos rather than this scan.
+        """
+        memo = self._load(content_hash)
+        missing = [pattern_id for pattern_id, pattern in enumerate(self.matcher.patterns) if pattern not in memo]
+        metrics.increment("search_memo_hits", len(self.matcher.patterns) - len(missing))
+        metrics.increment("search_memo_misses", len(missing))
+
+        if missing:
+            # Patterns are matched independently, so a matcher for the missing terms finds the same hits for them
+            found = search_hits_multi(pages, self.matcher.with_terms(
+                [self.matcher.terms_for(pattern_id)[0] for pattern_id in missing]))
+            new = {}
+            for pattern_id in missing:
+                new[self.matcher.patterns[pattern_id]] = found.get(self.matcher.terms_for(pattern_id)[0], {})
+            self._store(content_hash, new)
+            memo.update(new)
+
+        reused = {
+            term
+            for pattern_id, pattern in enumerate(self.matcher.patterns) if pattern_id not in missing
+            for term in self.matcher.terms_for(pattern_id)
+        }
+        return self._by_term(memo), reused
+
+    def search_stream(self, content_hash: str,
+                      pages: Iterable[Tuple[int, NormalizedPage]]) -> Iterator[Tuple[int, NormalizedPage, Windows]]:
+        """Search a file's pages as they arrive, e.g. while being extracted, storing its memos at the end.
+
+        For files without memos, such as ones just extracted. Yields
+        (page number, page, term -> [(start, end, matches)] on that page) for
+        every page, so only one page needs to be held at a time.
+        """
+        found = {}
+        for page_num, page in pages:
+            if not isinstance(page, NormalizedPage):
+                page = NormalizedPage(page)
+            page_hits = {}
+            for _, page_hits in iter_search_hits(((page_num, page),), self.matcher):
+                for term, windows in page_hits.items():
+                    found.setdefault(term, {})[page_num] = windows
+            yield page_num, page, page_hits
+
+        if self.matcher.patterns:
+            metrics.increment("search_memo_misses", len(self.matcher.patterns))
+            self._store(content_hash, {
+                pattern: found.get(self.matcher.terms_for(pattern_id)[0], {})
+                for pattern_id, pattern in enumerate(self.matcher.patterns)
+            })
+
+    def _by_term(self, memo: Dict[str, Windows]) -> Dict[str, Windows]:
+        return {
+            term: memo[pattern]
+            for pattern_id, pattern in enumerate(self.matcher.patterns) if memo[pattern]
+            for term in self.matcher.terms_for(pattern_id)
+        }
+
+    def _load(self, content_hash: str) -> Dict[str, Windows]:
+        if not self.matcher.patterns:
+            return {}
+        with metrics.span("search_memo_load"):
+            rows = (
+                self.db.query(SearchMemoEntry.pattern, SearchMemoEntry.hits)
+                .filter(
+                    SearchMemoEntry.content_hash == content_hash,
+                    SearchMemoEntry.mode == self.matcher.mode,
+                    SearchMemoEntry.version == self.version,
+                    SearchMemoEntry.pattern.in_(self.matcher.patterns)
+                )
+                .all()
+            )
+        return {pattern: unpack_hits(hits) for pattern, hits in rows}
+
+    def _store(self, content_hash: str, windows_by_pattern: Dict[str, Windows]):
+        rows = [
+            {"content_hash": content_hash, "pattern": pattern, "mode": self.matcher.mode, "version": self.version,
+             "hits": pack_hits(windows)}
+            for pattern, windows in windows_by_pattern.items()
+        ]
+        with metrics.span("search_memo_store"):
+            # Memos of earlier versions can never be read again
+            self.db.query(SearchMemoEntry).filter(
+                SearchMemoEntry.content_hash == content_hash,
+                SearchMemoEntry.mode == self.matcher.mode,
+                SearchMemoEntry.version != self.version,
+                SearchMemoEntry.pattern.in_(list(windows_by_pattern))
+            ).delete(synchronize_session=False)
+
+            # A concurrent search of the same file may store the same memos; either copy will do
+            dialect = self.db.get_bind().dialect.name
+            if dialect in ("postgresql", "sqlite"):
+                stmt = (postgresql.insert if dialect == "postgresql" else sqlite.insert)(SearchMemoEntry)
+                self.db.execute(stmt.on_conflict_do_nothing(
+                    index_elements=["content_hash", "pattern", "mode", "version"]), rows)
+                return
+            for row in rows:
+                try:
+                    with self.db.begin_nested():
+                        self.db.execute(insert(SearchMemoEntry).values(**row))
+                except IntegrityError:
+                    pass
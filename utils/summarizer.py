@@ -1,86 +1,470 @@
+import asyncio
+import contextvars
 import os
-from openai import OpenAI
-from typing import Optional
+import queue
+import random
+import threading
+import time
+from typing import AsyncIterator, Dict, Iterator, List, Optional, Tuple
+from utils import metrics
+from utils.summary_cache import SummaryCache, get_summary_cache, make_cache_key
+from utils.text_processor import normalize_text
 
 # the newest OpenAI model is "gpt-4o" which was released May 13, 2024.
 # do not change this unless explicitly requested by the user
+MODEL = "gpt-4o"
+
+TEXT_SUMMARY_PROMPT = "You are a precise document summarizer. Create a concise summary that captures the key points."
+RESULTS_SUMMARY_PROMPT = "Create a brief summary of the search results, highlighting key findings and patterns."
+PARTIAL_SUMMARY_PROMPT = (
+    "Summarize this part of a larger set of search results. Keep every distinct finding, the documents it "
+    "comes from and how often it occurs, so the summary can be merged with summaries of the other parts."
+)
+
+API_KEY_MISSING_MESSAGE = "OpenAI API key not found. Please provide a valid API key to enable summarization."
+
+# Limits for batch summarization; keep them at or below the account's OpenAI rate limits
+SUMMARY_CONCURRENCY = int(os.getenv("SUMMARY_CONCURRENCY", "8"))
+OPENAI_REQUESTS_PER_MINUTE = int(os.getenv("OPENAI_REQUESTS_PER_MINUTE", "500"))
+OPENAI_TOKENS_PER_MINUTE = int(os.getenv("OPENAI_TOKENS_PER_MINUTE", "30000"))
+SUMMARY_MAX_RETRIES = int(os.getenv("SUMMARY_MAX_RETRIES", "5"))
+
+# Prompt tokens per request when summarizing search results; larger result sets are summarized in parts
+SUMMARY_CHUNK_TOKENS = int(os.getenv("SUMMARY_CHUNK_TOKENS", "6000"))
+
+# Completion tokens of each partial summary of search results
+SUMMARY_PARTIAL_TOKENS = int(os.getenv("SUMMARY_PARTIAL_TOKENS", "300"))
+
+# Excerpts at least this similar (Jaccard similarity of their word 5-grams) are sent once
+SUMMARY_DEDUP_SIMILARITY = float(os.getenv("SUMMARY_DEDUP_SIMILARITY", "0.8"))
+
+# Words per shingle when comparing excerpts, and shingles kept per excerpt to find similar ones
+SHINGLE_WORDS = 5
+SKETCH_SIZE = 8
+
+_encoding = None
+_encoding_loaded = False
+_encoding_lock = threading.Lock()
+
+def _get_encoding():
+    """The model's tiktoken encoding, or None when tiktoken isn't installed or its data can't be loaded"""
+    global _encoding, _encoding_loaded
+    with _encoding_lock:
+        if not _encoding_loaded:
+            _encoding_loaded = True
+            try:
+                import tiktoken
+                try:
+                    _encoding = tiktoken.encoding_for_model(MODEL)
+                except KeyError:
+                    _encoding = tiktoken.get_encoding("o200k_base")
+            except ImportError:
+                pass
+            except Exception as e:
+                print(f"Error loading tiktoken encoding, estimating token counts: {str(e)}")
+        return _encoding
+
+def count_tokens(text: str) -> int:
+    """Tokens in text for MODEL: exact with tiktoken installed, otherwise about four characters per token"""
+    encoding = _get_encoding()
+    if encoding is None:
+        return len(text) // 4 + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+def truncate_tokens(text: str, max_tokens: int) -> str:
+    """Cut text to at most max_tokens tokens as counted by count_tokens"""
+    encoding = _get_encoding()
+    if encoding is None:
+        return text[:max(0, (max_tokens - 1) * 4)]
+    tokens = encoding.encode(text, disallowed_special=())
+    return text if len(tokens) <= max_tokens else encoding.decode(tokens[:max_tokens])
+
+def _shingles(text: str) -> frozenset:
+    words = normalize_text(text).split()
+    if len(words) <= SHINGLE_WORDS:
+        return frozenset([hash(tuple(words))])
+    return frozenset(hash(tuple(words[i:i + SHINGLE_WORDS])) for i in range(len(words) - SHINGLE_WORDS + 1))
+
+def dedupe_results(results: List[Dict], similarity: float = SUMMARY_DEDUP_SIMILARITY) -> List[Tuple[Dict, List[Dict]]]:
+    """Group search results whose excerpts are near-identical, returning (first result, all results) in order.
+
+    Excerpts are compared by their sets of word 5-grams. Candidates are found
+    through each excerpt's few smallest shingle hashes, which near-identical
+    sets almost always share, so this stays close to linear in the number of
+    results instead of comparing every pair.
+    """
+    groups = []
+    kept_shingles = []
+    by_sketch = {}
+    for result in results:
+        shingles = _shingles(result['Excerpt'] or "")
+        sketch = sorted(shingles)[:SKETCH_SIZE]
+        match = None
+        for group_index in dict.fromkeys(i for h in sketch for i in by_sketch.get(h, ())):
+            other = kept_shingles[group_index]
+            if len(shingles & other) >= similarity * len(shingles | other):
+                match = group_index
+                break
+        if match is not None:
+            groups[match][1].append(result)
+            continue
+        for h in sketch:
+            by_sketch.setdefault(h, []).append(len(groups))
+        kept_shingles.append(shingles)
+        groups.append((result, [result]))
+    return groups
+
+def _format_group(result: Dict, group: List[Dict]) -> str:
+    """One search result as prompt text, noting how often near-identical excerpts occur"""
+    lines = [f"Document: {result['Document']}", f"Term: {result['Search Term']}"]
+    if len(group) > 1:
+        documents = list(dict.fromkeys(r['Document'] for r in group))
+        lines.append(f"Similar excerpts: {len(group)}, in {len(documents)} document(s)")
+    lines.append(f"Context: {result['Excerpt']}")
+    return "\n".join(lines) + "\n"
+
+def pack_chunks(sizes: List[int], budget: int) -> List[List[int]]:
+    """Pack items of the given token sizes into as few chunks of at most budget tokens as fits greedily.
+
+    First-fit decreasing: the largest items are placed first, each into the
+    first chunk with room. Returns each chunk's item indexes in their original
+    order; an item larger than the budget gets a chunk of its own.
+    """
+    chunks = []
+    room = []
+    for index in sorted(range(len(sizes)), key=lambda i: -sizes[i]):
+        for chunk_index, free in enumerate(room):
+            if sizes[index] <= free:
+                chunks[chunk_index].append(index)
+                room[chunk_index] -= sizes[index]
+                break
+        else:
+            chunks.append([index])
+            room.append(budget - sizes[index])
+    return [sorted(chunk) for chunk in chunks]
+
+def _error_message(e: Exception) -> str:
+    """Turn an OpenAI error into a message for the user"""
+    error_msg = str(e)
+    if "rate limit" in error_msg.lower():
+        return "OpenAI API rate limit reached. Please try again in a few moments."
+    elif "quota" in error_msg.lower() or "billing" in error_msg.lower():
+        return "OpenAI API quota exceeded. Please ensure your account has available credits and billing is set up correctly."
+    elif "invalid" in error_msg.lower() and "api" in error_msg.lower():
+        return "Invalid OpenAI API key. Please provide a valid API key."
+    return f"Error generating summary: {error_msg}"
+
+def _messages(system_prompt: str, user_content: str) -> list:
+    return [
+        {
+            "role": "system",
+            "content": system_prompt
+        },
+        {
+            "role": "user",
+            "content": user_content
+        }
+    ]
+
+def _record_usage(response):
+    """Count API calls and the tokens they used"""
+    metrics.increment("llm_requests")
+    usage = getattr(response, "usage", None)
+    if usage is not None:
+        metrics.increment("llm_tokens", getattr(usage, "prompt_tokens", 0) or 0, kind="prompt")
+        metrics.increment("llm_tokens", getattr(usage, "completion_tokens", 0) or 0, kind="completion")
+
 class TextSummarizer:
-    def __init__(self):
-        self.client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+    def __init__(self, client=None, cache: Optional[SummaryCache] = None, batch_summarizer=None):
+        # A client can be passed in, e.g. a stub in tests
+        self._client = client
+        self.cache = cache or get_summary_cache()
+        # Runs the parallel stage of summarize_search_results
+        self._batch_summarizer = batch_summarizer
+
+    @property
+    def client(self):
+        # Created on first use, since the OpenAI client refuses to start without an API key
+        if self._client is None:
+            from openai import OpenAI
+            self._client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+        return self._client
+
+    def _complete(self, system_prompt: str, user_content: str, max_tokens: int, temperature: float = 0.5) -> str:
+        """Run a chat completion, answering identical requests from the summary cache"""
+        key = make_cache_key(MODEL, system_prompt, user_content, max_tokens, temperature)
+        summary = self.cache.get(key)
+        if summary is not None:
+            return summary
+
+        with metrics.span("llm_request"):
+            response = self.client.chat.completions.create(
+                model=MODEL,
+                messages=_messages(system_prompt, user_content),
+                max_tokens=max_tokens,
+                temperature=temperature
+            )
+        _record_usage(response)
+        summary = response.choices[0].message.content.strip()
+        self.cache.put(key, summary)
+        return summary
 
     def summarize_text(self, text: str, max_tokens: int = 150) -> Optional[str]:
         """Generate a concise summary of the provided text"""
         if not os.getenv("OPENAI_API_KEY"):
-            return "OpenAI API key not found. Please provide a valid API key to enable summarization."
+            return API_KEY_MISSING_MESSAGE
 
         try:
-            response = self.client.chat.completions.create(
-                model="gpt-4o",
-                messages=[
-                    {
-                        "role": "system",
-                        "content": "You are a precise document summarizer. Create a concise summary that captures the key points."
-                    },
-                    {
-                        "role": "user",
-                        "content": f"Please summarize the following text:\n\n{text}"
-                    }
-                ],
-                max_tokens=max_tokens,
-                temperature=0.5
+            return self._complete(
+                TEXT_SUMMARY_PROMPT,
+                f"Please summarize the following text:\n\n{text}",
+                max_tokens
             )
-            return response.choices[0].message.content.strip()
         except Exception as e:
-            error_msg = str(e)
-            print(f"Error in summarization: {error_msg}")
-            if "rate limit" in error_msg.lower():
-                return "OpenAI API rate limit reached. Please try again in a few moments."
-            elif "quota" in error_msg.lower() or "billing" in error_msg.lower():
-                return "OpenAI API quota exceeded. Please ensure your account has available credits and billing is set up correctly."
-            elif "invalid" in error_msg.lower() and "api" in error_msg.lower():
-                return "Invalid OpenAI API key. Please provide a valid API key."
-            return f"Error generating summary: {error_msg}"
-
-    def summarize_search_results(self, results: list) -> Optional[str]:
-        """Generate a summary of search results"""
+            print(f"Error in summarization: {str(e)}")
+            return _error_message(e)
+
+    def summarize_search_results(self, results: list, chunk_tokens: int = SUMMARY_CHUNK_TOKENS) -> Optional[str]:
+        """Generate a summary of all search results, in parts when they don't fit one request.
+
+        Near-identical excerpts are sent once, with a count. The rest are
+        packed into as few prompts of chunk_tokens as possible; when more than
+        one is needed, each is summarized in parallel and the partial
+        summaries are combined, again in parts if they don't fit.
+        """
         if not results:
             return None
 
         if not os.getenv("OPENAI_API_KEY"):
-            return "OpenAI API key not found. Please provide a valid API key to enable summarization."
-
-        # Prepare context from results
-        context = "\n".join([
-            f"Document: {r['Document']}\n"
-            f"Term: {r['Search Term']}\n"
-            f"Context: {r['Excerpt']}\n"
-            for r in results[:5]  # Limit to first 5 results for conciseness
-        ])
+            return API_KEY_MISSING_MESSAGE
 
         try:
-            response = self.client.chat.completions.create(
-                model="gpt-4o",
-                messages=[
-                    {
-                        "role": "system",
-                        "content": "Create a brief summary of the search results, highlighting key findings and patterns."
-                    },
-                    {
-                        "role": "user",
-                        "content": f"Please summarize these search results:\n\n{context}"
-                    }
-                ],
-                max_tokens=200,
-                temperature=0.5
-            )
-            return response.choices[0].message.content.strip()
+            with metrics.span("summarize_results"):
+                groups = dedupe_results(results)
+                metrics.increment("summary_results_deduplicated", len(results) - len(groups))
+                texts = [_format_group(result, group) for result, group in groups]
+                return self._reduce(texts, chunk_tokens)
         except Exception as e:
-            error_msg = str(e)
-            print(f"Error in search results summarization: {error_msg}")
-            if "rate limit" in error_msg.lower():
-                return "OpenAI API rate limit reached. Please try again in a few moments."
-            elif "quota" in error_msg.lower() or "billing" in error_msg.lower():
-                return "OpenAI API quota exceeded. Please ensure your account has available credits and billing is set up correctly."
-            elif "invalid" in error_msg.lower() and "api" in error_msg.lower():
-                return "Invalid OpenAI API key. Please provide a valid API key."
-            return f"Error generating summary: {error_msg}"
\ No newline at end of file
+            print(f"Error in search results summarization: {str(e)}")
+            return _error_message(e)
+
+    def _reduce(self, texts: List[str], chunk_tokens: int) -> str:
+        instruction = "Please summarize these search results:\n\n"
+        combining = False
+        while True:
+            # Each request is budgeted with the system prompt and instruction it is sent with
+            final_budget = chunk_tokens - count_tokens(RESULTS_SUMMARY_PROMPT) - count_tokens(instruction)
+            map_budget = chunk_tokens - count_tokens(PARTIAL_SUMMARY_PROMPT) - count_tokens(instruction)
+            item_budget = min(final_budget, map_budget) - 1
+            if item_budget <= 0:
+                raise Exception(f"Error summarizing search results: {chunk_tokens} tokens per request leave no room for them")
+            # A text that doesn't fit a request on its own is cut short
+            texts = [truncate_tokens(text, item_budget) if count_tokens(text) > item_budget else text for text in texts]
+            sizes = [count_tokens(text) + 1 for text in texts]
+            if sum(sizes) <= final_budget:
+                return self._complete(RESULTS_SUMMARY_PROMPT, instruction + "\n".join(texts), 200)
+
+            chunks = pack_chunks(sizes, map_budget)
+            if combining and len(chunks) >= len(texts):
+                # The partial summaries can't be combined any further; send as many as fit
+                used = kept = 0
+                while kept < len(texts) and used + sizes[kept] <= final_budget:
+                    used += sizes[kept]
+                    kept += 1
+                metrics.increment("summary_parts_dropped", len(texts) - kept)
+                return self._complete(RESULTS_SUMMARY_PROMPT, instruction + "\n".join(texts[:kept]), 200)
+
+            parts = ["\n".join(texts[i] for i in chunk) for chunk in chunks]
+            batch = self._batch_summarizer or BatchSummarizer(cache=self.cache)
+            texts = [None] * len(parts)
+            with metrics.span("summarize_results_map"):
+                for index, summary in batch.summarize_many(parts, SUMMARY_PARTIAL_TOKENS, PARTIAL_SUMMARY_PROMPT,
+                                                           instruction):
+                    texts[index] = summary
+            if batch.errors:
+                # A summary missing some parts would silently misreport the results
+                raise next(iter(batch.errors.values()))
+            instruction = "Please combine these summaries of parts of the search results:\n\n"
+            combining = True
+
+class TokenBucket:
+    """Async token bucket holding up to one minute's allowance, refilled continuously"""
+
+    def __init__(self, per_minute: int):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, amount: float = 1):
+        """Wait until `amount` tokens are available and take them"""
+        amount = min(amount, self.capacity)
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= amount:
+                    self._tokens -= amount
+                    return
+                await asyncio.sleep((amount - self._tokens) / self.rate)
+
+def _retry_after(e: Exception) -> Optional[float]:
+    """Seconds the server asked us to wait, from retry-after-ms or retry-after headers"""
+    response = getattr(e, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except ValueError:
+        pass
+    return None
+
+def _is_retryable(e: Exception) -> bool:
+    from openai import APIConnectionError, APIStatusError, RateLimitError
+    if isinstance(e, RateLimitError):
+        # Running out of quota won't fix itself by waiting
+        return getattr(e, "code", None) != "insufficient_quota"
+    if isinstance(e, APIConnectionError):
+        return True
+    return isinstance(e, APIStatusError) and e.status_code >= 500
+
+class BatchSummarizer:
+    """Summarizes many texts concurrently with the async OpenAI client.
+
+    Concurrency is bounded by a semaphore, request and token throughput by two
+    token buckets, and 429/5xx/connection errors are retried with exponential
+    backoff that honors the server's retry-after header. A retry-after pauses
+    every request, not just the one that was throttled. Results share the
+    summary cache with TextSummarizer.summarize_text. Errors of the last run
+    are kept in errors, by text index.
+    """
+
+    def __init__(self, client=None, cache: Optional[SummaryCache] = None,
+                 max_concurrency: int = SUMMARY_CONCURRENCY,
+                 requests_per_minute: int = OPENAI_REQUESTS_PER_MINUTE,
+                 tokens_per_minute: int = OPENAI_TOKENS_PER_MINUTE,
+                 max_retries: int = SUMMARY_MAX_RETRIES):
+        # An AsyncOpenAI client can be passed in, e.g. one pointed at a local stub server
+        self.client = client
+        self.cache = cache or get_summary_cache()
+        self.max_concurrency = max_concurrency
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_retries = max_retries
+        self.errors: Dict[int, Exception] = {}
+
+    async def summarize_stream(self, texts: List[str], max_tokens: int = 150, system_prompt: str = TEXT_SUMMARY_PROMPT,
+                               instruction: str = "Please summarize the following text:\n\n") -> AsyncIterator[Tuple[int, str]]:
+        """Summarize texts concurrently, yielding (index, summary) as each one finishes.
+
+        A text that fails after all retries yields the same user-facing error
+        message summarize_text would return.
+        """
+        self.errors = {}
+        if self.client is None and not os.getenv("OPENAI_API_KEY"):
+            for index in range(len(texts)):
+                yield index, API_KEY_MISSING_MESSAGE
+            return
+
+        # The default client is created per run because it is tied to the running event loop
+        from openai import AsyncOpenAI
+        client = self.client or AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0)
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self._requests = TokenBucket(self.requests_per_minute)
+        self._tokens = TokenBucket(self.tokens_per_minute)
+        self._paused_until = 0.0
+
+        try:
+            tasks = [
+                asyncio.ensure_future(self._summarize_one(client, index, instruction + text, max_tokens, system_prompt))
+                for index, text in enumerate(texts)
+            ]
+            try:
+                for task in asyncio.as_completed(tasks):
+                    yield await task
+            finally:
+                for task in tasks:
+                    task.cancel()
+        finally:
+            if self.client is None:
+                await client.close()
+
+    def summarize_many(self, texts: List[str], max_tokens: int = 150, system_prompt: str = TEXT_SUMMARY_PROMPT,
+                       instruction: str = "Please summarize the following text:\n\n") -> Iterator[Tuple[int, str]]:
+        """Blocking wrapper around summarize_stream for synchronous callers such as the Streamlit script"""
+        results = queue.Queue()
+        done = object()
+
+        async def consume():
+            async for item in self.summarize_stream(texts, max_tokens, system_prompt, instruction):
+                results.put(item)
+
+        def run():
+            try:
+                asyncio.run(consume())
+            except Exception as e:
+                results.put(e)
+            finally:
+                results.put(done)
+
+        # The thread gets a copy of the caller's context, so its spans reach the caller's metrics.record_run
+        threading.Thread(target=contextvars.copy_context().run, args=(run,), daemon=True).start()
+        while True:
+            item = results.get()
+            if item is done:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    async def _summarize_one(self, client, index: int, user_content: str, max_tokens: int,
+                             system_prompt: str) -> Tuple[int, str]:
+        key = make_cache_key(MODEL, system_prompt, user_content, max_tokens, 0.5)
+        summary = await asyncio.to_thread(self.cache.get, key)
+        if summary is not None:
+            return index, summary
+
+        # Prompt size plus the completion budget
+        estimated_tokens = count_tokens(system_prompt) + count_tokens(user_content) + max_tokens
+        delay = 1.0
+
+        for attempt in range(self.max_retries + 1):
+            async with self._semaphore:
+                await self._wait_while_paused()
+                await self._requests.acquire(1)
+                await self._tokens.acquire(estimated_tokens)
+                try:
+                    started = time.perf_counter()
+                    response = await client.chat.completions.create(
+                        model=MODEL,
+                        messages=_messages(system_prompt, user_content),
+                        max_tokens=max_tokens,
+                        temperature=0.5
+                    )
+                    metrics.observe("llm_request", time.perf_counter() - started, log=False, mode="batch")
+                    _record_usage(response)
+                    summary = response.choices[0].message.content.strip()
+                    await asyncio.to_thread(self.cache.put, key, summary)
+                    return index, summary
+                except Exception as e:
+                    metrics.increment("llm_errors", status=getattr(e, "status_code", None))
+                    if attempt == self.max_retries or not _is_retryable(e):
+                        print(f"Error in batch summarization: {str(e)}")
+                        self.errors[index] = e
+                        return index, _error_message(e)
+                    retry_after = _retry_after(e)
+                    if retry_after is not None:
+                        self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+
+            # Back off outside the semaphore so other requests can proceed meanwhile
+            await asyncio.sleep(retry_after if retry_after is not None else delay * (1 + random.random()))
+            delay *= 2
+
+    async def _wait_while_paused(self):
+        remaining = self._paused_until - time.monotonic()
+        if remaining > 0:
+            await asyncio.sleep(remaining)
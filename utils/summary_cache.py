@@ -0,0 +1,198 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Dict, Optional, Tuple
+from sqlalchemy import bindparam, update
+from utils import metrics
+from utils.database import get_db_context, SummaryCacheEntry
+
+# Summaries kept in the in-process LRU tier
+SUMMARY_CACHE_SIZE = int(os.getenv("SUMMARY_CACHE_SIZE", "256"))
+
+# Age after which a stored summary is ignored and removed
+SUMMARY_CACHE_TTL = int(os.getenv("SUMMARY_CACHE_TTL", str(7 * 24 * 3600)))
+
+# Rows kept in the database tier; the least recently used are evicted past this
+SUMMARY_CACHE_MAX_ROWS = int(os.getenv("SUMMARY_CACHE_MAX_ROWS", "10000"))
+
+# A stored summary's last use is only written when the one recorded is older than this
+SUMMARY_CACHE_TOUCH_SECONDS = int(os.getenv("SUMMARY_CACHE_TOUCH_SECONDS", "3600"))
+
+# Run the database size check once every this many writes
+EVICT_EVERY = 50
+
+# Last uses queued before they are written together
+TOUCH_BATCH_SIZE = 50
+
+def make_cache_key(model: str, system_prompt: str, user_content: str, max_tokens: int, temperature: float) -> str:
+    """Hash every request parameter that affects the completion"""
+    payload = json.dumps([model, system_prompt, user_content, max_tokens, temperature])
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+class SummaryCache:
+    """Two-tier summary cache: an in-process LRU in front of a database table with TTL and size eviction.
+
+    Both tiers expire a summary once it is older than the TTL. Lookups don't
+    write: a stored summary's last use, which decides size eviction, is only
+    refreshed once per SUMMARY_CACHE_TOUCH_SECONDS, and refreshes are queued
+    and written together with the next store or once TOUCH_BATCH_SIZE pile up.
+    Database errors never fail a lookup or store; the cache just falls back to
+    the memory tier.
+    """
+
+    def __init__(self, max_entries: int = SUMMARY_CACHE_SIZE, ttl_seconds: int = SUMMARY_CACHE_TTL,
+                 max_rows: int = SUMMARY_CACHE_MAX_ROWS, use_db: bool = True,
+                 touch_seconds: int = SUMMARY_CACHE_TOUCH_SECONDS):
+        self.max_entries = max_entries
+        self.ttl = timedelta(seconds=ttl_seconds)
+        self.max_rows = max_rows
+        self.use_db = use_db
+        self.touch_interval = timedelta(seconds=touch_seconds)
+        # key -> (summary, expiry time)
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._writes = 0
+        # key -> last use not written yet
+        self._touched = {}
+        self._stats = {"memory_hits": 0, "db_hits": 0, "misses": 0}
+
+    def get(self, key: str) -> Optional[str]:
+        """Return a cached summary or None"""
+        with self._lock:
+            cached = self._memory.get(key)
+            if cached is not None:
+                if cached[1] > datetime.utcnow():
+                    self._memory.move_to_end(key)
+                    self._stats["memory_hits"] += 1
+                    metrics.increment("summary_cache_hits", tier="memory")
+                    return cached[0]
+                # Expired here means expired in the database too, which drops it below
+                del self._memory[key]
+
+        found = self._db_get(key) if self.use_db else None
+        with self._lock:
+            if found is None:
+                self._stats["misses"] += 1
+                metrics.increment("summary_cache_misses")
+                return None
+            self._stats["db_hits"] += 1
+        metrics.increment("summary_cache_hits", tier="db")
+        summary, created_at = found
+        self._remember(key, summary, created_at + self.ttl)
+        return summary
+
+    def put(self, key: str, summary: str):
+        """Cache a summary in both tiers"""
+        self._remember(key, summary, datetime.utcnow() + self.ttl)
+        if self.use_db:
+            self._db_put(key, summary)
+
+    def stats(self) -> Dict[str, float]:
+        """Return hit/miss counters and the overall hit rate"""
+        with self._lock:
+            stats = dict(self._stats)
+        lookups = stats["memory_hits"] + stats["db_hits"] + stats["misses"]
+        stats["hit_rate"] = (stats["memory_hits"] + stats["db_hits"]) / lookups if lookups else 0.0
+        return stats
+
+    def _remember(self, key: str, summary: str, expires_at: datetime):
+        with self._lock:
+            self._memory[key] = (summary, expires_at)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_entries:
+                self._memory.popitem(last=False)
+
+    def _db_get(self, key: str) -> Optional[Tuple[str, datetime]]:
+        """Return a stored summary and when it was created, or None"""
+        try:
+            with get_db_context() as db:
+                entry = (
+                    db.query(SummaryCacheEntry.summary, SummaryCacheEntry.created_at, SummaryCacheEntry.last_used_at)
+                    .filter(SummaryCacheEntry.cache_key == key)
+                    .first()
+                )
+                if entry is None:
+                    return None
+                now = datetime.utcnow()
+                if entry.created_at < now - self.ttl:
+                    db.query(SummaryCacheEntry).filter(
+                        SummaryCacheEntry.cache_key == key,
+                        SummaryCacheEntry.created_at < now - self.ttl
+                    ).delete(synchronize_session=False)
+                    db.commit()
+                    return None
+                if entry.last_used_at < now - self.touch_interval:
+                    with self._lock:
+                        self._touched[key] = now
+                        flush = len(self._touched) >= TOUCH_BATCH_SIZE
+                    if flush:
+                        self._write_touched(db)
+                        db.commit()
+                return entry.summary, entry.created_at
+        except Exception as e:
+            print(f"Summary cache lookup failed: {str(e)}")
+            return None
+
+    def _write_touched(self, db):
+        """Write the queued last uses in one statement"""
+        with self._lock:
+            touched, self._touched = self._touched, {}
+        if not touched:
+            return
+        # Core executemany, since an ORM bulk update takes its keys from the rows themselves
+        table = SummaryCacheEntry.__table__
+        db.connection().execute(
+            update(table).where(table.c.cache_key == bindparam("key")).values(last_used_at=bindparam("used_at")),
+            [{"key": key, "used_at": used_at} for key, used_at in touched.items()]
+        )
+
+    def _db_put(self, key: str, summary: str):
+        try:
+            with get_db_context() as db:
+                now = datetime.utcnow()
+                with self._lock:
+                    self._touched.pop(key, None)
+                self._write_touched(db)
+                db.merge(SummaryCacheEntry(cache_key=key, summary=summary, created_at=now, last_used_at=now))
+                db.commit()
+
+                with self._lock:
+                    self._writes += 1
+                    evict = self._writes % EVICT_EVERY == 0
+                if evict:
+                    self._evict(db)
+        except Exception as e:
+            print(f"Summary cache store failed: {str(e)}")
+
+    def _evict(self, db):
+        """Drop expired rows and the least recently used rows beyond max_rows"""
+        db.query(SummaryCacheEntry).filter(
+            SummaryCacheEntry.created_at < datetime.utcnow() - self.ttl
+        ).delete(synchronize_session=False)
+
+        cutoff = (
+            db.query(SummaryCacheEntry.last_used_at)
+            .order_by(SummaryCacheEntry.last_used_at.desc())
+            .offset(self.max_rows)
+            .limit(1)
+            .scalar()
+        )
+        if cutoff is not None:
+            db.query(SummaryCacheEntry).filter(
+                SummaryCacheEntry.last_used_at <= cutoff
+            ).delete(synchronize_session=False)
+        db.commit()
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+def get_summary_cache() -> SummaryCache:
+    """Return the process-wide cache, shared by every TextSummarizer across Streamlit reruns"""
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = SummaryCache()
+        return _default_cache
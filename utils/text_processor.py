@@ -1,19 +1,24 @@
-import nltk
-from nltk.tokenize import sent_tokenize
 import re
+import threading
 import unicodedata
-import os
+from array import array
+from bisect import bisect_left, bisect_right
+from utils import metrics
 
-# Create NLTK data directory if it doesn't exist
-nltk_data_dir = os.path.join(os.path.expanduser('~'), 'nltk_data')
-os.makedirs(nltk_data_dir, exist_ok=True)
+# NLTK tokenizer data; newer NLTK releases load punkt_tab, older ones punkt
+NLTK_RESOURCES = ("punkt_tab", "punkt")
 
-# Download required NLTK data with error handling
-try:
-    nltk.download('punkt', quiet=True, raise_on_error=True)
-except Exception as e:
-    # Try downloading to the specific directory
-    nltk.download('punkt', download_dir=nltk_data_dir, quiet=True)
+# Bump whenever a change to this module or utils.fuzzy_matcher changes where hits are found; see search_version
+SEARCH_VERSION = "1"
+
+# Longest raw window overlapping matches are merged into by iter_search_hits, about two default contexts
+MAX_HIT_SPAN = 1000
+
+_tokenizer = None
+_tokenizer_lock = threading.Lock()
+
+_ALNUM_RUN = re.compile(r'[a-z0-9]+')
+_WHITESPACE = re.compile(r'\s')
 
 def normalize_text(text):
     """Normalize text for consistent comparison"""
@@ -31,62 +36,449 @@ def normalize_text(text):
 
     return text
 
+def normalize_with_offsets(text):
+    """Normalize text like `normalize_text` and map each normalized character back to the raw text.
+
+    Returns (normalized, offsets) where offsets[i] is the index in `text` of the
+    character that produced normalized character i.
+    """
+    if text.isascii():
+        folded = text.lower()
+        source = None
+    else:
+        # Fold one character at a time so every folded character keeps its source index
+        pieces = []
+        source = array('l')
+        for index, char in enumerate(text):
+            if char.isascii():
+                piece = char.lower()
+            else:
+                piece = unicodedata.normalize('NFKD', char.lower()).encode('ASCII', 'ignore').decode('utf-8')
+            if piece:
+                pieces.append(piece)
+                source.extend([index] * len(piece))
+        folded = ''.join(pieces)
+
+    pieces = []
+    offsets = array('l')
+    previous_end = 0
+
+    for match in _ALNUM_RUN.finditer(folded):
+        start, end = match.span()
+        # Whitespace between two kept runs collapses to a single space
+        if pieces:
+            space = _WHITESPACE.search(folded, previous_end, start)
+            if space:
+                pieces.append(' ')
+                offsets.append(space.start() if source is None else source[space.start()])
+        pieces.append(match.group())
+        if source is None:
+            offsets.extend(range(start, end))
+        else:
+            offsets.extend(source[start:end])
+        previous_end = end
+
+    return ''.join(pieces), offsets
+
+class NormalizedPage:
+    """Page text normalized once, with an offset map back to the raw text.
+
+    Sentence boundaries are computed on first use, or passed in when they were
+    stored with the page text, so a page is tokenized at most once.
+    """
+
+    def __init__(self, text, boundaries=None):
+        self.text = text
+        self.normalized, self.offsets = normalize_with_offsets(text)
+        self._boundaries = boundaries
+
+    @property
+    def boundaries(self):
+        """Sorted sentence start offsets in the raw text, ending with len(text)"""
+        if self._boundaries is None:
+            self._boundaries = sentence_boundaries(self.text)
+        return self._boundaries
+
+    def source_span(self, start, end):
+        """Map a normalized [start, end) span to the raw text"""
+        return self.offsets[start], self.offsets[end - 1] + 1
+
+    def context_span(self, start, end, context_size=200):
+        """Raw [start, end) of the context around a normalized span, snapped to sentence edges.
+
+        The window reaches at most context_size characters either side of the
+        hit; it starts at the first sentence start inside it before the hit and
+        ends at the last sentence end inside it after the hit, where there are any.
+        """
+        source_start, source_end = self.source_span(start, end)
+        window_start = max(0, source_start - context_size)
+        window_end = min(len(self.text), source_end + context_size)
+        boundaries = self.boundaries
+
+        index = bisect_left(boundaries, window_start)
+        if index < len(boundaries) and boundaries[index] <= source_start:
+            window_start = boundaries[index]
+        index = bisect_right(boundaries, window_end) - 1
+        if index >= 0 and boundaries[index] >= source_end:
+            window_end = boundaries[index]
+        return window_start, window_end
+
+    def context(self, start, end, context_size=200):
+        """Extract context around the normalized [start, end) span"""
+        return self.text[slice(*self.context_span(start, end, context_size))].strip()
+
+    def first_sentence(self, start, end, max_length=150):
+        """Summarize the raw [start, end) excerpt by its first sentence, like `generate_summary`"""
+        return _first_sentence(self.text, self.boundaries, start, end, max_length)
+
+    def excerpt(self, start, end):
+        """Excerpt for a raw [start, end) window, such as a hit from `search_hits_multi`"""
+        return self.text[start:end].strip()
+
+def render_excerpt(text, boundaries, start, end, max_length=150):
+    """Return (excerpt, first-sentence summary) for a raw [start, end) window of stored page text.
+
+    Stored hits keep only the window's offsets; this cuts the text back out
+    without normalizing or tokenizing the page. boundaries are the page's
+    sentence boundaries, computed here if None.
+    """
+    if boundaries is None:
+        boundaries = sentence_boundaries(text)
+    return text[start:end].strip(), _first_sentence(text, boundaries, start, end, max_length)
+
+def _first_sentence(text, boundaries, start, end, max_length):
+    """Cut the first sentence of text[start:end] with a lookup in its sentence boundaries"""
+    # Skip leading whitespace so it isn't taken for a sentence of its own
+    while start < end and text[start].isspace():
+        start += 1
+    index = bisect_right(boundaries, start)
+    if index < len(boundaries):
+        end = min(end, boundaries[index])
+
+    summary = text[start:end].rstrip()
+    if len(summary) > max_length:
+        summary = summary[:max_length] + "..."
+    return summary
+
+class _UnsplitTokenizer:
+    """Stand-in when the punkt data is missing: every text is one sentence"""
+    name = "unsplit"
+
+    def tokenize(self, text):
+        # Fallback if tokenization fails
+        return [text]
+
+    def span_tokenize(self, text):
+        return [(0, len(text))]
+
+def _load_punkt():
+    try:
+        # NLTK 3.8.2 and later ship the tokenizer as punkt_tab
+        from nltk.tokenize import PunktTokenizer
+        return PunktTokenizer()
+    except ImportError:
+        import nltk
+        return nltk.data.load('tokenizers/punkt/english.pickle')
+
+def init_tokenizer(download=True):
+    """Load the sentence tokenizer once per process, downloading the NLTK data if it's missing.
+
+    Without the data, sentences are not split and each text is treated as one sentence.
+    """
+    global _tokenizer
+    with _tokenizer_lock:
+        if _tokenizer is not None:
+            return _tokenizer
+
+        import nltk
+
+        for attempt in range(2):
+            try:
+                _tokenizer = _load_punkt()
+                break
+            except LookupError:
+                if attempt or not download:
+                    print("NLTK punkt data not found; sentence splitting is disabled")
+                    _tokenizer = _UnsplitTokenizer()
+                    break
+                for resource in NLTK_RESOURCES:
+                    try:
+                        nltk.download(resource, quiet=True, raise_on_error=True)
+                    except Exception as e:
+                        print(f"Error downloading NLTK {resource}: {str(e)}")
+        return _tokenizer
+
+def _get_tokenizer():
+    # Loads on first use without downloading anything
+    return _tokenizer or init_tokenizer(download=False)
+
+def tokenizer_name():
+    """"punkt", or "unsplit" when sentences aren't split; stored with sentence boundaries it computed"""
+    return getattr(_get_tokenizer(), "name", "punkt")
+
+def search_version():
+    """Identify how hits are found: SEARCH_VERSION and the sentence tokenizer in use.
+
+    Hit windows snap to sentence boundaries, so the tokenizer is part of it.
+    Memoized searches (see utils.search_memo) of another version are ignored,
+    so bumping SEARCH_VERSION or losing the punkt data invalidates them.
+    """
+    return f"{SEARCH_VERSION}.{tokenizer_name()}"
+
+def sent_tokenize(text):
+    """Split text into sentences"""
+    return _get_tokenizer().tokenize(text)
+
+def sentence_boundaries(text):
+    """Tokenize text once into a sorted array of sentence start offsets, ending with len(text)"""
+    boundaries = array('l')
+    with metrics.span("sentence_tokenize", log=False):
+        for start, _ in _get_tokenizer().span_tokenize(text):
+            boundaries.append(start)
+    if not boundaries or boundaries[0] != 0:
+        boundaries.insert(0, 0)
+    if boundaries[-1] != len(text):
+        boundaries.append(len(text))
+    return boundaries
+
+def pack_boundaries(boundaries):
+    """Serialize sentence boundaries for storage next to the page text"""
+    return array('I', boundaries).tobytes()
+
+def unpack_boundaries(data, tokenizer=None):
+    """Load sentence boundaries stored by `pack_boundaries`.
+
+    None when nothing was stored, or when they were computed by another
+    tokenizer than the current one (see `tokenizer_name`), so the page is
+    tokenized again.
+    """
+    if data is None or tokenizer != tokenizer_name():
+        return None
+    boundaries = array('I')
+    boundaries.frombytes(data)
+    return array('l', boundaries)
+
 def get_context(text, term, context_size=200):
-    """Extract context around a term"""
-    term_pos = normalize_text(text).lower().find(normalize_text(term).lower())
+    """Extract context around the first occurrence of a term"""
+    normalized_term = normalize_text(term)
+    if not normalized_term:
+        return None
+
+    page = NormalizedPage(text)
+    term_pos = page.normalized.find(normalized_term)
     if term_pos == -1:
         return None
 
-    start = max(0, term_pos - context_size)
-    end = min(len(text), term_pos + len(term) + context_size)
+    return page.context(term_pos, term_pos + len(normalized_term), context_size)
 
-    # Extend to complete sentences
-    context = text[start:end]
-    try:
-        sentences = sent_tokenize(context)
-    except LookupError:
-        # Fallback if tokenization fails
-        sentences = [context]
+class TermMatcher:
+    """Aho-Corasick automaton that finds many normalized terms in a single pass.
 
-    if len(sentences) > 1:
-        return ' '.join(sentences)
-    return context
+    Terms are matched as literal strings after `normalize_text`, so regex
+    metacharacters in user input are never interpreted. Terms that normalize
+    to the same pattern share one output and terms that normalize to an empty
+    string are ignored.
+    """
 
-def search_terms(text_by_page, term):
-    """Search for terms in text and return page numbers and contexts"""
-    results = {}
-    normalized_term = normalize_text(term)
+    def __init__(self, terms):
+        self.terms = []
+        self.patterns = []
+        self._pattern_terms = []
+
+        pattern_ids = {}
+        for term in terms:
+            if term in self.terms:
+                continue
+            self.terms.append(term)
+            pattern = normalize_text(term)
+            if not pattern:
+                continue
+            if pattern not in pattern_ids:
+                pattern_ids[pattern] = len(self.patterns)
+                self.patterns.append(pattern)
+                self._pattern_terms.append([])
+            self._pattern_terms[pattern_ids[pattern]].append(term)
+
+        self._build()
+
+    @property
+    def mode(self):
+        """Identifies how this matcher matches a pattern, for memoizing its results (see utils.search_memo)"""
+        return "exact"
+
+    def with_terms(self, terms):
+        """A matcher for other terms with the same settings"""
+        return TermMatcher(terms)
+
+    def _build(self):
+        """Build the goto, failure and output tables"""
+        goto = [{}]
+        output = [[]]
+
+        for pattern_id, pattern in enumerate(self.patterns):
+            state = 0
+            for char in pattern:
+                next_state = goto[state].get(char)
+                if next_state is None:
+                    next_state = len(goto)
+                    goto[state][char] = next_state
+                    goto.append({})
+                    output.append([])
+                state = next_state
+            output[state].append(pattern_id)
+
+        # Breadth-first pass to compute failure links and merge outputs
+        fail = [0] * len(goto)
+        queue = list(goto[0].values())
+        for state in queue:
+            for char, next_state in goto[state].items():
+                queue.append(next_state)
+                fallback = fail[state]
+                while fallback and char not in goto[fallback]:
+                    fallback = fail[fallback]
+                fail[next_state] = goto[fallback].get(char, 0)
+                output[next_state] = output[next_state] + output[fail[next_state]]
+
+        self._goto = goto
+        self._fail = fail
+        self._output = [tuple(out) for out in output]
+
+    def scan(self, normalized_text):
+        """Yield (pattern_id, start, end) for each match in normalized text.
+
+        Matches of the same pattern never overlap, mirroring `re.finditer`.
+        """
+        goto, fail, output = self._goto, self._fail, self._output
+        lengths = [len(pattern) for pattern in self.patterns]
+        last_end = [0] * len(self.patterns)
+        state = 0
+
+        for pos, char in enumerate(normalized_text):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+
+            for pattern_id in output[state]:
+                end = pos + 1
+                start = end - lengths[pattern_id]
+                if start >= last_end[pattern_id]:
+                    last_end[pattern_id] = end
+                    yield pattern_id, start, end
 
-    for page_num, page_text in text_by_page.items():
-        normalized_text = normalize_text(page_text)
+    def terms_for(self, pattern_id):
+        """Return the original terms that normalize to a pattern"""
+        return self._pattern_terms[pattern_id]
 
-        if normalized_term in normalized_text:
-            contexts = []
-            term_positions = [m.start() for m in re.finditer(normalized_term, normalized_text)]
+def iter_search_results(pages, terms, summaries=False):
+    """Lazily search a stream of pages for all terms, yielding results page by page.
 
-            for pos in term_positions:
-                context = get_context(page_text, term)
-                if context:
-                    contexts.append(context)
+    `pages` is a dict of page number -> text or any iterable of (page number, text)
+    pairs such as `DocumentHandler.iter_pages()`, so results for early pages are
+    available before the rest of the document has been extracted. Each hit maps
+    back to the raw text through the page's offset map, so its context is cut
+    around that occurrence rather than the first one on the page.
+    Pages may also be given as `NormalizedPage`s, e.g. loaded with their stored
+    sentence boundaries. Yields (page number, {term: [contexts]}) for pages with
+    at least one hit; with summaries=True each context is an (excerpt, summary)
+    pair, the summary being the excerpt's first sentence as `generate_summary`
+    would give it, without tokenizing the excerpt again.
+    """
+    matcher = terms if isinstance(terms, TermMatcher) else TermMatcher(terms)
+    if not matcher.patterns:
+        return
 
-            if contexts:
-                results[page_num] = contexts
+    if hasattr(pages, 'items'):
+        pages = pages.items()
 
+    for page_num, page in pages:
+        if not isinstance(page, NormalizedPage):
+            page = NormalizedPage(page)
+        page_results = {}
+
+        for pattern_id, start, end in matcher.scan(page.normalized):
+            context_start, context_end = page.context_span(start, end)
+            context = page.text[context_start:context_end].strip()
+            if summaries:
+                context = (context, page.first_sentence(context_start, context_end))
+            for term in matcher.terms_for(pattern_id):
+                page_results.setdefault(term, []).append(context)
+
+        if page_results:
+            metrics.increment("search_hits", sum(len(contexts) for contexts in page_results.values()))
+            yield page_num, page_results
+        metrics.increment("pages_searched")
+
+def iter_search_hits(pages, terms):
+    """Like `iter_search_results`, but yields context windows as offsets instead of text.
+
+    Yields (page number, {term: [(start, end, matches)]}) where [start, end) is
+    a context window in the page's raw text. Overlapping windows of one term on
+    a page are merged into one, and matches counts the occurrences it covers,
+    so repeated occurrences don't produce near-identical excerpts. A window
+    isn't merged past MAX_HIT_SPAN characters, so a page dense with matches
+    gives several excerpts instead of one the size of the page. Render a
+    window with `NormalizedPage.excerpt` and `NormalizedPage.first_sentence`.
+    """
+    matcher = terms if isinstance(terms, TermMatcher) else TermMatcher(terms)
+    if not matcher.patterns:
+        return
+
+    if hasattr(pages, 'items'):
+        pages = pages.items()
+
+    for page_num, page in pages:
+        if not isinstance(page, NormalizedPage):
+            page = NormalizedPage(page)
+        windows = {}
+        match_count = 0
+
+        # A pattern's matches come in text order, so its windows only ever extend the last one
+        for pattern_id, start, end in matcher.scan(page.normalized):
+            context_start, context_end = page.context_span(start, end)
+            pattern_windows = windows.setdefault(pattern_id, [])
+            if (pattern_windows and context_start < pattern_windows[-1][1]
+                    and max(pattern_windows[-1][1], context_end) - pattern_windows[-1][0] <= MAX_HIT_SPAN):
+                last_start, last_end, matches = pattern_windows[-1]
+                pattern_windows[-1] = (last_start, max(last_end, context_end), matches + 1)
+            else:
+                pattern_windows.append((context_start, context_end, 1))
+            match_count += 1
+
+        if windows:
+            page_results = {}
+            for pattern_id, pattern_windows in windows.items():
+                for term in matcher.terms_for(pattern_id):
+                    page_results[term] = pattern_windows
+            metrics.increment("search_hits", match_count)
+            yield page_num, page_results
+        metrics.increment("pages_searched")
+
+def search_hits_multi(text_by_page, terms):
+    """Search for all terms at once like `search_terms_multi`, returning term -> {page number: [(start, end, matches)]}"""
+    results = {}
+    with metrics.span("search"):
+        for page_num, page_results in iter_search_hits(text_by_page, terms):
+            for term, windows in page_results.items():
+                results.setdefault(term, {})[page_num] = windows
     return results
 
-def generate_summary(text, max_length=150):
-    """Generate a brief summary of the context"""
-    try:
-        sentences = sent_tokenize(text)
-    except LookupError:
-        # Fallback if tokenization fails
-        sentences = [text]
+def search_terms_multi(text_by_page, terms, summaries=False):
+    """Search for all terms at once, normalizing and scanning each page a single time.
 
-    if not sentences:
-        return ""
+    Returns a dict of term -> {page number: [contexts]}, or of
+    [(excerpt, summary)] with summaries=True.
+    """
+    results = {}
+    with metrics.span("search"):
+        for page_num, page_results in iter_search_results(text_by_page, terms, summaries):
+            for term, contexts in page_results.items():
+                results.setdefault(term, {})[page_num] = contexts
+    return results
 
-    summary = sentences[0]
-    if len(summary) > max_length:
-        summary = summary[:max_length] + "..."
+def search_terms(text_by_page, term):
+    """Search for terms in text and return page numbers and contexts"""
+    return search_terms_multi(text_by_page, [term]).get(term, {})
 
-    return summary
\ No newline at end of file
+def generate_summary(text, max_length=150):
+    """Generate a brief summary of the context"""
+    return _first_sentence(text, sentence_boundaries(text), 0, len(text), max_length)
\ No newline at end of file
@@ -0,0 +1,41 @@
+"""Run the analysis jobs queued by the app.
+
+Start any number of these, on any hosts that reach the database; each claims
+one queued job at a time. Set EMBEDDED_WORKER=0 on the app when they run, so
+the app doesn't process jobs itself.
+
+    python worker.py
+    python worker.py --once
+"""
+import argparse
+import sys
+
+from utils.database import init_db
+from utils.jobs import JOB_POLL_SECONDS, work
+from utils.metrics import start_metrics_server
+from utils.search_index import init_search_index
+from utils.text_processor import init_tokenizer
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run queued document analysis jobs")
+    parser.add_argument("--once", action="store_true", help="exit when the queue is empty instead of waiting for jobs")
+    parser.add_argument("--poll", type=float, default=JOB_POLL_SECONDS, help="seconds between checks for new jobs")
+    parser.add_argument("--id", help="worker name shown on its jobs (default: host, pid and a random suffix)")
+    args = parser.parse_args(argv)
+
+    init_db()
+    init_search_index()
+    init_tokenizer()
+    # Serve Prometheus metrics when METRICS_PORT is set
+    start_metrics_server()
+
+    try:
+        ran = work(args.id, once=args.once, poll_seconds=args.poll)
+    except KeyboardInterrupt:
+        # A job cut short here is requeued once its heartbeat goes stale
+        return 130
+    print(f"Ran {ran} jobs", file=sys.stderr)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())